@@ -124,6 +124,149 @@
 #
 #  To return to the standard "0" and "1" display, enter "z" all by itself.  
 #  
+#  A program stuck in a loop will run forever. To stop runs after a given
+#  number of seconds, enter "t<seconds>" (i.e. "t5"). Enter "t" all by
+#  itself to take the time limit away again.
+#  
+#  Enter "b" to step BACK one instruction, or "b<number>" (i.e. "b10")
+#  to go back that many. Every "s" step is remembered. Runs are only
+#  remembered after "k" (enter "k" again to stop); that makes runs
+#  slower, so it is off to begin with, and going back skips over runs
+#  that weren't remembered.
+#  
+#  To stop a run part way, set a breakpoint with "@" and then:
+#  
+#      "@12"       stop when the program gets to pc 12
+#      "@tag3"     stop when it gets to a "tag,3"
+#      "@cell3,4"  stop when the bit at x=3 y=4 changes
+#      "@flag"     stop when the flag changes
+#      "@row10"    stop when the pointer moves into row 10
+#      "@col5"     stop when the pointer moves into column 5
+#  
+#  Entering the same one again takes it away. "@" by itself lists them
+#  and "@clear" takes them all away. Runs with breakpoints set are
+#  slower.
+#  
+#  To come back to where you are later, enter ">" and a name (i.e.
+#  ">before") to save a snapshot of the machine, and "<" and the name
+#  ("<before") to go back to it: the program counter, pointer, flag and
+#  every bit of the field are put back as they were. ">" by itself lists
+#  them. A name ending ".ob1s" is saved to (or read from) a file of that
+#  name instead, to come back to another day with the same program.
+#  
+#  Enter "p" to switch the profiler on (or off again). After each run it
+#  lists every instruction that was executed with how many times it ran,
+#  how often its condition held, how far each "adv,"/"ret," jumped, and
+#  the steps and time spent between each "tag," and the next. It also
+#  writes "<program>.folded" for flame graph tools. Runs are a lot slower
+#  with it on.
+#  
+#  To watch a program as it runs, enter "w<times a second>" (i.e. "w10")
+#  and the screen is redrawn up to that many times a second while the
+#  program runs. Enter "w" all by itself to stop watching.
+#  
+#  On a terminal that understands ANSI cursor movement only the parts of
+#  the screen that change are redrawn. Start the program with "--plain"
+#  to have the whole screen printed every time instead.
+#  
+#  To get a data field without edges, start the program with
+#  
+#      python mjh_ob1.py --sparse
+#  
+#  Then the pointer can go as far as you like in any direction (even left
+#  of or below "HOME") and is never out of range. The 16x16 part of the
+#  field on display follows the pointer around, and the pointer's
+#  position is shown under the field.
+#  
+#  The data field doesn't have to be 16x16. To make it bigger (or
+#  smaller), start the program with
+#  
+#      python mjh_ob1.py --width 640 --height 480
+#  
+#  and the part on display follows the pointer the same way. Add
+#  "--field image.bits" to keep the field in a file instead of in
+#  memory, for fields far too big to fit (see MappedField below for the
+#  file layout). The file is made if it isn't there, and whatever the
+#  program leaves in the field is still there next time.
+#  
+#  Enter "i" to switch infinite loop detection on (or off again). While
+#  it is on, a run that gets back into a state it has already been in
+#  stops with "infinite loop detected at pc N after K steps". Runs are a
+#  bit slower with it on.
+#  
+#  Enter "o" to switch the optimizer on (or off again). It lists the runs
+#  of instructions in the program it can do in one go (see OPTIMIZER
+#  below); programs run faster, but otherwise exactly the same.
+#  
+#  After a run, the number of instructions executed, the time it took and
+#  the instructions per second are shown after the exception message.
+#  
+#############################################################################  
+#  USING THE MACHINE FROM ANOTHER PYTHON PROGRAM
+#############################################################################
+#  
+#  Importing this file does nothing by itself (no banner, no prompts).
+#  The console only starts when the file is run as a program.
+#  
+#  To drive the machine from your own code, make a "Machine":
+#  
+#      import mjh_ob1
+#      m = mjh_ob1.Machine()
+#      m.load("scan.ob1")        # a filename or a list of instruction codes
+#      m.step()                  # one instruction, returns the exception
+#      m.run(max_steps=10000)    # runs until something stops it
+#      m.run(time_limit=2.5)     # ... or until 2.5 seconds have gone by
+#      m.run(detect_loops=True)  # ... or until it is clearly stuck
+#      m.run(backend="compiled") # same, but compiled to Python first
+#      m.optimize()              # list of runs of instructions done in one go
+#      m.run(watchers=[mjh_ob1.Profiler()])   # see PROFILER below
+#      m.step_back(trace, 10)    # with a Trace watching (see TRACE below)
+#      m.state()                 # dictionary of pc, pointer, flag, field
+#      m.state(field="cells")    # ... with just where the "1"s are
+#      m.snapshot()              # all of that as bytes, for m.restore()
+#      m.fork()                  # a second machine from the same point
+#      memo.run(m)               # m.run(), remembered (see Memo below)
+#  
+#  For another size of field, or one kept in a file:
+#  
+#      m = mjh_ob1.Machine(mjh_ob1.Field(width=64, height=32))
+#      m = mjh_ob1.Machine(mjh_ob1.MappedField("image.bits", 65536, 65536))
+#  
+#  Programs can also be kept as binary ".ob1b" tapes, which load much
+#  faster than text (see "Binary tapes" below):
+#  
+#      python mjh_ob1.py --assemble scan.ob1 scan.ob1b
+#      python mjh_ob1.py --disassemble scan.ob1b > scan.ob1
+#  
+#  A tape is loaded like any other program, by a filename ending ".ob1b".
+#  
+#  To set up a field and run a program without typing (from another
+#  program, say), put the console commands in a file, one a line, and
+#  start the program with
+#  
+#      python mjh_ob1.py --script setup.txt
+#  
+#  ("--script -" takes them from a pipe). There is no banner and nothing
+#  is drawn until the commands run out (or "q"); then the screen is shown
+#  once. Add "--json" to get the machine's state as JSON instead (with
+#  "--field-output cells" just the [x, y] of every "1", for a big field,
+#  or "--field-output none" to leave the field out). Only
+#  that goes to stdout; what the commands print (the loader's messages,
+#  "?????") goes to stderr, and the exit status is 1 if a program didn't
+#  load or a command wasn't understood.
+#  
+#  Programs can be rewritten as they are loaded, with rules found by
+#  mjh_ob1_superopt.py (see "Rewrite rules" below):
+#  
+#      python mjh_ob1.py --rules ob1.rules
+#  
+#  The console commands (l, r, u, d, h, 0/1 strings, f) are available as
+#  m.move(), m.home(), m.data_bits() and m.toggle_flag().
+#  
+#  m.run() returns a RunResult: why it stopped (the same message the
+#  console shows), the number of steps, the elapsed time and the
+#  instructions per second.
+#  
 #############################################################################  
 #############################################################################  
 #
@@ -185,6 +328,9 @@
 #  Retreat program to the previous "tag," with the same id as
 #  proclaimed by the "ret," instruction (0 through 15).
 #  
+#  If an "adv," or "ret," has no "tag," to go to, you are warned when the
+#  program is loaded. Running into it anyway gives "tag not found".
+#  
 #   exec,
 #  Always and unconditionally perform the indicated operation.
 #  
@@ -277,47 +423,33 @@
 #############################################################################
 #  
 # 
-print()
-print('******************************************************************')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*                                                                *')
-print('*  "MJH One-Bit Machine Type 01"                                 *')
-print('*  should run in a window at least 66 characters wide            *')
-print('*  and 40 characters high for best results.                      *')
-print('*                                                                *')     
-dummy = input('*****  Hit <ENTER> to continue.  *********************************')
+
+import argparse
+import array
+import collections
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+def func_banner():
+    print()
+    print('******************************************************************')
+    i = 0
+    while i < 34:
+        print('*                                                                *')
+        i += 1
+    print('*  "MJH One-Bit Machine Type 01"                                 *')
+    print('*  should run in a window at least 66 characters wide            *')
+    print('*  and 40 characters high for best results.                      *')
+    print('*                                                                *')     
+    dummy = input('*****  Hit <ENTER> to continue.  *********************************')
 
 def func_get_number(this_str):
     try:
@@ -330,147 +462,292 @@ def func_get_number(this_str):
         print("????")
         return 0
 
-def func_data_bits(this_str):
-    old_str = mem[memy]
-    new_str = old_str[ : memx * 3]
+#  Puts a string of "0"s and "1"s into a row of the data field (an int,
+#  bit x = column x) starting at column memx. Bits that don't fit in
+#  width are dropped. Returns the new row, or the old one if the string
+#  is bad.
+def func_data_bits(old_row, memx, this_str, width=16):
+    new_row = old_row
     bad_error = "So far, so good."
     i=0
     while i < len(this_str):
         bit_str = this_str[i]
         if bit_str == "0" or bit_str == "1":
-            new_str = new_str + " " + bit_str + " "
+            if memx + i < width:
+                if bit_str == "1":
+                    new_row = new_row | (1 << (memx + i))
+                else:
+                    new_row = new_row & ~(1 << (memx + i))
         else:
             bad_error = "TROUBLE!"
         i += 1
-    new_str = new_str + old_str[(i + memx) * 3 : ]
-    new_str = new_str[ : 48]
     if bad_error == "TROUBLE!":
-        new_str = old_str
+        new_row = old_row
         print("?????")
-    return new_str
+    return new_row
 
-def func_read_prog(filename):
-    bad_error = 0
-    
-    try:
-        prog_file = open(filename[1 : -1], "r")
-    
-        xline = prog_file.readline()
-        
-        line_number = 0
-        bad_error = 0    
+############################################################################
+#
+#  Loading a program
+#
+#  The whole file is read in one go and each line looked up in the two
+#  tables below. A line that has been seen before (most lines of a long
+#  tape have) isn't worked out again.
+#
+#  Every bad line is reported with its line number and error number:
+#      1 - no comma
+#      2 - unknown header
+#      3 - numeric expression out of range
+#      4 - instruction or number expected
+#      5 - the file can't be opened
+#  The program is only loaded up to the first bad line.
+#
+#  A good load is also saved in a cache (one file per program, in
+#  ~/.cache/mjh_ob1 or wherever MJH_OB1_CACHE says). Loading the same
+#  file again, not changed since (same modification time, same
+#  contents), takes the instruction codes straight from the cache.
+#
 
-        while xline != "":
-            print(xline[:-1])
-            line_number += 1
-            workline = xline.upper()[:-1]
-            
-            if workline != "":         
-                if workline.find("#") >= 0:
-                    workline = workline[ : workline.find("#")]
-                if workline.find("@") >= 0:
-                    workline = workline[workline.find("@") + 1 : ]
-                    
-                workline = workline.strip()
-
-                if workline != "":
-                    xcode = 0
-                    comma = workline.find(",")
-                    if comma == -1:
-                        print("No comma")
-                        bad_error = 1
-                        break
-                    chunk = workline[:comma]
-                    if chunk == "TAG":
-                        xcode = 128
-                    elif chunk == "ADV":
-                        xcode = 144
-                    elif chunk == "RET":
-                        xcode = 160
-                    elif chunk == "EXEC":
-                        xcode = 176
-                    elif chunk == "IFD0":
-                        xcode = 192
-                    elif chunk == "IFD1":
-                        xcode = 208
-                    elif chunk == "IFF0":
-                        xcode = 224
-                    elif chunk == "IFF1":
-                        xcode = 240
-                    else:
-                        print("Unknown header")
-                        bad_error = 2
-                        break
-                
-                    chunk = workline[comma + 1 :]
-                    if chunk == "R":
-                        xcode = xcode + 0
-                    elif chunk == "L":
-                        xcode = xcode + 1
-                    elif chunk == "U":
-                        xcode = xcode + 2
-                    elif chunk == "D":
-                        xcode = xcode + 3
-                    elif chunk == "H":
-                        xcode = xcode + 4
-                    elif chunk == "X":
-                        xcode = xcode + 5
-                    elif chunk == "SK":
-                        xcode = xcode + 6
-                    elif chunk == "EX":
-                        xcode = xcode + 7
-                    elif chunk == "DF":
-                        xcode = xcode + 8
-                    elif chunk == "DC":
-                        xcode = xcode + 9
-                    elif chunk == "D0":
-                        xcode = xcode + 10
-                    elif chunk == "D1":
-                        xcode = xcode + 11
-                    elif chunk == "FD":
-                        xcode = xcode + 12
-                    elif chunk == "FC":
-                        xcode = xcode + 13
-                    elif chunk == "F0":
-                        xcode = xcode + 14
-                    elif chunk == "F1":
-                        xcode = xcode + 15
-                    else:
-                        try:
-                            trial_number = int(chunk)
-                            if (trial_number > 15) or (trial_number < 0):
-                                
-                                print("Numeric expression out of range")
-                                bad_error = 3
-                                break
-                            else:
-                                xcode = xcode + trial_number
-                        except:
-                            print("Instruction or number expected")
-                            bad_error = 4
-                            break
+_load_headers = {
+    "TAG": 128, "ADV": 144, "RET": 160, "EXEC": 176,
+    "IFD0": 192, "IFD1": 208, "IFF0": 224, "IFF1": 240,
+}
+
+_load_operations = {
+    "R": 0, "L": 1, "U": 2, "D": 3, "H": 4, "X": 5, "SK": 6, "EX": 7,
+    "DF": 8, "DC": 9, "D0": 10, "D1": 11, "FD": 12, "FC": 13, "F0": 14, "F1": 15,
+}
+
+_load_errors = {
+    1: "No comma",
+    2: "Unknown header",
+    3: "Numeric expression out of range",
+    4: "Instruction or number expected",
+}
+
+_cache_dir = os.environ.get("MJH_OB1_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "mjh_ob1")
+
+#  One line of a program (in upper case) to (code, error). code is None
+#  for a line with no instruction on it.
+def func_encode_line(xline):
+    workline = xline
+    if workline.find("#") >= 0:
+        workline = workline[ : workline.find("#")]
+    if workline.find("@") >= 0:
+        workline = workline[workline.find("@") + 1 : ]
+    workline = workline.strip()
+    if workline == "":
+        return (None, 0)
+
+    comma = workline.find(",")
+    if comma == -1:
+        return (None, 1)
+    xcode = _load_headers.get(workline[:comma])
+    if xcode is None:
+        return (None, 2)
 
-                    #print("#! >>>",xcode) ###  I'm commenting this
-                    #                      ###   print line out because
-                    #                      ###   it clutters the screen
-                    #                      ###  and nobody cares anyway!
-                    
-                    proglist.append(xcode)
-            xline = prog_file.readline()
-            
-        prog_file.close()
-
-        print(">>>",filename)
+    chunk = workline[comma + 1 :]
+    operation = _load_operations.get(chunk)
+    if operation is None:
+        try:
+            operation = int(chunk)
+        except ValueError:
+            return (None, 4)
+        if (operation > 15) or (operation < 0):
+            return (None, 3)
+    return (xcode + operation, 0)
+
+#  Appends the instruction codes in text to proglist (up to the first bad
+#  line), their line numbers to linenos, and (line number, error number)
+#  for every bad line to errors.
+def func_parse_prog(text, proglist, linenos, errors):
+    known = {}
+    line_number = 0
+    text = text.upper().replace("\r\n", "\n").replace("\r", "\n")
+    for xline in text.split("\n"):
+        line_number += 1
+        encoded = known.get(xline)
+        if encoded is None:
+            encoded = func_encode_line(xline)
+            known[xline] = encoded
+        xcode, bad_error = encoded
         if bad_error != 0:
-            print(">>> Error", bad_error, "in line", line_number)
-        else:
+            errors.append((line_number, bad_error))
+        elif xcode is not None and not errors:
+            proglist.append(xcode)
+            linenos.append(line_number)
+
+#  The cache file for a program, named after its full path.
+def func_cache_file(filename):
+    return os.path.join(_cache_dir, hashlib.sha256(os.path.abspath(filename).encode()).hexdigest() + ".ob1c")
+
+#  A cache file is one line "ob1c 1 <mtime> <sha256 of the source> <count>",
+#  then count instruction codes (a byte each), then count line numbers
+#  (4 bytes each). Returns (codes, line numbers), or None when there is
+#  no cache file, it is for another version of the program, or it is cut
+#  short or damaged.
+def func_read_cache(filename, mtime, digest):
+    try:
+        with open(func_cache_file(filename), "rb") as cache_file:
+            data = cache_file.read()
+    except OSError:
+        return None
+    header, newline, body = data.partition(b"\n")
+    fields = header.split()
+    if len(fields) != 5 or fields[0] != b"ob1c" or fields[1] != b"1":
+        return None
+    if fields[2] != str(mtime).encode() or fields[3] != digest.encode():
+        return None
+    try:
+        count = int(fields[4])
+    except ValueError:
+        return None
+    lines = array.array("I")
+    if count < 0 or len(body) != count + lines.itemsize * count:
+        return None
+    codes = body[:count]
+    if count and min(codes) < 128:
+        return None
+    lines.frombytes(body[count:])
+    return (codes, lines)
+
+#  Never fails: a cache that can't be written just isn't used.
+def func_write_cache(filename, mtime, digest, proglist, linenos):
+    cache_name = func_cache_file(filename)
+    header = "ob1c 1 %d %s %d\n" % (mtime, digest, len(proglist))
+    try:
+        os.makedirs(_cache_dir, exist_ok=True)
+        #  A temporary file of its own, so two loads writing the same
+        #  cache at once can't mix their writes.
+        handle, temp_name = tempfile.mkstemp(suffix=".tmp", dir=_cache_dir)
+    except OSError:
+        return
+    try:
+        with os.fdopen(handle, "wb") as cache_file:
+            cache_file.write(header.encode())
+            cache_file.write(bytes(proglist))
+            cache_file.write(array.array("I", linenos).tobytes())
+        os.replace(temp_name, cache_name)
+    except OSError:
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass
+
+#  Appends the instruction codes to proglist and, if given, the source
+#  line number of each instruction to linenos. Returns 0 for a good load,
+#  otherwise the number of the first error.
+def func_read_prog(filename, proglist, verbose=True, linenos=None, cache=True):
+    try:
+        with open(filename, "rb") as prog_file:
+            data = prog_file.read()
+            mtime = os.fstat(prog_file.fileno()).st_mtime_ns
+    except OSError:
+        if verbose:
+            print(">>>", '"' + filename + '"', "can't be opened.")
+        return 5
+
+    digest = hashlib.sha256(data).hexdigest()
+    cached = None
+    if cache:
+        cached = func_read_cache(filename, mtime, digest)
+
+    errors = []
+    if cached is not None:
+        codes, lines = cached
+    else:
+        codes = []
+        lines = []
+        func_parse_prog(data.decode("utf-8", "replace"), codes, lines, errors)
+        if cache and not errors:
+            func_write_cache(filename, mtime, digest, codes, lines)
+
+    proglist.extend(codes)
+    if linenos is not None:
+        linenos.extend(lines)
+
+    if verbose:
+        print(">>>", '"' + filename + '"')
+        for line_number, bad_error in errors:
+            print(">>> Error", bad_error, "in line", line_number, "-", _load_errors[bad_error])
+        if not errors:
             print(">>> Successful Program Load")
-    except:
-        print(">>>",filename,"can't be opened.")
-        bad_error = 5
-    return bad_error
+    if errors:
+        return errors[0][1]
+    return 0
+
+#  Builds the jump table for "adv," and "ret,". For every instruction the
+#  table holds the program counter of the "tag," it goes to, or -1 when
+#  there is no such tag (or the instruction isn't an "adv,"/"ret,").
+#  One pass backward finds the next tag of each id for "adv,", one pass
+#  forward finds the previous tag of each id for "ret,".
+def func_tag_table(proglist):
+    proglist_length = len(proglist)
+    jumps = [-1] * proglist_length
+
+    next_tag = [-1] * 16
+    pc = proglist_length - 1
+    while pc >= 0:
+        header = proglist[pc] >> 4
+        if header == 9:
+            jumps[pc] = next_tag[proglist[pc] & 15]
+        elif header == 8:
+            next_tag[proglist[pc] & 15] = pc
+        pc -= 1
+
+    last_tag = [-1] * 16
+    pc = 0
+    while pc < proglist_length:
+        header = proglist[pc] >> 4
+        if header == 10:
+            jumps[pc] = last_tag[proglist[pc] & 15]
+        elif header == 8:
+            last_tag[proglist[pc] & 15] = pc
+        pc += 1
+
+    return jumps
+
+#  Matches any "adv," or "ret," instruction code, so they can be found
+#  in a program (as bytes) without looking at every instruction in
+#  Python.
+_jump_codes = re.compile(b"[\x90-\xaf]")
+
+#  The program counters of the "adv,"/"ret," instructions in proglist.
+def func_jump_pcs(proglist):
+    if not isinstance(proglist, (bytes, memoryview)):
+        proglist = bytes(proglist)
+    return [found.start() for found in _jump_codes.finditer(proglist)]
 
-def func_format_progline(pcounter):
+#  Lists the "adv,"/"ret," instructions that have nowhere to go.
+def func_missing_tags(proglist, jumps):
+    return [pc for pc in func_jump_pcs(proglist) if jumps[pc] < 0]
+
+#  Decodes the program once, at load time, into one (condition, action,
+#  argument) tuple per instruction, so the run loop never has to pull
+#  instruction codes apart.
+#
+#  condition: 0 = always (exec, tag, adv, ret), 1 = ifd0, 2 = ifd1,
+#             3 = iff0, 4 = iff1
+#  action:    0 thru 15 = the operations r thru f1,
+#             16 = adv/ret (argument = program counter of the tag, or -1),
+#             17 = tag (does nothing)
+def func_decode_code(xcode):
+    header = xcode >> 4
+    if header >= 11 and header <= 15:
+        return (header - 11, xcode & 15, 0)
+    return (0, 17, 0)                           # tag (or undefined)
+
+#  Every instruction code but "adv,"/"ret," always decodes the same, so
+#  those come from a table and only the jumps are filled in after.
+_decoded = [func_decode_code(xcode) for xcode in range(256)]
+
+def func_decode_prog(proglist, jumps):
+    code = [_decoded[xcode] for xcode in proglist]
+    for pc in func_jump_pcs(proglist):
+        code[pc] = (0, 16, jumps[pc])
+    return code
+
+def func_format_progline(proglist, pcounter):
 
     if pcounter < 0 or pcounter >= len(proglist):
         return "#"
@@ -535,315 +812,3168 @@ def func_format_progline(pcounter):
             that_str = that_str + "#?"
         return that_str
 
+############################################################################
+#
+#  Binary tapes
+#
+#  Every instruction is already one byte (128 thru 255), so a program can
+#  also be kept as a binary ".ob1b" tape, which loads without any parsing:
+#
+#      bytes 0-3    "OB1B"
+#      bytes 4-5    version (1)
+#      bytes 6-7    0
+#      bytes 8-11   length: the number of instructions
+#      bytes 12-15  offset of the tag index
+#      bytes 16...  the instructions, one byte each
+#      then, at the tag index offset (a multiple of 4), one 4-byte number
+#      per instruction: the program counter an "adv,"/"ret," there goes
+#      to, or -1 (what func_tag_table works out)
+#
+#  All numbers are little-endian. The tape is mapped with mmap and used
+#  where it lies: the program is a memoryview of the file, not a copy.
+#  Loading only checks that each "adv,"/"ret," entry of the tag index
+#  leads to a tag with its id; the tags aren't searched for again.
+#
+#  func_assemble turns a text program into a tape and func_disassemble
+#  turns a tape back into text (a line per instruction, as the console
+#  lists them), which assembles to the same tape again.
+#
+
+_tape_header = struct.Struct("<4sHHII")
+_tape_version = 1
+
+def func_write_tape(filename, proglist):
+    length = len(proglist)
+    tag_index = (_tape_header.size + length + 3) & ~3
+    with open(filename, "wb") as tape_file:
+        tape_file.write(_tape_header.pack(b"OB1B", _tape_version, 0, length, tag_index))
+        tape_file.write(bytes(proglist))
+        tape_file.write(bytes(tag_index - _tape_header.size - length))
+        tape_file.write(struct.pack("<%di" % length, *func_tag_table(proglist)))
+
+#  Returns (proglist, jumps). Both are views of the mapped file. Raises
+#  ValueError if the file isn't a good tape.
+def func_read_tape(filename):
+    with open(filename, "rb") as tape_file:
+        size = os.fstat(tape_file.fileno()).st_size
+        if size < _tape_header.size:
+            raise ValueError("%s is not an ob1b tape" % filename)
+        tape = mmap.mmap(tape_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, zero, length, tag_index = _tape_header.unpack_from(tape)
+    if magic != b"OB1B":
+        raise ValueError("%s is not an ob1b tape" % filename)
+    if version != _tape_version:
+        raise ValueError("%s is an ob1b tape of version %d, not %d" % (filename, version, _tape_version))
+    if tag_index & 3 or tag_index < _tape_header.size + length or size < tag_index + 4 * length:
+        raise ValueError("%s is cut short or damaged" % filename)
+
+    proglist = memoryview(tape)[_tape_header.size : _tape_header.size + length]
+    if length > 0 and min(proglist) < 128:
+        raise ValueError("%s has a bad instruction code in it" % filename)
+    jumps = memoryview(tape)[tag_index : tag_index + 4 * length]
+    if sys.byteorder != "little":
+        return (proglist, func_tag_table(proglist))
+    jumps = jumps.cast("i")
+
+    #  Only the entries for "adv,"/"ret," are ever used. Each must be -1,
+    #  or lead the right way to a tag with the same id: a damaged one
+    #  could send a jump off the end of the tape.
+    for pc in func_jump_pcs(proglist):
+        target = jumps[pc]
+        if target == -1:
+            continue
+        if proglist[pc] < 160:
+            good = pc < target < length
+        else:
+            good = 0 <= target < pc
+        if not good or proglist[target] != 128 + (proglist[pc] & 15):
+            raise ValueError("%s is cut short or damaged" % filename)
+    return (proglist, jumps)
+
+#  Returns the error number from func_read_prog (0 = all went well).
+def func_assemble(source, target, verbose=True):
+    proglist = []
+    bad_error = func_read_prog(source, proglist, verbose)
+    if bad_error == 0:
+        func_write_tape(target, proglist)
+    return bad_error
+
+def func_disassemble(proglist):
+    return "".join(func_format_progline(proglist, pc) + "\n" for pc in range(len(proglist)))
+
+#
+#  Rewrite rules
+#
+#  A rule file (made by mjh_ob1_superopt.py, or by hand) lists runs of
+#  instructions that can be swapped for shorter ones doing exactly the
+#  same thing, one rule a line, instructions split by ";":
+#
+#      exec,f0; exec,fc  =>  exec,f1
+#      exec,ex; exec,ex  =>
+#
+#  "#" starts a comment. Both sides may only use straight-line
+#  instructions: "exec,", "ifd0,", "ifd1,", "iff0," and "iff1," with any
+#  operation but "h", "x" and "sk". An empty right side takes the run out.
+#
+#  With Machine.rules set (the console's --rules FILE), Machine.load
+#  rewrites the program with them: every run matching a left side is
+#  replaced (longest rule first), over and over until nothing matches. A
+#  run straight after an "sk" is left alone, since the "sk" would then
+#  skip something else, and so is a run at the end of the tape that
+#  would leave nothing, or an "x", at the end. The program does just
+#  what it did before, in fewer steps. Only the program counters differ:
+#  after a rewrite they count the new tape.
+#
+#  A rule with a move ("r", "l", "u" or "d") on either side is never
+#  used. A run of moves can stop partway with "data pointer out of
+#  range", and a stop inside a rewritten run could not be carried on
+#  from just where the old run would have stopped, so every stop must
+#  land on an instruction of the program as it was written.
+#
+
+def func_straight_line(code):
+    return code >= 176 and (code & 15) not in (4, 5, 6)
+
+#  True if any of codes moves the pointer.
+def func_has_moves(codes):
+    return any(code >= 176 and (code & 15) <= 3 for code in codes)
+
+#  "exec,f0; exec,fc" to a tuple of codes. Raises ValueError.
+def func_parse_rule_side(text):
+    codes = []
+    for chunk in text.split(";"):
+        if chunk.strip() == "":
+            continue
+        code, bad_error = func_encode_line(chunk.upper())
+        if bad_error != 0:
+            raise ValueError("%s: %s" % (chunk.strip(), _load_errors[bad_error]))
+        if not func_straight_line(code):
+            raise ValueError("%s: not a straight-line instruction" % chunk.strip())
+        codes.append(code)
+    return tuple(codes)
+
+#  Returns the list of (pattern, replacement) rules in filename. Raises
+#  OSError or ValueError.
+def func_read_rules(filename):
+    rules = []
+    with open(filename, "r") as rule_file:
+        line_number = 0
+        for xline in rule_file:
+            line_number += 1
+            if xline.find("#") >= 0:
+                xline = xline[: xline.find("#")]
+            if xline.strip() == "":
+                continue
+            if xline.count("=>") != 1:
+                raise ValueError('%s line %d: a rule is "pattern => replacement"' % (filename, line_number))
+            left, right = xline.split("=>")
+            try:
+                pattern = func_parse_rule_side(left)
+                replacement = func_parse_rule_side(right)
+            except ValueError as error:
+                raise ValueError("%s line %d: %s" % (filename, line_number, error))
+            if len(pattern) == 0 or len(replacement) >= len(pattern):
+                raise ValueError("%s line %d: the replacement must be shorter" % (filename, line_number))
+            rules.append((pattern, replacement))
+    return rules
+
+def func_format_rule(pattern, replacement):
+    left = "; ".join(func_format_progline(pattern, i) for i in range(len(pattern)))
+    right = "; ".join(func_format_progline(replacement, i) for i in range(len(replacement)))
+    return (left + "  =>  " + right).rstrip()
+
+#  Returns (proglist, linenos, count): the program rewritten with rules,
+#  the line number each new instruction came from (the first line of
+#  the run it replaced) and the number of rewrites.
+def func_apply_rules(proglist, linenos, rules):
+    by_first = {}
+    for pattern, replacement in rules:
+        if func_has_moves(pattern) or func_has_moves(replacement):
+            continue
+        by_first.setdefault(pattern[0], []).append((pattern, replacement))
+    for this_list in by_first.values():
+        this_list.sort(key=lambda rule: -len(rule[0]))
+
+    proglist = list(proglist)
+    linenos = list(linenos)
+    count = 0
+    changed = True
+    while changed:
+        changed = False
+        new_proglist = []
+        new_linenos = []
+        i = 0
+        while i < len(proglist):
+            code = proglist[i]
+            match = None
+            if code in by_first and not (i > 0 and proglist[i - 1] >= 176 and proglist[i - 1] & 15 == 6):
+                for pattern, replacement in by_first[code]:
+                    if tuple(proglist[i : i + len(pattern)]) != pattern:
+                        continue
+                    #  Taking out the end of the tape must leave something,
+                    #  and not an "x" (which would then end the program
+                    #  normally instead of halting).
+                    if not replacement and i + len(pattern) == len(proglist):
+                        if not new_proglist or (new_proglist[-1] >= 176 and new_proglist[-1] & 15 == 5):
+                            continue
+                    match = (pattern, replacement)
+                    break
+            if match is None:
+                new_proglist.append(code)
+                new_linenos.append(linenos[i])
+                i += 1
+            else:
+                pattern, replacement = match
+                new_proglist.extend(replacement)
+                new_linenos.extend([linenos[i]] * len(replacement))
+                i += len(pattern)
+                count += 1
+                changed = True
+        proglist = new_proglist
+        linenos = new_linenos
+    return (proglist, linenos, count)
+
 
 
 ############################################################################
 ###                                                                      ###
-###                               MAIN                                   ###
+###                            DATA FIELD                                ###
 ###                                                                      ###
 ############################################################################
-    
-print()
-proglist = []
-program_counter = -1
-str_0="0"
-str_1="1"
-mem = []
-memx = 0
-memy = 0
-flag = "0"
-exception = "ok"
-name = ""
-
-i=0
-while i < 16:
-    mem = mem + [" 0 " * 16]
-    i += 1
-
-quit = 0
-
-while quit == 0:
-    print()
-    print('To load a program, enter "path/filename" in quotes.')
-    print('<ENTER>=run s=step l=left r=right u=up d=down h=home')
-    print('0=reset_bit 1=set_bit f=toggle_flag q=quit')
-    print('*** See comments in listing for more options ***')
+#
+#  The data field is kept as one int per row: bit x of rows[y] is the bit
+#  at column x of row y (row 0 is the bottom row, column 0 the left).
+#  Setting, clearing or testing a bit is a single shift-and-mask.
+#
+#  func_field_view turns a row into the " 0  1  0 ..." text the console
+#  shows. Nothing else ever needs the text, so it is only built when the
+#  field is actually displayed.
+#
+#  There is more than one kind of field. They all have the same methods
+#  (test, set, clear, put, flip, row_bits, set_row_bits, set_bits,
+#  copy_bits, restore_bits, fork, close) and say what they are with two flags:
+#      dense   - the bits are in .rows, one int per row (the run loop
+#                and the compiler use .rows directly)
+#      bounded - the field has edges (.width x .height) and moving off
+#                it is "data pointer out of range"
+#
 
-    displayed_op = program_counter - 11
-    i=15
-    while i >= 0:
-        displayed_op += 1
-        this_str = mem[i]
-        this_str = this_str.replace("0",str_0)
-        this_str = this_str.replace("1",str_1)
-        
-        if i == 10:
-            this_str = this_str + str(program_counter).rjust(6) + " >>>"
+class Field:
+
+    dense = True
+    bounded = True
+
+    def __init__(self, width=16, height=16):
+        if width < 1 or height < 1:
+            raise ValueError("a data field needs at least one row and column")
+        self.width = width
+        self.height = height
+        self.rows = [0] * height
+
+    def test(self, x, y):
+        return (self.rows[y] >> x) & 1
+
+    def set(self, x, y):
+        self.rows[y] |= 1 << x
+
+    def clear(self, x, y):
+        self.rows[y] &= ~(1 << x)
+
+    def put(self, x, y, bit):
+        if bit:
+            self.rows[y] |= 1 << x
         else:
-            this_str = this_str+ "          "
-        print(this_str , func_format_progline(displayed_op))
+            self.rows[y] &= ~(1 << x)
 
-        displayed_op += 1      
-        if memy == i:
-            this_str = ("   " * memx) + "*^*" + ("   " * (15 - memx))
+    def flip(self, x, y):
+        self.rows[y] ^= 1 << x
+
+    #  The row as a string of "0"s and "1"s, left to right, starting at
+    #  column x0 (count bits, or the rest of the row).
+    def row_bits(self, y, x0=0, count=None):
+        if count is None:
+            count = self.width - x0
+        row = self.rows[y]
+        return "".join("1" if (row >> x) & 1 else "0" for x in range(x0, x0 + count))
+
+    #  Sets a row from a string of "0"s and "1"s, left to right.
+    def set_row_bits(self, y, bits, x0=0):
+        self.rows[y] = int(bits[: self.width][::-1] or "0", 2)
+
+    def close(self):
+        pass
+
+    #  Every (x, y) holding a "1".
+    def set_bits(self):
+        y = 0
+        while y < self.height:
+            row = self.rows[y]
+            x = 0
+            while row:
+                if row & 1:
+                    yield (x, y)
+                row >>= 1
+                x += 1
+            y += 1
+
+    #  A copy of the bits that can be compared with ==.
+    def copy_bits(self):
+        return list(self.rows)
+
+    #  Puts back bits from copy_bits.
+    def restore_bits(self, bits):
+        self.rows[:] = bits
+
+    #  A field of its own with the same bits. The row ints are shared
+    #  until one side changes a row (ints never change in place).
+    def fork(self):
+        field = Field(self.width, self.height)
+        field.rows[:] = self.rows
+        return field
+
+############################################################################
+#
+#  MappedField is a field too big to keep in memory as Python ints (say
+#  65536 x 65536 bits for an image), kept in a file instead. The file is
+#  just the bits, packed eight to a byte, one row after another from the
+#  bottom row up, each row starting on a new byte; bit x of a row is bit
+#  (x & 7) of byte (x >> 3), low bit first. A field of width w and height
+#  h is ((w + 7) // 8) * h bytes. If the file doesn't exist (or is too
+#  short) it is made (or lengthened) with "0"s.
+#
+#  The file is mapped with mmap, so nothing is read until the run touches
+#  it and changed pages are written back by the operating system when it
+#  gets round to it (or at close()).
+#
+
+class MappedField:
+
+    dense = False
+    bounded = True
+
+    def __init__(self, filename, width, height):
+        if width < 1 or height < 1:
+            raise ValueError("a data field needs at least one row and column")
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) >> 3
+        size = self.stride * height
+
+        if not os.path.exists(filename):
+            open(filename, "wb").close()
+        self.file = open(filename, "r+b")
+        actual = os.fstat(self.file.fileno()).st_size
+        if actual > size:
+            self.file.close()
+            raise ValueError("%s is %d bytes, more than a %d x %d field" % (filename, actual, width, height))
+        if actual < size:
+            self.file.truncate(size)
+        self.mem = mmap.mmap(self.file.fileno(), size)
+
+    def test(self, x, y):
+        return (self.mem[y * self.stride + (x >> 3)] >> (x & 7)) & 1
+
+    def set(self, x, y):
+        i = y * self.stride + (x >> 3)
+        self.mem[i] = self.mem[i] | (1 << (x & 7))
+
+    def clear(self, x, y):
+        i = y * self.stride + (x >> 3)
+        self.mem[i] = self.mem[i] & ~(1 << (x & 7)) & 255
+
+    def put(self, x, y, bit):
+        if bit:
+            self.set(x, y)
         else:
-            this_str = (" " * 48)
-        print(this_str , "         ", func_format_progline(displayed_op))
-        i -= 1
+            self.clear(x, y)
 
-    print("******************** FLAG=" + flag +  " ********************           ######&")
-    print(name)
-    print(exception)
-
-    exception = "ok"
-    
-    search_for_this = 0
-    cmd = ""
-    console_cmd = input()
-
-    if console_cmd != "":
-        cmd = console_cmd[0]
-  
-    if cmd == "l":  
-        memx -= func_get_number(console_cmd)
-        if memx < 0:
-            memx = 0
-        if memx > 15:
-            memx = 15
-    elif cmd == "r":
-        memx += func_get_number(console_cmd)
-        if memx < 0:
-            memx = 0
-        if memx > 15:
-            memx = 15
-    elif cmd == "u":
-        memy += func_get_number(console_cmd)
-        if memy < 0:
-            memy = 0
-        if memy > 15:
-            memy = 15
-    elif cmd == "d":
-        memy -= func_get_number(console_cmd)
-        if memy < 0:
-            memy = 0
-        if memy > 15:
-            memy = 15
-    elif console_cmd == "h":
-        memx = 0
-        memy = 0
-    elif console_cmd == "f":
-        if flag == "0":
-            flag = "1"
-        else:
-            flag = "0"
-    elif cmd == "0":
-        mem[memy] = func_data_bits(console_cmd)
-        
-    elif cmd == "1":
-        mem[memy] = func_data_bits(console_cmd)
-    elif cmd == "z":
-        this_str = console_cmd + "01"
-        str_0 = this_str[1]
-        str_1 = this_str[2]
+    def flip(self, x, y):
+        i = y * self.stride + (x >> 3)
+        self.mem[i] = self.mem[i] ^ (1 << (x & 7))
 
+    def row_bits(self, y, x0=0, count=None):
+        if count is None:
+            count = self.width - x0
+        return "".join("1" if self.test(x, y) else "0" for x in range(x0, x0 + count))
 
-##################################################################
-        
-    elif console_cmd == "s" or console_cmd == "":
-        mode = "run"
-        if console_cmd == "s":
-            mode = "step"
+    def set_row_bits(self, y, bits, x0=0):
+        i = 0
+        while i < len(bits) and x0 + i < self.width:
+            self.put(x0 + i, y, bits[i] == "1")
+            i += 1
 
-        exception = "ok"
+    #  Skips over runs of zero bytes a block at a time.
+    def set_bits(self):
+        block = 1 << 20
+        start = 0
+        size = len(self.mem)
+        while start < size:
+            chunk = self.mem[start : start + block]
+            if chunk.count(0) != len(chunk):
+                i = 0
+                while i < len(chunk):
+                    byte = chunk[i]
+                    if byte:
+                        y, column = divmod(start + i, self.stride)
+                        bit = 0
+                        while byte:
+                            if byte & 1:
+                                yield ((column << 3) + bit, y)
+                            byte >>= 1
+                            bit += 1
+                    i += 1
+            start += block
 
-        if len(proglist) == 0:
-            exception = "no program loaded"
-        else:
-            if program_counter < 0:
-                exception = "what happened???"
-            elif program_counter >= len(proglist):
-                program_counter = 0
-                exception = "ok"
-
-        while exception == "ok":
-               
-            header = int(proglist[program_counter] / 16)
-            opcode = int(proglist[program_counter] % 16)
-            do_op = "no"
-            exception = "ok"
-
-            if header == 9 or header == 10:  ############ adv/ret
-                
-                if header == 9:      # adv
-                    noodle = 1
-                elif header == 10:   # ret
-                    noodle = -1
-                
-                search_for_this = 128 + opcode # because (header of "tag") * 16 = 128
-                trial_pc = program_counter
-                proglist_length = len(proglist)
-                
-                keep_going = "yes"
-
-                while keep_going == "yes":
-                    trial_pc += noodle
-                    if trial_pc < 0 or trial_pc >= proglist_length:
-                        keep_going = "tag not found"
-                        exception = "tag not found"
-                    else:
-                        if proglist[trial_pc] == search_for_this:
-                            keep_going = "tag found"
-                            program_counter = trial_pc - 1
-                    
-            elif header == 11:   # exec
-                do_op = "yes"
-            elif header == 12:   # ifd0
-                if mem[memy][(3 * memx) + 1] == "0":
-                    do_op = "yes"
-                else:
-                    do_op = "no"
-            elif header == 13:   # ifd1
-                if mem[memy][(3 * memx) + 1] == "1":
-                    do_op = "yes"
-                else:
-                    do_op = "no"
-            elif header == 14:   # iff0
-                if flag =="0":
-                    do_op = "yes"
-                else:
-                    do_op = "no"
-            elif header == 15:   # iff1
-                if flag =="1":
-                    do_op = "yes"
-                else:
-                    do_op = "no"
-            
-            else:                # Includes tag
-                do_op = "no"
-            
-
-            if do_op == "yes":
-                if opcode == 0:      #### r
-                    memx += 1
-                    if memx > 15:
-                        memx = 15
-                        exception = "data pointer out of range"
-                elif opcode == 1:    #### l
-                    memx -= 1
-                    if memx < 0:
-                        memx = 0
-                        exception = "data pointer out of range"
-                elif opcode == 2:    #### u
-                    memy += 1
-                    if memy > 15:
-                        memy = 15
-                        exception = "data pointer out of range"
-                elif opcode == 3:    #### d
-                    memy -= 1
-                    if memy < 0:
-                        memy = 0
-                        exception = "data pointer out of range"
-                elif opcode == 4:    #### h
-                    memx = 0
-                    memy = 0
-                elif opcode == 5:    #### x
-                    exception = "halt"
-                elif opcode == 6:    #### sk
-                    program_counter += 1
-                elif opcode == 7:    #### ex
-                    old_flag = flag
-                    flag = mem[memy][(3 * memx) + 1]
-
-                    old_str = mem[memy]
-                    new_str = old_str[ : 1 + (memx * 3)]
-                    new_str = new_str + old_flag
-                    new_str = new_str + old_str[(memx * 3) + 2 : ]
-                    #new_str = new_str[ : 48]
-                    mem[memy] = new_str
-                    
-                elif opcode == 8:    #### df
-                    old_str = mem[memy]
-                    new_str = old_str[ : 1 + (memx * 3)]
-                    new_str = new_str + flag
-                    new_str = new_str + old_str[(memx * 3) + 2 : ]
-                    #new_str = new_str[ : 48]
-                    mem[memy] = new_str
-                    
-                elif opcode == 9:    #### dc
-                    data_bit = mem[memy][(3 * memx) + 1]
-                    
-                    if data_bit == "0":
-                        data_bit = "1"
-                    else:
-                        data_bit = "0"
-
-                    old_str = mem[memy]
-                    new_str = old_str[ : 1 + (memx * 3)]
-                    new_str = new_str + data_bit
-                    new_str = new_str + old_str[(memx * 3) + 2 : ]
-                    #new_str = new_str[ : 48]
-                    mem[memy] = new_str
-
-                elif opcode == 10:   #### d0
-                    old_str = mem[memy]
-                    new_str = old_str[ : 1 + (memx * 3)]
-                    new_str = new_str + "0"
-                    new_str = new_str + old_str[(memx * 3) + 2 : ]
-                    #new_str = new_str[ : 48]
-                    mem[memy] = new_str
-
-                elif opcode == 11:   #### d1
-                    old_str = mem[memy]
-                    new_str = old_str[ : 1 + (memx * 3)]
-                    new_str = new_str + "1"
-                    new_str = new_str + old_str[(memx * 3) + 2 : ]
-                    #new_str = new_str[ : 48]
-                    mem[memy] = new_str
-
-                elif opcode == 12:   #### fd
-                    flag = mem[memy][(3 * memx) + 1]
-
-                elif opcode == 13:   #### fc
-                    if flag == "0":
-                        flag = "1"
-                    else:
-                        flag = "0"
-                        
-                elif opcode == 14:   #### f0
-                    flag = "0"
-                elif opcode == 15:   #### f1
-                    flag = "1"
-                else:               #### undefined error (should never happen)
-                    exception = "undefined error"
-
-            if exception == "ok" or exception == "halt":
-                program_counter += 1
-                if program_counter >= len(proglist):
-                    exception = "Program terminated normally"
+    #  (A copy of the whole file: only cheap for small fields.)
+    def copy_bits(self):
+        return bytes(self.mem)
 
-            if mode == "step" and exception == "ok":
-                exception = "step"
+    def restore_bits(self, bits):
+        self.mem[:] = bits
 
-###################################################################
+    #  A field of its own with the same bits: a private (copy-on-write)
+    #  mapping of the same file, so only the pages one side changes are
+    #  ever copied. Nothing the fork does is written back to the file.
+    def fork(self):
+        self.mem.flush()
+        field = MappedField.__new__(MappedField)
+        field.filename = self.filename
+        field.width = self.width
+        field.height = self.height
+        field.stride = self.stride
+        field.file = open(self.filename, "rb")
+        field.mem = mmap.mmap(field.file.fileno(), len(self.mem), access=mmap.ACCESS_COPY)
+        return field
 
+    def flush(self):
+        self.mem.flush()
 
-        
-    elif console_cmd == "q":
-        quit = 1
-    elif cmd == '"':
-        name = console_cmd
-        proglist = []
-        xxx = func_read_prog(console_cmd)
-        if len(proglist) > 0:
-            program_counter = 0
+    def close(self):
+        self.mem.flush()
+        self.mem.close()
+        self.file.close()
+
+############################################################################
+#
+#  SparseField is the data field "extending infinitely in all directions".
+#  The pointer can go anywhere (including negative x and y) and is never
+#  out of range.
+#
+#  The field is cut into 16 x 16 chunks, kept in a dictionary by chunk
+#  position (x >> 4, y >> 4). Each chunk is a list of 16 row ints, like a
+#  little Field. A chunk is only made when one of its bits is first set
+#  to "1", and it is thrown away again when its last "1" is cleared, so
+#  the memory used follows the "1"s, not how far apart they are.
+#
+#  A fork shares every chunk with the field it came from. "owned" holds
+#  the positions of the chunks a field has made or copied itself, which
+#  are the only ones it changes in place; any other chunk is copied the
+#  first time it is written to.
+#
+
+class SparseField:
+
+    dense = False
+    bounded = False
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.chunks = {}
+        self.owned = set()
+
+    #  The chunk at key, made or copied so it can be changed in place.
+    def own(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = [0] * 16
+            self.chunks[key] = chunk
+            self.owned.add(key)
+        elif key not in self.owned:
+            chunk = list(chunk)
+            self.chunks[key] = chunk
+            self.owned.add(key)
+        return chunk
+
+    def test(self, x, y):
+        chunk = self.chunks.get((x >> 4, y >> 4))
+        if chunk is None:
+            return 0
+        return (chunk[y & 15] >> (x & 15)) & 1
+
+    def set(self, x, y):
+        self.own((x >> 4, y >> 4))[y & 15] |= 1 << (x & 15)
+
+    def clear(self, x, y):
+        key = (x >> 4, y >> 4)
+        if key in self.chunks:
+            chunk = self.own(key)
+            chunk[y & 15] &= ~(1 << (x & 15))
+            if not any(chunk):
+                del self.chunks[key]
+                self.owned.discard(key)
+
+    def put(self, x, y, bit):
+        if bit:
+            self.set(x, y)
         else:
-            program_counter = -1
+            self.clear(x, y)
 
-        if xxx == 0:
-            exception = "ok"
+    def flip(self, x, y):
+        if self.test(x, y):
+            self.clear(x, y)
         else:
-            exception = "problem loading program"
-            name = ""
+            self.set(x, y)
+
+    def row_bits(self, y, x0=0, count=16):
+        return "".join("1" if self.test(x, y) else "0" for x in range(x0, x0 + count))
+
+    def set_row_bits(self, y, bits, x0=0):
+        i = 0
+        while i < len(bits):
+            self.put(x0 + i, y, bits[i] == "1")
+            i += 1
+
+    def set_bits(self):
+        for (cx, cy), chunk in list(self.chunks.items()):
+            row_y = 0
+            while row_y < 16:
+                row = chunk[row_y]
+                x = 0
+                while row:
+                    if row & 1:
+                        yield ((cx << 4) + x, (cy << 4) + row_y)
+                    row >>= 1
+                    x += 1
+                row_y += 1
+
+    def copy_bits(self):
+        return dict((key, tuple(chunk)) for key, chunk in self.chunks.items())
+
+    def restore_bits(self, bits):
+        self.chunks = dict((key, list(chunk)) for key, chunk in bits.items())
+        self.owned = set(self.chunks)
 
+    #  Only the dictionary is copied: from now on neither side owns any
+    #  chunk, so each copies a chunk before its first change to it.
+    def fork(self):
+        field = SparseField()
+        field.chunks = dict(self.chunks)
+        self.owned = set()
+        return field
+
+    def close(self):
+        pass
+
+    #  The smallest box holding every "1": (x0, y0, x1, y1), bottom left
+    #  and top right, or None if the field is all "0"s.
+    def bounding_box(self):
+        box = None
+        for x, y in self.set_bits():
+            if box is None:
+                box = [x, y, x, y]
+            else:
+                box = [min(box[0], x), min(box[1], y), max(box[2], x), max(box[3], y)]
+        if box is None:
+            return None
+        return tuple(box)
+
+############################################################################
+#
+#  Snapshots
+#
+#  Machine.snapshot() packs up everything a run depends on (the program
+#  counter, pointer, flag and field) as bytes, and Machine.restore()
+#  puts it all back, so a run can be picked up again from that point
+#  instead of from the start:
+#
+#      bytes 0-3    "OB1S"
+#      bytes 4-5    version (1)
+#      byte  6      the flag
+#      byte  7      1 if the field has edges, 0 if not
+#      bytes 8-39   SHA-256 of the program (func_program_hash)
+#      bytes 40-47  program counter
+#      bytes 48-63  memx, memy
+#      bytes 64-79  x, y of the bottom left of the field (0, 0 unless
+#                   the field has no edges, then it is the box holding
+#                   all its "1"s)
+#      bytes 80-95  width, height of the field (or of that box)
+#      bytes 96...  the field, compressed with zlib: rows from the bottom
+#                   up, laid out like a MappedField file
+#
+#  All numbers are little-endian and signed. A snapshot can only be put
+#  back into a machine with the same program loaded, and a field with
+#  edges only into one the same size.
+#
+#  Machine.fork() is quicker still: a second machine, with the same
+#  program, at the same point, with a field of its own (see fork() on
+#  each kind of field), so "what if this bit were 1" can be tried from
+#  deep in a long run without running it all again.
+#
+
+_snapshot_header = struct.Struct("<4sHBB32sqqqqqqq")
+_snapshot_version = 1
+
+#  Returns (x0, y0, width, height, bits), bits packed as described above.
+def func_pack_field(field):
+    if field.dense:
+        stride = (field.width + 7) >> 3
+        return (0, 0, field.width, field.height,
+                b"".join(row.to_bytes(stride, "little") for row in field.rows))
+    if field.bounded:
+        return (0, 0, field.width, field.height, bytes(field.mem))
+
+    box = field.bounding_box()
+    if box is None:
+        return (0, 0, 0, 0, b"")
+    x0, y0, x1, y1 = box
+    width = x1 - x0 + 1
+    rows = [0] * (y1 - y0 + 1)
+    for x, y in field.set_bits():
+        rows[y - y0] |= 1 << (x - x0)
+    stride = (width + 7) >> 3
+    return (x0, y0, width, len(rows), b"".join(row.to_bytes(stride, "little") for row in rows))
+
+#  The other way round. Raises ValueError if the bits won't go in field.
+def func_unpack_field(field, x0, y0, width, height, bits):
+    stride = (width + 7) >> 3
+    if len(bits) != stride * height:
+        raise ValueError("the field in the snapshot is damaged")
+    if field.bounded and (width, height) != (field.width, field.height):
+        raise ValueError("the snapshot is of a %d x %d field, not %d x %d" % (
+                         width, height, field.width, field.height))
+    if field.dense:
+        field.rows[:] = [int.from_bytes(bits[y * stride : (y + 1) * stride], "little")
+                         for y in range(height)]
+    elif field.bounded:
+        field.mem[:] = bits
     else:
-        print("?????")
+        field.chunks.clear()
+        y = 0
+        while y < height:
+            row = int.from_bytes(bits[y * stride : (y + 1) * stride], "little")
+            x = 0
+            while row:
+                if row & 1:
+                    field.set(x0 + x, y0 + y)
+                row >>= 1
+                x += 1
+            y += 1
+
+#  The console text for 16 cells of row y, starting at column x0. Cells
+#  off the edge of a small field are left blank.
+def func_field_view(field, y, str_0="0", str_1="1", x0=0):
+    count = 16
+    if field.bounded:
+        if y < 0 or y >= field.height:
+            return " " * 48
+        count = min(16, field.width - x0)
+    bits = field.row_bits(y, x0, count)
+    this_str = "".join(" " + (str_1 if bit == "1" else str_0) + " " for bit in bits)
+    return this_str + "   " * (16 - count)
+
+#  Moves the start of a 16 cell window (view) just far enough that pos is
+#  inside it. On a field with edges the window stays on the field.
+def func_follow(view, pos, size):
+    if pos < view:
+        view = pos
+    elif pos > view + 15:
+        view = pos - 15
+    if size is not None:
+        view = max(0, min(view, size - 16))
+    return view
+
+
+
+############################################################################
+###                                                                      ###
+###                             COMPILER                                 ###
+###                                                                      ###
+############################################################################
+#
+#  Instead of interpreting the program one instruction at a time, a
+#  program can be turned into Python source and compiled, once, with
+#  compile(). Use  m.run(backend="compiled")  to run that way.
+#
+#  The program is cut into basic blocks. A block starts at pc 0, at every
+#  "tag," something jumps to, after every "adv,", "ret,", "x" and "sk",
+#  and at every place an "sk" can skip to. Inside a block the instructions
+#  are straight-line Python. In a program with only a few blocks, a
+#  "while" loop picks the next one with a binary search over the block
+#  starting points; otherwise each block is a function, and the loop
+#  calls the one for the program counter from a table of them. A block
+#  that always goes on to the same next block (it ends in an "adv,",
+#  say) runs on into that block's code, so a string of short blocks is
+#  picked only once.
+#
+#  A block only runs if the whole block fits in what is left of the step
+#  budget, so the generated code stops on exactly the same step as the
+#  interpreter would. Whatever is left over (and getting from the middle
+#  of a block to the start of the next one) is done by the interpreter.
+#
+#  Compiled programs are kept in _compiled_programs, keyed by
+#  func_program_hash, so loading the same program again is free. Only
+#  the _compiled_keep most recently used are kept, so a long-lived
+#  process (the server, a batch worker) that sees many programs doesn't
+#  keep them all.
+#
+
+_compiled_programs = collections.OrderedDict()
+_compiled_keep = 64
+
+#  The most instructions a block's source runs on into the blocks after
+#  it (see func_compile_chain).
+_compiled_chain = 16
+
+#  Programs with more blocks than this dispatch through a table of
+#  functions (see func_compile_source).
+_compiled_table_min = 16
+
+def func_program_hash(proglist):
+    try:
+        data = bytes(proglist)
+    except (ValueError, TypeError):
+        data = repr(list(proglist)).encode()
+    return hashlib.sha256(data).hexdigest()
+
+#  Where blocks start (always including len(code), the end of the tape).
+def func_block_leaders(code):
+    proglist_length = len(code)
+    leaders = set([0, proglist_length])
+    pc = 0
+    while pc < proglist_length:
+        cond, op, arg = code[pc]
+        if op == 16:
+            leaders.add(pc + 1)
+            if arg >= 0:
+                leaders.add(arg)
+        elif op == 5:
+            leaders.add(pc + 1)
+        elif op == 6:
+            leaders.add(pc + 1)
+            leaders.add(pc + 2)
+        pc += 1
+    return sorted(leader for leader in leaders if leader <= proglist_length)
+
+_compiled_conditions = [
+    None,
+    "not (rows[memy] >> memx) & 1",     # ifd0
+    "(rows[memy] >> memx) & 1",         # ifd1
+    "not flag",                         # iff0
+    "flag",                             # iff1
+]
+
+_compiled_moves = {
+    0: ("memx == right_edge", "memx += 1"),   # r
+    1: ("memx == 0", "memx -= 1"),            # l
+    2: ("memy == top_edge", "memy += 1"),     # u
+    3: ("memy == 0", "memy -= 1"),            # d
+}
+
+_compiled_ops = {
+    4: ["memx = 0", "memy = 0"],                                    # h
+    7: ["data_bit = (rows[memy] >> memx) & 1",                      # ex
+        "if data_bit != flag:",
+        "    rows[memy] ^= 1 << memx",
+        "flag = data_bit"],
+    8: ["if flag:",                                                 # df
+        "    rows[memy] |= 1 << memx",
+        "else:",
+        "    rows[memy] &= ~(1 << memx)"],
+    9: ["rows[memy] ^= 1 << memx"],                                 # dc
+    10: ["rows[memy] &= ~(1 << memx)"],                             # d0
+    11: ["rows[memy] |= 1 << memx"],                                # d1
+    12: ["flag = (rows[memy] >> memx) & 1"],                        # fd
+    13: ["flag = 1 - flag"],                                        # fc
+    14: ["flag = 0"],                                               # f0
+    15: ["flag = 1"],                                               # f1
+    17: [],                                                         # tag
+}
+
+#  The lines that leave a block for pc, with steps as counted so far
+#  plus done. Going on (exception None) past the end of the tape ends
+#  the program. Anything else returns from the function the block is
+#  in, which (see func_compile_source) is the same as returning from
+#  ob1_program, except going on to the next block inside its loop.
+def func_compile_leave(code, pc, exception, done=0, loop=False):
+    if done:
+        steps = "steps + %d" % done
+    else:
+        steps = "steps"
+    if exception == "None" and pc >= len(code):
+        exception = '"Program terminated normally"'
+    if exception == "None" and loop:
+        return ["pc = %d" % pc, "continue"]
+    return ["return %d, memx, memy, flag, %s, %s" % (pc, steps, exception)]
+
+#  Python source for the block of instructions first .. last, and the pc
+#  it always goes on to (None when that depends on the run). When there
+#  is such a pc the source just stops, for the caller to go on from.
+def func_compile_block(code, first, last, loop):
+    proglist_length = len(code)
+    size = last - first + 1
+
+    if first >= proglist_length:
+        return (func_compile_leave(code, first, '"Program terminated normally"'), None)
+
+    lines = ["if steps + %d > limit:" % size]
+    lines.extend("    " + line for line in func_compile_leave(code, first, '"step limit"'))
+    pc = first
+    while pc <= last:
+        cond, op, arg = code[pc]
+        done = pc - first + 1
+        if cond:
+            test = _compiled_conditions[cond]
+        else:
+            test = None
+
+        if op == 16:                     #### adv/ret (always ends a block)
+            if arg < 0:
+                lines.extend(func_compile_leave(code, pc, '"tag not found"', done))
+                return (lines, None)
+            lines.append("steps += %d" % done)
+            return (lines, arg)
+
+        if op == 6 and pc == last:       #### sk (ends a block)
+            lines.append("steps += %d" % done)
+            if test is None:
+                return (lines, pc + 2)
+            lines.append("if %s:" % test)
+            lines.extend("    " + line for line in func_compile_leave(code, pc + 2, "None", loop=loop))
+            lines.extend(func_compile_leave(code, pc + 1, "None", loop=loop))
+            return (lines, None)
+
+        if op == 5:                      #### x
+            if pc + 1 >= proglist_length:
+                halt = "Program terminated normally"
+            else:
+                halt = "halt"
+            body = func_compile_leave(code, pc + 1, '"%s"' % halt, done)
+        elif op in _compiled_moves:
+            edge, move = _compiled_moves[op]
+            body = ["if %s:" % edge]
+            body.extend("    " + line for line in func_compile_leave(code, pc, '"data pointer out of range"', done))
+            body.append(move)
+        else:
+            body = _compiled_ops[op]
+
+        if test is None:
+            lines.extend(body)
+        elif body:
+            lines.append("if %s:" % test)
+            lines.extend("    " + line for line in body)
+        pc += 1
+
+    lines.append("steps += %d" % size)
+    return (lines, last + 1)
+
+#  The source for the block starting at first. Where a block always goes
+#  on to another, that block's source follows on straight after it (up
+#  to _compiled_chain instructions in all, and never the same block
+#  twice), so a string of short blocks joined by "adv,"/"ret," is
+#  dispatched to once, not once a block.
+def func_compile_chain(code, lasts, first, loop):
+    lines = []
+    seen = set()
+    size = 0
+    pc = first
+    while True:
+        block, next_pc = func_compile_block(code, pc, lasts[pc], loop)
+        lines.extend(block)
+        seen.add(pc)
+        size += lasts[pc] - pc + 1
+        if next_pc is None:
+            return lines
+        if (next_pc in seen or next_pc >= len(code)
+                or size + lasts[next_pc] - next_pc + 1 > _compiled_chain):
+            lines.extend(func_compile_leave(code, next_pc, "None", loop=loop))
+            return lines
+        pc = next_pc
+
+#  Binary search over the block starting points, leaders[low:high].
+def func_compile_dispatch(code, leaders, lasts, low, high, indent):
+    if high - low == 1:
+        return [indent + line for line in func_compile_chain(code, lasts, leaders[low], True)]
+    middle = (low + high) // 2
+    lines = [indent + "if pc < %d:" % leaders[middle]]
+    lines.extend(func_compile_dispatch(code, leaders, lasts, low, middle, indent + "    "))
+    lines.append(indent + "else:")
+    lines.extend(func_compile_dispatch(code, leaders, lasts, middle, high, indent + "    "))
+    return lines
+
+#  A program with only a few blocks is one function: a "while" loop that
+#  finds the block for pc with a binary search over where they start,
+#  which is quicker than a call while the search is short. Otherwise
+#  every block is a function of its own, and ob1_program calls the one
+#  for pc from the table "blocks".
+def func_compile_source(code):
+    leaders = func_block_leaders(code)
+    lasts = {}
+    i = 0
+    while i < len(leaders):
+        if i + 1 < len(leaders):
+            lasts[leaders[i]] = leaders[i + 1] - 1
+        else:
+            lasts[leaders[i]] = leaders[i]
+        i += 1
+
+    head = "def ob1_program(rows, memx, memy, flag, pc, limit, right_edge, top_edge):"
+    if len(leaders) <= _compiled_table_min:
+        lines = [head, "    steps = 0", "    while True:"]
+        lines.extend(func_compile_dispatch(code, leaders, lasts, 0, len(leaders), "        "))
+        return "\n".join(lines) + "\n"
+
+    lines = []
+    for first in leaders:
+        lines.append("def block_%d(rows, memx, memy, flag, steps, limit, right_edge, top_edge):" % first)
+        lines.extend("    " + line for line in func_compile_chain(code, lasts, first, False))
+    lines.append("blocks = [None] * %d" % (len(code) + 1))
+    for first in leaders:
+        lines.append("blocks[%d] = block_%d" % (first, first))
+    lines.extend([head,
+                  "    steps = 0",
+                  "    exception = None",
+                  "    while exception is None:",
+                  "        pc, memx, memy, flag, steps, exception = blocks[pc](rows, memx, memy, flag, steps, limit,",
+                  "                                                            right_edge, top_edge)",
+                  "    return pc, memx, memy, flag, steps, exception"])
+    return "\n".join(lines) + "\n"
+
+#  Returns (function, set of block starting points) for a decoded program.
+def func_compile_prog(proglist, code):
+    key = func_program_hash(proglist)
+    if key in _compiled_programs:
+        _compiled_programs.move_to_end(key)
+    else:
+        namespace = {}
+        exec(compile(func_compile_source(code), "<ob1 " + key[:12] + ">", "exec"), namespace)
+        _compiled_programs[key] = (namespace["ob1_program"], set(func_block_leaders(code)))
+        while len(_compiled_programs) > _compiled_keep:
+            _compiled_programs.popitem(last=False)
+    return _compiled_programs[key]
+
+
+
+############################################################################
+###                                                                      ###
+###                          LOOP DETECTION                              ###
+###                                                                      ###
+############################################################################
+#
+#  Everything the machine does depends only on the program counter, the
+#  pointer, the flag and the bits in the data field. So if a run ever
+#  gets back to a state it has been in before, it will go round that loop
+#  forever.
+#
+#  LoopDetector watches a run (see Machine.execute_watched) and keeps a
+#  Zobrist hash of the state: every cell, pointer position, pc and the
+#  flag has its own random 64-bit key, and the hash is the XOR of the keys
+#  that apply. A bit flip XORs one key in or out, so the hash never has
+#  to be worked out from the whole field: the field the run started with
+#  counts as 0, and only the cells changed since are in the hash.
+#
+#  To keep memory small it uses Brent's method: the state is saved at
+#  steps 1, 2, 4, 8, ... and every later state is compared against the
+#  last saved one. A loop is reported at most about twice its length
+#  after the run first enters it. Matching hashes are confirmed against
+#  the saved copy of the state, so a hash collision can't give a false
+#  alarm.
+#
+
+#  A fixed, well-mixed 64-bit key for any number (SplitMix64).
+def func_zobrist_key(number):
+    z = (number * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return z ^ (z >> 31)
+
+def func_cell_key(x, y):
+    return func_zobrist_key((y << 32) ^ x)
+
+class LoopDetector:
+
+    def __init__(self):
+        self.started = False
+
+    def start(self, m, pc):
+        if self.started:
+            return
+        self.started = True
+        self.field = m.field
+        self.pc_keys = [func_zobrist_key(0x100000000 + i) for i in range(len(m.code) + 2)]
+        self.x_keys = {}
+        self.y_keys = {}
+        self.flag_key = func_zobrist_key(0x400000000)
+        self.cell_keys = {}
+
+        #  The hash of the field the run started with is the same in
+        #  every state, so it is left out: field_hash is only the cells
+        #  that have changed since, and the field never has to be read.
+        self.field_hash = 0
+
+        self.steps = 0
+        self.power = 1
+        self.lam = 0
+        self.saved_hash = None
+        self.saved_state = None
+
+    def x_key(self, x):
+        key = self.x_keys.get(x)
+        if key is None:
+            key = func_zobrist_key(0x200000000 + x)
+            self.x_keys[x] = key
+        return key
+
+    def y_key(self, y):
+        key = self.y_keys.get(y)
+        if key is None:
+            key = func_zobrist_key(0x300000000 + y)
+            self.y_keys[y] = key
+        return key
+
+    def cell_key(self, x, y):
+        key = self.cell_keys.get((x, y))
+        if key is None:
+            key = func_cell_key(x, y)
+            self.cell_keys[(x, y)] = key
+        return key
+
+    def after_step(self, pc, taken, next_pc, memx, memy, flag, flipped):
+        self.steps += 1
+        if flipped:
+            self.field_hash ^= self.cell_key(memx, memy)
+        if next_pc >= len(self.pc_keys):
+            return None
+
+        state_hash = self.field_hash ^ self.pc_keys[next_pc] ^ self.x_key(memx) ^ self.y_key(memy)
+        if flag:
+            state_hash ^= self.flag_key
+
+        if state_hash == self.saved_hash:
+            if self.saved_state == (next_pc, memx, memy, flag, self.field.copy_bits()):
+                return "infinite loop detected at pc %d after %d steps" % (next_pc, self.steps)
+
+        self.lam += 1
+        if self.lam == self.power:
+            self.saved_hash = state_hash
+            self.saved_state = (next_pc, memx, memy, flag, self.field.copy_bits())
+            self.power *= 2
+            self.lam = 0
+        return None
+
+
+
+############################################################################
+###                                                                      ###
+###                             OPTIMIZER                                ###
+###                                                                      ###
+############################################################################
+#
+#  Tapes are full of runs that can be done in one go: "exec,r" ten times
+#  over, "exec,f0" right after "exec,f0", "exec,fc" twice (which does
+#  nothing at all), "tag," markers that are only in the way. func_optimize
+#  finds runs like these and gives the run loop a "superinstruction" for
+#  each, which does the whole run in one step of the loop:
+#
+#      18 - n moves the same way, argument (n, 0 thru 3 = r l u d, 0)
+#      19 - n tags and flag instructions (fc, f0, f1), argument (n, a, x):
+#           the flag ends up (flag & a) ^ x
+#      20 - n tags and data instructions (dc, d0, d1), argument (n, a, x):
+#           the data bit ends up (bit & a) ^ x
+#
+#  Only "exec," (and "tag,") instructions go into a run, never an "if"
+#  one, and nothing is taken out of the program: the optimized code has
+#  the same instructions at the same program counters, just with the
+#  first of a run replaced by the superinstruction for the rest of it
+#  (and the second by the one for the rest of it from there, and so on).
+#  So an "adv,"/"ret," or an "sk" that lands in the middle of a run, or a
+#  "tag," that is jumped to, still finds the instructions it expects, and
+#  the listing and the program counter mean what they always did.
+#
+#  A run still counts as n steps. A run of moves that hits the edge stops
+#  on the move that hit it, with the same step count as one move at a
+#  time would give. When a step limit would end a run part way through,
+#  the run loop goes back to the ordinary instructions (Machine.execute).
+#
+#  Two kinds of loop are also done in one step of the run loop. The scan
+#  loop from the top of this listing,
+#
+#      tag,0     ifd0,sk     adv,1     exec,r     ret,0
+#
+#  (with ifd0 or ifd1, any move, and whatever tag ids, so long as the
+#  "ret," or "adv," at the end goes back to the "tag," at the start)
+#  becomes
+#
+#      21 - scan, argument (0 thru 3 = r l u d, the bit scanned over,
+#           where the "adv,"/"ret," in the middle goes)
+#
+#  and finds the first cell that doesn't hold that bit with a shift and
+#  a mask on the row (or by going up or down the column). The fill loop
+#
+#      tag,0     exec,df     exec,r     ret,0
+#
+#  (df, d0 or d1, any move), which writes every cell up to the edge of
+#  the field and stops with "data pointer out of range" there, becomes
+#
+#      22 - fill, argument (0 thru 3 = r l u d, 0 = d0 1 = d1 2 = df, 0)
+#
+#  and writes the whole row (or column) in one go. Either way the steps
+#  are counted as if the loop had gone round one instruction at a time.
+#
+
+_optimize_flag_effects = {13: (1, 1), 14: (0, 0), 15: (0, 1)}       # fc f0 f1
+_optimize_data_effects = {9: (1, 1), 10: (0, 0), 11: (0, 1)}        # dc d0 d1
+
+#  Returns (optimized code, list of what was changed, as text).
+def func_optimize(proglist, code):
+    proglist_length = len(code)
+    runs = [None] * (proglist_length + 1)
+    pc = proglist_length - 1
+    while pc >= 0:
+        cond, op, arg = code[pc]
+        after = runs[pc + 1]
+        run = None
+        if cond != 0:
+            pass
+        elif op <= 3:                            # r l u d
+            if after is not None and after[0] == 18 and after[2] == op:
+                run = (18, after[1] + 1, op, 0)
+            else:
+                run = (18, 1, op, 0)
+        elif op == 17:                           # tag
+            if after is not None and after[0] != 18:
+                run = (after[0], after[1] + 1, after[2], after[3])
+            else:
+                run = (19, 1, 1, 0)
+        else:
+            for action, effects in ((19, _optimize_flag_effects), (20, _optimize_data_effects)):
+                if op in effects:
+                    a, x = effects[op]
+                    if after is not None and after[0] == action:
+                        run = (action, after[1] + 1, a & after[2], (x & after[2]) ^ after[3])
+                    else:
+                        run = (action, 1, a, x)
+        runs[pc] = run
+        pc -= 1
+
+    targets = set(arg for cond, op, arg in code if op == 16 and arg >= 0)
+    fast_code = list(code)
+    changes = []
+    pc = 0
+    while pc < proglist_length:
+        run = runs[pc]
+        if run is None or run[1] < 2:
+            pc += 1
+            continue
+        action, n, p, q = run
+        fast_code[pc] = (0, action, (n, p, q))
+
+        #  Only report a run where it starts.
+        before = runs[pc - 1] if pc > 0 else None
+        if before is None or before[0] != action or before[1] != n + 1 or (action == 18 and before[2] != p):
+            lost_tags = 0
+            i = pc
+            while i < pc + n:
+                if code[i][1] == 17 and i not in targets:
+                    lost_tags += 1
+                i += 1
+            if action == 18:
+                this_str = "%d x %s done as one move" % (n, func_format_progline(proglist, pc))
+            elif action == 19 and p == 1 and q == 0 and lost_tags == n:
+                this_str = "%d tags nobody jumps to skipped in one step" % n
+            else:
+                if action == 19:
+                    what = "flag"
+                else:
+                    what = "data bit"
+                if p == 1 and q == 0:
+                    effect = "no effect"
+                elif p == 1:
+                    effect = "flips the " + what
+                else:
+                    effect = "sets the %s to %d" % (what, q)
+                this_str = "%d instructions done in one step (%s)" % (n, effect)
+                if lost_tags:
+                    this_str = this_str + ", %d of them tags nobody jumps to" % lost_tags
+            changes.append("pc %d-%d: %s" % (pc, pc + n - 1, this_str))
+        pc += 1
+
+    directions = ["right", "left", "up", "down"]
+    pc = 0
+    while pc + 3 < proglist_length:
+        if code[pc][1] != 17:
+            pass
+        elif (pc + 4 < proglist_length
+                and code[pc + 1][0] in (1, 2) and code[pc + 1][1] == 6
+                and code[pc + 2][1] == 16
+                and code[pc + 3][0] == 0 and code[pc + 3][1] <= 3
+                and code[pc + 4][1] == 16 and code[pc + 4][2] == pc):
+            bit = code[pc + 1][0] - 1
+            direction = code[pc + 3][1]
+            fast_code[pc] = (0, 21, (direction, bit, code[pc + 2][2]))
+            changes.append("pc %d-%d: scan %s over %d bits done in one step" %
+                           (pc, pc + 4, directions[direction], bit))
+        elif (code[pc + 1][0] == 0 and code[pc + 1][1] in (8, 10, 11)
+                and code[pc + 2][0] == 0 and code[pc + 2][1] <= 3
+                and code[pc + 3][1] == 16 and code[pc + 3][2] == pc):
+            value = {10: 0, 11: 1, 8: 2}[code[pc + 1][1]]
+            direction = code[pc + 2][1]
+            fast_code[pc] = (0, 22, (direction, value, 0))
+            changes.append("pc %d-%d: fill %s to the edge with %s done in one step" %
+                           (pc, pc + 3, directions[direction], ["0", "1", "the flag"][value]))
+        pc += 1
+    return (fast_code, changes)
+
+
+############################################################################
+###                                                                      ###
+###                             PROFILER                                 ###
+###                                                                      ###
+############################################################################
+#
+#  A Profiler watches runs (see Machine.execute_watched) and counts
+#  where they spend their time:
+#
+#      counts[pc]    - how many times each instruction was executed
+#      taken[pc]     - how many of those times its condition held (for
+#                      ifd0, ifd1, iff0 and iff1; the rest are always
+#                      taken)
+#      distance[pc]  - how far, in instructions, each "adv,"/"ret," has
+#                      moved the program counter altogether
+#      region_steps, region_time - steps and seconds spent in each
+#                      region of the program: a region runs from a "tag,"
+#                      up to the next one (region -1 is everything before
+#                      the first tag)
+#
+#  Counts add up over any number of runs of the same program.
+#
+#      p = mjh_ob1.Profiler()
+#      m.run(watchers=[p])
+#      print(p.report())
+#      p.write_collapsed("scan.folded")
+#
+#  The collapsed stack file has a line "program;region;instruction count"
+#  for every instruction executed, which flame graph tools (flamegraph.pl,
+#  speedscope, ...) read directly.
+#
+#  Watching every step makes runs several times slower, so the profiler
+#  is only there when it is asked for. Runs without it don't change at
+#  all.
+#
+
+class Profiler:
+
+    def __init__(self):
+        self.code = None
+
+    def start(self, m, pc):
+        if self.code is m.code:
+            self.clock = time.perf_counter()
+            return
+        self.code = m.code
+        self.proglist = m.proglist
+        self.name = m.name or "program"
+        proglist_length = len(m.code)
+        self.counts = [0] * proglist_length
+        self.taken = [0] * proglist_length
+        self.distance = [0] * proglist_length
+
+        #  region[pc] is the pc of the "tag," that starts its region.
+        self.region = [-1] * proglist_length
+        region = -1
+        i = 0
+        while i < proglist_length:
+            if m.code[i][1] == 17:
+                region = i
+            self.region[i] = region
+            i += 1
+        self.region_steps = collections.defaultdict(int)
+        self.region_time = collections.defaultdict(float)
+        self.clock = time.perf_counter()
+
+    def after_step(self, pc, taken, next_pc, memx, memy, flag, flipped):
+        self.counts[pc] += 1
+        if taken:
+            self.taken[pc] += 1
+            if self.code[pc][1] == 16:
+                self.distance[pc] += abs(next_pc - pc)
+        now = time.perf_counter()
+        region = self.region[pc]
+        self.region_steps[region] += 1
+        self.region_time[region] += now - self.clock
+        self.clock = now
+        return None
+
+    def region_name(self, region):
+        if region < 0:
+            return "(start)"
+        return "%s@%d" % (func_format_progline(self.proglist, region), region)
+
+    #  The annotated listing (only the instructions that were executed,
+    #  unless everything=True), then the regions, busiest first.
+    def report(self, everything=False):
+        if self.code is None:
+            return "nothing profiled yet\n"
+        total = sum(self.counts) or 1
+        lines = ["    pc       count      %      taken  not taken    distance  instruction"]
+        pc = 0
+        while pc < len(self.counts):
+            count = self.counts[pc]
+            if count or everything:
+                cond, op, arg = self.code[pc]
+                if cond != 0:
+                    branches = "%10d %10d" % (self.taken[pc], count - self.taken[pc])
+                else:
+                    branches = " " * 21
+                if op == 16:
+                    distance = "%11d" % self.distance[pc]
+                else:
+                    distance = " " * 11
+                lines.append("%6d %11d %6.2f %s %s  %s" % (pc, count, 100.0 * count / total,
+                             branches, distance, func_format_progline(self.proglist, pc)))
+            pc += 1
+        lines.append("")
+        lines.append("region                    steps      %         seconds")
+        for region in sorted(self.region_steps, key=lambda r: -self.region_steps[r]):
+            steps = self.region_steps[region]
+            lines.append("%-20s %11d %6.2f %15.6f" % (self.region_name(region), steps,
+                         100.0 * steps / total, self.region_time[region]))
+        return "\n".join(lines) + "\n"
+
+    def write_collapsed(self, filename):
+        with open(filename, "w") as out_file:
+            pc = 0
+            while self.code is not None and pc < len(self.counts):
+                if self.counts[pc]:
+                    out_file.write("%s;%s;%s@%d %d\n" % (self.name.replace(";", "_").replace(" ", "_"),
+                                   self.region_name(self.region[pc]),
+                                   func_format_progline(self.proglist, pc), pc, self.counts[pc]))
+                pc += 1
+
+
+############################################################################
+###                                                                      ###
+###                               TRACE                                  ###
+###                                                                      ###
+############################################################################
+#
+#  A Trace watches runs (see Machine.execute_watched) and keeps the last
+#  size steps in a ring buffer, five bytes a step: the pc of each step
+#  (an array of ints) and what it changed (an array of bytes):
+#
+#      1 - the data bit under the pointer flipped
+#      2 - the flag changed
+#      4 - memx changed
+#      8 - memy changed
+#
+#  Every interval steps it also saves a checkpoint: the whole state (pc,
+#  pointer, flag, field) and the step number. Machine.step_back() goes
+#  back to an earlier step by putting back the last checkpoint before it
+#  and running forward from there. A checkpoint is also taken when a run
+#  or step starts somewhere other than where the last one stopped (the
+#  console may have moved the pointer or typed bits in), but not when
+#  nothing has changed, so single steps don't pile them up.
+#
+#  Only a dense field is kept whole in a checkpoint (it is a list of the
+#  row ints, which are shared with the field until a row changes). For
+#  the others (a mapped file can be gigabytes) the trace keeps where each
+#  flipped bit was instead, and stepping back flips them back. Changes
+#  made to such a field between runs (bits typed in at the console) are
+#  not undone. Checkpoints are also dropped oldest first once they take
+#  more than max_bytes.
+#
+#  Steps taken without the trace watching (a run without it, say) aren't
+#  in it: stepping back jumps straight over them.
+#
+#      t = mjh_ob1.Trace()
+#      m.run(watchers=[t])
+#      m.step_back(t, 10)
+#
+
+class Trace:
+
+    def __init__(self, size=1 << 20, interval=4096, max_bytes=1 << 26):
+        self.size = size
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.pcs = array.array("i", bytes(4 * size))
+        self.deltas = array.array("B", bytes(size))
+        self.code = None
+        self.steps = 0
+        self.checkpoints = collections.deque()
+        self.checkpoint_bytes = 0
+        self.flips = collections.deque()
+        self.field = None
+        self.next_pc = None
+        self.rows = None
+
+    def start(self, m, pc):
+        if self.code is not m.code or self.field is not m.field:
+            self.code = m.code
+            self.steps = 0
+            self.clear()
+        elif (self.checkpoints and pc == self.next_pc
+              and (m.memx, m.memy, m.flag) == (self.memx, self.memy, self.flag)
+              and (not m.field.dense or m.field.rows == self.rows)):
+            return
+        self.field = m.field
+        self.memx = m.memx
+        self.memy = m.memy
+        self.flag = m.flag
+        self.checkpoint(pc)
+
+    def clear(self):
+        self.checkpoints.clear()
+        self.checkpoint_bytes = 0
+        self.flips.clear()
+
+    #  Rough size of a checkpoint's field bits: a list entry for every
+    #  row, and the row ints themselves (which may be shared with the
+    #  field or other checkpoints, so this counts high).
+    def bits_bytes(self, bits):
+        if bits is None:
+            return 0
+        return 8 * len(bits) + len(bits) * ((self.field.width + 7) >> 3)
+
+    def checkpoint(self, pc):
+        self.drop_after(self.steps - 1)
+        bits = None
+        if self.field.dense:
+            bits = self.field.copy_bits()
+            self.rows = list(bits)
+        self.checkpoints.append((self.steps, pc, self.memx, self.memy, self.flag, bits))
+        self.checkpoint_bytes += self.bits_bytes(bits)
+        self.next_pc = pc
+        while len(self.checkpoints) > 1 and (self.checkpoints[1][0] <= self.steps - self.size
+                                             or self.checkpoint_bytes > self.max_bytes):
+            self.checkpoint_bytes -= self.bits_bytes(self.checkpoints.popleft()[5])
+        while self.flips and self.flips[0][0] < self.checkpoints[0][0]:
+            self.flips.popleft()
+
+    #  Throws away the checkpoints after step.
+    def drop_after(self, step):
+        while self.checkpoints and self.checkpoints[-1][0] > step:
+            self.checkpoint_bytes -= self.bits_bytes(self.checkpoints.pop()[5])
+
+    #  Puts field back as it was at checkpoint (the last one), and the
+    #  trace with it. Returns the checkpoint.
+    def rewind(self, field):
+        step, pc, memx, memy, flag, bits = self.checkpoints[-1]
+        if bits is None:
+            while self.flips and self.flips[-1][0] >= step:
+                flip_step, x, y = self.flips.pop()
+                field.flip(x, y)
+        else:
+            field.restore_bits(bits)
+            self.rows = list(bits)
+        self.field = field
+        self.steps = step
+        self.next_pc = pc
+        self.memx = memx
+        self.memy = memy
+        self.flag = flag
+        return self.checkpoints[-1]
+
+    def after_step(self, pc, taken, next_pc, memx, memy, flag, flipped):
+        i = self.steps % self.size
+        self.pcs[i] = pc
+        delta = 0
+        if flipped:
+            delta = 1
+            if self.field.dense:
+                self.rows[memy] ^= 1 << memx
+            else:
+                self.flips.append((self.steps, memx, memy))
+        if flag != self.flag:
+            delta |= 2
+            self.flag = flag
+        if memx != self.memx:
+            delta |= 4
+            self.memx = memx
+        if memy != self.memy:
+            delta |= 8
+            self.memy = memy
+        self.deltas[i] = delta
+        self.steps += 1
+        self.next_pc = next_pc
+        if self.steps - self.checkpoints[-1][0] >= self.interval:
+            self.checkpoint(next_pc)
+        return None
+
+    #  The earliest step that can be gone back to.
+    def first_step(self):
+        if not self.checkpoints:
+            return self.steps
+        return self.checkpoints[0][0]
+
+    #  The last count steps, oldest first, as (step number, pc, delta).
+    def last(self, count):
+        first = max(self.steps - count, self.steps - self.size, 0)
+        return [(step, self.pcs[step % self.size], self.deltas[step % self.size])
+                for step in range(first, self.steps)]
+
+
+############################################################################
+###                                                                      ###
+###                            BREAKPOINTS                               ###
+###                                                                      ###
+############################################################################
+#
+#  Breakpoints stops a run (see Machine.execute_watched) when:
+#
+#      "12"      - the program gets to pc 12 (it stops before running it)
+#      "tag3"    - the program gets to any "tag,3"
+#      "cell3,4" - the bit at x=3 y=4 changes
+#      "flag"    - the flag changes
+#      "row10"   - the pointer moves into row 10
+#      "col5"    - the pointer moves into column 5
+#
+#  The run stops with an exception naming what stopped it, such as
+#  "breakpoint at pc 12" or "watchpoint: flag changed to 1", which the
+#  console shows in the usual place.
+#
+#  Only runs that are given a Breakpoints (with something in it) are
+#  watched, so breakpoints don't slow anything else down.
+#
+
+class Breakpoints:
+
+    def __init__(self):
+        self.pcs = set()
+        self.tags = set()
+        self.cells = set()
+        self.flag = False
+        self.rows = set()
+        self.columns = set()
+
+    def __len__(self):
+        return (len(self.pcs) + len(self.tags) + len(self.cells) + int(self.flag)
+                + len(self.rows) + len(self.columns))
+
+    #  Sets the breakpoint or watchpoint spec (one of the above), or
+    #  takes it away if it is already set. Returns a message saying which.
+    #  Raises ValueError if spec doesn't make sense.
+    def toggle(self, spec):
+        spec = spec.strip().lower()
+        if spec == "flag":
+            self.flag = not self.flag
+            if self.flag:
+                return "watching the flag"
+            return "not watching the flag"
+
+        if spec.startswith("tag"):
+            which = self.tags
+            key = int(spec[3:])
+            if key < 0 or key > 15:
+                raise ValueError("tag ids go from 0 to 15")
+            name = "tag," + str(key)
+        elif spec.startswith("cell"):
+            which = self.cells
+            x, y = spec[4:].split(",")
+            key = (int(x), int(y))
+            name = "cell %d,%d" % key
+        elif spec.startswith("row"):
+            which = self.rows
+            key = int(spec[3:])
+            name = "row %d" % key
+        elif spec.startswith("col"):
+            which = self.columns
+            key = int(spec[3:])
+            name = "column %d" % key
+        else:
+            which = self.pcs
+            key = int(spec)
+            name = "pc %d" % key
+
+        if key in which:
+            which.remove(key)
+            return "no break at " + name
+        which.add(key)
+        return "break at " + name
+
+    def clear(self):
+        self.__init__()
+
+    def describe(self):
+        this_list = ["pc %d" % pc for pc in sorted(self.pcs)]
+        this_list += ["tag,%d" % tag for tag in sorted(self.tags)]
+        this_list += ["cell %d,%d" % cell for cell in sorted(self.cells)]
+        if self.flag:
+            this_list.append("flag")
+        this_list += ["row %d" % row for row in sorted(self.rows)]
+        this_list += ["column %d" % column for column in sorted(self.columns)]
+        return this_list
+
+    def start(self, m, pc):
+        self.field = m.field
+        self.tag_pcs = {}
+        i = 0
+        while i < len(m.code):
+            if m.code[i][1] == 17 and (m.proglist[i] & 15) in self.tags:
+                self.tag_pcs[i] = m.proglist[i] & 15
+            i += 1
+        self.last_memx = m.memx
+        self.last_memy = m.memy
+        self.last_flag = m.flag
+
+    def after_step(self, pc, taken, next_pc, memx, memy, flag, flipped):
+        stop = None
+        if flipped and (memx, memy) in self.cells:
+            stop = "watchpoint: cell %d,%d changed to %d" % (memx, memy, self.field.test(memx, memy))
+        elif self.flag and flag != self.last_flag:
+            stop = "watchpoint: flag changed to %d" % flag
+        elif memy != self.last_memy and memy in self.rows:
+            stop = "break: pointer moved into row %d" % memy
+        elif memx != self.last_memx and memx in self.columns:
+            stop = "break: pointer moved into column %d" % memx
+        elif next_pc in self.pcs:
+            stop = "breakpoint at pc %d" % next_pc
+        elif next_pc in self.tag_pcs:
+            stop = "breakpoint at tag,%d (pc %d)" % (self.tag_pcs[next_pc], next_pc)
+        self.last_memx = memx
+        self.last_memy = memy
+        self.last_flag = flag
+        return stop
+
+
+############################################################################
+###                                                                      ###
+###                         REMEMBERING RUNS                             ###
+###                                                                      ###
+############################################################################
+#
+#  A run can only depend on the cells of the field it reads before it
+#  writes them ("ifd0,"/"ifd1," and "fd", "ex", "dc") and on the flag if
+#  it reads that ("iff0,"/"iff1," and "df", "ex", "fc") before setting
+#  it. Every other cell just comes out the way it went in.
+#
+#  ReadSet watches a run and keeps those reads, in the order they
+#  happened, as (cell, bit) pairs (cell None is the flag), and the cells
+#  the run wrote (and whether it set the flag).
+#
+#  Memo.run(m) runs m the way m.run() does, but remembers each run in a
+#  decision tree: each node is a cell the run read there, with a branch
+#  for each bit, and each leaf is how the run ended (the pointer, flag,
+#  program counter, exception, steps and the final bits of every cell
+#  written, and of the flag if it was set). A later run from the same start (same program, program
+#  counter, pointer and max_steps) walks the tree on its own field, and
+#  if it gets to a leaf the machine is put straight into that end state
+#  without running anything. So a sweep over all 2^k settings of k input
+#  cells only runs as many times as there are different paths through
+#  the cells the program actually looks at.
+#
+#  The result is exactly what m.run() would have given, except for
+#  elapsed and ips. A time limit or loop detection would make a run
+#  depend on more than the field, so Memo has neither.
+#
+
+class ReadSet:
+
+    def start(self, m, pc):
+        self.code = m.code
+        self.test = m.field.test
+        self.memx = m.memx
+        self.memy = m.memy
+        self.flag = m.flag
+        self.reads = []
+        self.touched = set()
+        self.written = set()
+        self.flag_touched = False
+        self.flag_written = False
+
+    def after_step(self, pc, taken, next_pc, memx, memy, flag, flipped):
+        cond, op, arg = self.code[pc]
+        #  The condition is read first, then whatever the operation reads.
+        if cond == 1 or cond == 2:
+            self.read_cell(flipped)
+        elif cond == 3 or cond == 4:
+            self.read_flag()
+        if taken:
+            if op == 7 or op == 9 or op == 12:
+                self.read_cell(flipped)
+            if op == 7 or op == 8 or op == 13:
+                self.read_flag()
+            if 7 <= op <= 11:
+                self.touched.add((self.memx, self.memy))
+                self.written.add((self.memx, self.memy))
+            if op == 7 or 12 <= op <= 15:
+                self.flag_touched = True
+                self.flag_written = True
+        self.memx = memx
+        self.memy = memy
+        self.flag = flag
+        return None
+
+    #  The cell under the pointer (as it was before the step) was read.
+    def read_cell(self, flipped):
+        cell = (self.memx, self.memy)
+        if cell not in self.touched:
+            bit = self.test(self.memx, self.memy)
+            if flipped:
+                bit = 1 - bit
+            self.reads.append((cell, bit))
+            self.touched.add(cell)
+
+    def read_flag(self):
+        if not self.flag_touched:
+            self.reads.append((None, self.flag))
+            self.flag_touched = True
+
+class Memo:
+
+    def __init__(self):
+        self.roots = {}
+        self.code = None
+        self.digest = None
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, m, max_steps=None):
+        if m.start_check() != "ok":
+            return m.run(max_steps)
+        if m.code is not self.code:
+            self.code = m.code
+            self.digest = func_program_hash(m.proglist)
+        #  Where the edges are decides where a run goes out of range, so
+        #  runs on fields of another size (or without edges) are kept
+        #  apart.
+        key = (self.digest, m.program_counter, m.memx, m.memy, max_steps,
+               m.field.bounded, m.field.width, m.field.height)
+
+        start = time.perf_counter()
+        node = self.roots.get(key, [None])[0]
+        while isinstance(node, list):
+            cell = node[0]
+            if cell is None:
+                bit = m.flag
+            else:
+                bit = m.field.test(cell[0], cell[1])
+            node = node[1 + bit]
+
+        if node is None:
+            self.misses += 1
+            reader = ReadSet()
+            result = m.run(max_steps, watchers=[reader])
+            written = tuple((cell, m.field.test(cell[0], cell[1])) for cell in reader.written)
+            flag = None
+            if reader.flag_written:
+                flag = m.flag
+            leaf = (m.exception, m.steps, m.program_counter, m.memx, m.memy, flag, written)
+            branch = self.roots.setdefault(key, [None])
+            i = 0
+            for cell, bit in reader.reads:
+                if branch[i] is None:
+                    branch[i] = [cell, None, None]
+                branch = branch[i]
+                i = 1 + bit
+            branch[i] = leaf
+            return result
+
+        self.hits += 1
+        exception, steps, m.program_counter, m.memx, m.memy, flag, written = node
+        if flag is not None:
+            m.flag = flag
+        for cell, bit in written:
+            m.field.put(cell[0], cell[1], bit)
+        m.steps = steps
+        m.exception = exception
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            ips = steps / elapsed
+        else:
+            ips = 0.0
+        return RunResult(exception, steps, elapsed, ips)
+
+
+############################################################################
+###                                                                      ###
+###                             MACHINE                                  ###
+###                                                                      ###
+############################################################################
+#
+#  Machine.run() reports how a run went with a RunResult:
+#      reason   - the exception that stopped it ("halt", "time limit", ...)
+#      steps    - instructions executed
+#      elapsed  - seconds of wall-clock time
+#      ips      - instructions per second
+#
+
+RunResult = collections.namedtuple("RunResult", "reason steps elapsed ips")
+
+#  With a time limit, runs are done this many steps at a time and the
+#  clock is only looked at between chunks.
+_run_chunk = 65536
+
+#  Everything the one-bit computer knows about lives in a Machine:
+#  the loaded program, the program counter, the data field, the
+#  data-field pointer and the flag. Nothing here prints or waits for the
+#  keyboard, so a Machine can be used without the console.
+#
+#  "exception" always holds the reason the machine last stopped, the same
+#  strings the console shows under the data field ("ok", "halt", "step",
+#  "data pointer out of range", "tag not found", ...).
+#
+
+class Machine:
+
+    #  field is the kind of data field to use (a Field, the normal 16 x 16
+    #  one, unless you say otherwise).
+    def __init__(self, field=None):
+        self.proglist = []
+        self.jumps = []
+        self.code = []
+        self.fast_code = []
+        self.optimizations = []
+        self.missing_tags = []
+        self.listing = {}
+        self.program_counter = -1
+        if field is None:
+            field = Field()
+        self.field = field
+        self.memx = 0
+        self.memy = 0
+        self.flag = 0
+        self.exception = "ok"
+        self.steps = 0
+        self.name = ""
+        self.rules = []
+
+    #  "program" is either a filename (a text program, or a binary tape if
+    #  it ends in ".ob1b") or a list of instruction codes (128 thru 255).
+    #  Returns 0 for a good load, otherwise the error number from
+    #  func_read_prog (5 for a tape that can't be read).
+    #
+    #  An "adv,"/"ret," whose tag doesn't exist is listed in missing_tags
+    #  (and reported when verbose). It only stops the program with
+    #  "tag not found" if it is actually executed.
+    #
+    #  With optimize=True the program is also run through func_optimize
+    #  (see optimize()).
+    #
+    #  With rules (see "Rewrite rules" above) the program is rewritten
+    #  with them first.
+    def load(self, program, verbose=False, optimize=False):
+        self.proglist = []
+        linenos = []
+        jumps = None
+        if isinstance(program, str) and program.lower().endswith(".ob1b"):
+            self.name = program
+            try:
+                self.proglist, jumps = func_read_tape(program)
+                bad_error = 0
+            except (OSError, ValueError) as error:
+                if verbose:
+                    print(">>>", error)
+                bad_error = 5
+            linenos = range(1, len(self.proglist) + 1)
+            if verbose and bad_error == 0:
+                print(">>>", '"' + program + '"')
+                print(">>> Successful Program Load")
+        elif isinstance(program, str):
+            self.name = program
+            bad_error = func_read_prog(program, self.proglist, verbose, linenos)
+        else:
+            self.name = ""
+            self.proglist = list(program)
+            linenos = list(range(1, len(self.proglist) + 1))
+            bad_error = 0
+
+        if self.rules and bad_error == 0:
+            old_length = len(self.proglist)
+            self.proglist, linenos, count = func_apply_rules(self.proglist, linenos, self.rules)
+            jumps = None
+            if verbose and count > 0:
+                print(">>> Rewrote", count, "runs of instructions,",
+                      old_length - len(self.proglist), "instructions fewer")
+
+        if jumps is None:
+            jumps = func_tag_table(self.proglist)
+        self.jumps = jumps
+        self.code = func_decode_prog(self.proglist, self.jumps)
+        self.fast_code = self.code
+        self.optimizations = []
+        self.listing = {}
+        self.missing_tags = func_missing_tags(self.proglist, self.jumps)
+        if verbose:
+            for pc in self.missing_tags:
+                print(">>> Warning: line", linenos[pc], func_format_progline(self.proglist, pc),
+                      "has no tag," + str(self.proglist[pc] & 15), "to go to")
+        if optimize:
+            self.optimize()
+            if verbose:
+                for change in self.optimizations:
+                    print(">>> Optimized:", change)
+
+        if len(self.proglist) > 0:
+            self.program_counter = 0
+        else:
+            self.program_counter = -1
+
+        if bad_error == 0:
+            self.exception = "ok"
+        else:
+            self.exception = "problem loading program"
+            self.name = ""
+        return bad_error
+
+    #  Lets the run loop use superinstructions for runs of instructions
+    #  (see OPTIMIZER above). Results are exactly the same either way.
+    #  Returns the list of what was changed (also kept in optimizations).
+    def optimize(self):
+        self.fast_code, self.optimizations = func_optimize(self.proglist, self.code)
+        return self.optimizations
+
+    def unoptimize(self):
+        self.fast_code = self.code
+        self.optimizations = []
+
+    #  The listing line for pc (as func_format_progline gives it), worked
+    #  out once per load.
+    def format_line(self, pc):
+        line = self.listing.get(pc)
+        if line is None:
+            line = func_format_progline(self.proglist, pc)
+            self.listing[pc] = line
+        return line
+
+    def step(self, watchers=()):
+        if watchers:
+            return self.execute_watched("step", None, list(watchers))
+        return self.execute("step")
+
+    #  Goes back count steps of trace (a Trace that watched them), putting
+    #  back the machine exactly as it was then.
+    def step_back(self, trace, count=1):
+        if trace.code is not self.code or not trace.checkpoints:
+            self.exception = "no trace to step back through"
+            return self.exception
+        target = trace.steps - count
+        if target < trace.first_step():
+            target = trace.first_step()
+        trace.drop_after(target)
+        step, pc, memx, memy, flag, bits = trace.rewind(self.field)
+        self.program_counter = pc
+        self.memx = memx
+        self.memy = memy
+        self.flag = flag
+        #  (A run that stopped at an "x" went on with the next one.)
+        while trace.steps < target:
+            self.execute_watched("run", target - trace.steps, [trace])
+            if self.steps == 0:
+                break
+        trace.steps = target
+        self.steps = 0
+        self.exception = "back at step %d" % target
+        return self.exception
+
+    #  With max_steps the run also stops (exception "step limit") once
+    #  that many instructions have been executed; with time_limit it stops
+    #  (exception "time limit") after about that many seconds.
+    #
+    #  backend is "interp" (the run loop below) or "compiled" (see
+    #  COMPILER above). Both give exactly the same results.
+    #
+    #  With detect_loops the run stops as soon as a LoopDetector can tell
+    #  that it will never end (this always uses the watched run loop).
+    #
+    #  progress, if given, is called as progress(machine, steps) every so
+    #  often while the run goes on (for a live display, say).
+    #
+    #  watchers are more watchers for the watched run loop (a Profiler,
+    #  say); with any at all the run uses that loop.
+    #
+    #  Returns a RunResult.
+    def run(self, max_steps=None, time_limit=None, backend="interp", detect_loops=False,
+            progress=None, watchers=()):
+        watchers = list(watchers)
+        if detect_loops:
+            watchers.append(LoopDetector())
+
+        if watchers:
+            go = lambda chunk: self.execute_watched("run", chunk, watchers)
+        elif backend == "compiled":
+            go = self.run_compiled
+        else:
+            go = self.run_interpreted
+
+        start = time.perf_counter()
+        if time_limit is None and progress is None:
+            exception = go(max_steps)
+            steps = self.steps
+        else:
+            if time_limit is None:
+                deadline = None
+            else:
+                deadline = start + time_limit
+            steps = 0
+            while True:
+                chunk = _run_chunk
+                if max_steps is not None and max_steps - steps < chunk:
+                    chunk = max_steps - steps
+                exception = go(chunk)
+                steps += self.steps
+                if exception != "step limit":
+                    break
+                if max_steps is not None and steps >= max_steps:
+                    break
+                if deadline is not None and time.perf_counter() >= deadline:
+                    exception = "time limit"
+                    break
+                if progress is not None:
+                    progress(self, steps)
+        elapsed = time.perf_counter() - start
+
+        self.steps = steps
+        self.exception = exception
+        if elapsed > 0:
+            ips = steps / elapsed
+        else:
+            ips = 0.0
+        return RunResult(exception, steps, elapsed, ips)
+
+    def run_interpreted(self, max_steps=None):
+        return self.execute("run", max_steps)
+
+    def run_compiled(self, max_steps=None):
+        if self.start_check() != "ok" or not self.field.dense:
+            return self.execute("run", max_steps)
+
+        if max_steps is None:
+            limit = sys.maxsize
+        else:
+            limit = max_steps
+
+        ob1_program, leaders = func_compile_prog(self.proglist, self.code)
+        steps = 0
+        exception = "ok"
+
+        #  Get to the start of a block.
+        while self.program_counter not in leaders and steps < limit:
+            exception = self.execute("run", 1)
+            steps += self.steps
+            if exception != "step limit":
+                self.steps = steps
+                return exception
+
+        if steps < limit:
+            (self.program_counter, self.memx, self.memy, self.flag, done,
+             exception) = ob1_program(self.field.rows, self.memx, self.memy,
+                                      self.flag, self.program_counter, limit - steps,
+                                      self.field.width - 1, self.field.height - 1)
+            steps += done
+
+        #  The step budget ran out part way into a block.
+        if exception == "step limit" and steps < limit:
+            exception = self.execute("run", limit - steps)
+            steps += self.steps
+
+        self.steps = steps
+        self.exception = exception
+        return exception
+
+    #  "field" is a list of strings of "0"s and "1"s, top row first, the
+    #  way the console shows it.
+    #
+    #  A field without edges gives the smallest box holding all its "1"s,
+    #  and "field_origin" is the [x, y] of the bottom left of that box.
+    #
+    #  That is width x height characters, too many for a big field, so
+    #  with field="cells" there is "cells" instead: the [x, y] of every
+    #  "1" (which only costs as much as there are "1"s, and rows or blocks
+    #  of "0"s are skipped over). With field=None the field is left out.
+    def state(self, field="rows"):
+        state = {
+            "name": self.name,
+            "program_counter": self.program_counter,
+            "memx": self.memx,
+            "memy": self.memy,
+            "flag": self.flag,
+            "exception": self.exception,
+        }
+        if field == "cells":
+            state["cells"] = sorted([x, y] for x, y in self.field.set_bits())
+        elif field is None:
+            pass
+        elif self.field.bounded:
+            state["field"] = [self.field.row_bits(i) for i in range(self.field.height - 1, -1, -1)]
+        else:
+            box = self.field.bounding_box()
+            if box is None:
+                box = (0, 0, -1, -1)
+            x0, y0, x1, y1 = box
+            state["field"] = [self.field.row_bits(i, x0, x1 - x0 + 1) for i in range(y1, y0 - 1, -1)]
+            state["field_origin"] = [x0, y0]
+        return state
+
+    #  The other way round: takes a dictionary like the one state() gives
+    #  back. Anything left out stays as it is. Rows missing from "field"
+    #  (or bits missing from a row) are cleared; the pointer is kept on
+    #  the field.
+    #
+    #  On a field without edges the rows go at "field_origin" (default
+    #  [0, 0]) and the rest of the field is cleared.
+    def set_state(self, state):
+        if "field" in state:
+            field = state["field"]
+            if self.field.bounded:
+                i = 0
+                while i < self.field.height:
+                    if i < len(field):
+                        bits = field[i]
+                    else:
+                        bits = ""
+                    self.field.set_row_bits(self.field.height - 1 - i, bits.ljust(self.field.width, "0"))
+                    i += 1
+            else:
+                x0, y0 = state.get("field_origin", (0, 0))
+                self.field.chunks.clear()
+                i = 0
+                while i < len(field):
+                    self.field.set_row_bits(y0 + len(field) - 1 - i, field[i], x0)
+                    i += 1
+        if "memx" in state:
+            self.memx = int(state["memx"])
+        if "memy" in state:
+            self.memy = int(state["memy"])
+        if self.field.bounded:
+            self.memx = min(max(self.memx, 0), self.field.width - 1)
+            self.memy = min(max(self.memy, 0), self.field.height - 1)
+        if "flag" in state:
+            self.flag = int(state["flag"]) & 1
+        if "program_counter" in state:
+            self.program_counter = int(state["program_counter"])
+
+    #  The machine as it is now, as bytes (see "Snapshots" above).
+    def snapshot(self):
+        x0, y0, width, height, bits = func_pack_field(self.field)
+        return _snapshot_header.pack(
+            b"OB1S", _snapshot_version, self.flag, int(self.field.bounded),
+            bytes.fromhex(func_program_hash(self.proglist)), self.program_counter,
+            self.memx, self.memy, x0, y0, width, height) + zlib.compress(bits)
+
+    #  Puts the machine back as it was when snapshot() gave data. Raises
+    #  ValueError (and changes nothing) if it can't.
+    def restore(self, data):
+        if len(data) < _snapshot_header.size:
+            raise ValueError("not an ob1 snapshot")
+        (magic, version, flag, bounded, digest, program_counter, memx, memy,
+         x0, y0, width, height) = _snapshot_header.unpack_from(data)
+        if magic != b"OB1S":
+            raise ValueError("not an ob1 snapshot")
+        if version != _snapshot_version:
+            raise ValueError("an ob1 snapshot of version %d, not %d" % (version, _snapshot_version))
+        if digest.hex() != func_program_hash(self.proglist):
+            raise ValueError("the snapshot is of a different program")
+        if bounded != int(self.field.bounded):
+            raise ValueError("the snapshot is of a different kind of field")
+        try:
+            bits = zlib.decompress(data[_snapshot_header.size :])
+        except zlib.error:
+            raise ValueError("the field in the snapshot is damaged")
+        func_unpack_field(self.field, x0, y0, width, height, bits)
+        self.program_counter = program_counter
+        self.memx = memx
+        self.memy = memy
+        self.flag = flag
+        self.exception = "ok"
+        self.steps = 0
+
+    #  A second machine at the same point with the same program (shared,
+    #  not copied) and a field of its own.
+    def fork(self):
+        m = Machine(self.field.fork())
+        m.proglist = self.proglist
+        m.jumps = self.jumps
+        m.code = self.code
+        m.fast_code = self.fast_code
+        m.optimizations = self.optimizations
+        m.missing_tags = self.missing_tags
+        m.listing = self.listing
+        m.program_counter = self.program_counter
+        m.memx = self.memx
+        m.memy = self.memy
+        m.flag = self.flag
+        m.exception = self.exception
+        m.steps = self.steps
+        m.name = self.name
+        m.rules = self.rules
+        return m
+
+    ########################################################################
+    #  The console commands
+    ########################################################################
+
+    #  direction is "l", "r", "u" or "d". The pointer stops at the edge
+    #  of the field (no error).
+    def move(self, direction, count=1):
+        if direction == "l":
+            self.memx -= count
+        elif direction == "r":
+            self.memx += count
+        elif direction == "u":
+            self.memy += count
+        elif direction == "d":
+            self.memy -= count
+        if self.field.bounded:
+            if self.memx < 0:
+                self.memx = 0
+            if self.memx > self.field.width - 1:
+                self.memx = self.field.width - 1
+            if self.memy < 0:
+                self.memy = 0
+            if self.memy > self.field.height - 1:
+                self.memy = self.field.height - 1
+
+    def home(self):
+        self.memx = 0
+        self.memy = 0
+
+    def toggle_flag(self):
+        self.flag = 1 - self.flag
+
+    def data_bits(self, this_str):
+        if self.field.dense:
+            rows = self.field.rows
+            rows[self.memy] = func_data_bits(rows[self.memy], self.memx, this_str, self.field.width)
+        elif this_str.strip("01") != "":
+            print("?????")
+        else:
+            self.field.set_row_bits(self.memy, this_str, self.memx)
+
+    ########################################################################
+    #  The run loop
+    ########################################################################
+
+    #  Checked before every step or run. Returns "ok", or the reason there
+    #  is nothing to run. A program counter that has gone off the end of
+    #  the tape goes back to the beginning.
+    def start_check(self):
+        if len(self.code) == 0:
+            return "no program loaded"
+        if self.program_counter < 0:
+            return "what happened???"
+        if self.program_counter >= len(self.code):
+            self.program_counter = 0
+        return "ok"
+
+    #  The program has already been decoded by func_decode_prog, so each
+    #  step is one tuple unpack plus a few comparisons of small ints.
+    #  Anything that stops the machine leaves the program counter exactly
+    #  where the console expects it:
+    #      pointer out of range, tag not found - on the failing instruction
+    #      halt - on the instruction after the "x"
+    def execute(self, mode, max_steps=None):
+        if not self.field.dense:
+            return self.execute_watched(mode, max_steps, [])
+
+        exception = self.start_check()
+
+        code = self.fast_code
+        program_counter = self.program_counter
+        rows = self.field.rows
+        right_edge = self.field.width - 1
+        top_edge = self.field.height - 1
+        memx = self.memx
+        memy = self.memy
+        flag = self.flag
+
+        if mode == "step":
+            limit = 1
+        elif max_steps is None:
+            limit = sys.maxsize
+        else:
+            limit = max_steps
+
+        steps = 0
+        proglist_length = len(code)
+        pc = program_counter
+
+        if exception == "ok":
+            exception = "step limit"     # unless something else stops us
+
+            while steps < limit:
+                cond, op, arg = code[pc]
+                steps += 1
+
+                if (cond == 0
+                        or (cond == 1 and not (rows[memy] >> memx) & 1)    # ifd0
+                        or (cond == 2 and (rows[memy] >> memx) & 1)        # ifd1
+                        or (cond == 3 and not flag)                        # iff0
+                        or (cond == 4 and flag)):                          # iff1
+
+                    if op == 16:         #### adv/ret
+                        if arg < 0:
+                            exception = "tag not found"
+                            break
+                        pc = arg
+                        continue
+                    elif op == 17:       #### tag
+                        pass
+                    elif op == 0:        #### r
+                        if memx == right_edge:
+                            exception = "data pointer out of range"
+                            break
+                        memx += 1
+                    elif op == 1:        #### l
+                        if memx == 0:
+                            exception = "data pointer out of range"
+                            break
+                        memx -= 1
+                    elif op == 2:        #### u
+                        if memy == top_edge:
+                            exception = "data pointer out of range"
+                            break
+                        memy += 1
+                    elif op == 3:        #### d
+                        if memy == 0:
+                            exception = "data pointer out of range"
+                            break
+                        memy -= 1
+                    elif op == 6:        #### sk
+                        pc += 1
+                    elif op == 4:        #### h
+                        memx = 0
+                        memy = 0
+                    elif op == 5:        #### x
+                        pc += 1
+                        exception = "halt"
+                        if pc >= proglist_length:
+                            exception = "Program terminated normally"
+                        break
+                    elif op == 7:        #### ex
+                        data_bit = (rows[memy] >> memx) & 1
+                        if data_bit != flag:
+                            rows[memy] ^= 1 << memx
+                        flag = data_bit
+                    elif op == 8:        #### df
+                        if flag:
+                            rows[memy] |= 1 << memx
+                        else:
+                            rows[memy] &= ~(1 << memx)
+                    elif op == 9:        #### dc
+                        rows[memy] ^= 1 << memx
+                    elif op == 10:       #### d0
+                        rows[memy] &= ~(1 << memx)
+                    elif op == 11:       #### d1
+                        rows[memy] |= 1 << memx
+                    elif op == 12:       #### fd
+                        flag = (rows[memy] >> memx) & 1
+                    elif op == 13:       #### fc
+                        flag = 1 - flag
+                    elif op == 14:       #### f0
+                        flag = 0
+                    elif op == 15:       #### f1
+                        flag = 1
+                    elif op <= 20:       #### a run of n instructions
+                        n, p, q = arg
+                        if limit - steps < n - 1:
+                            #  Not enough steps left: finish one at a time.
+                            code = self.code
+                            steps -= 1
+                            continue
+                        if op == 18:     #### n moves
+                            if p == 0:
+                                room = right_edge - memx
+                            elif p == 1:
+                                room = memx
+                            elif p == 2:
+                                room = top_edge - memy
+                            else:
+                                room = memy
+                            if room < n:
+                                moves = room
+                            else:
+                                moves = n
+                            if p == 0:
+                                memx += moves
+                            elif p == 1:
+                                memx -= moves
+                            elif p == 2:
+                                memy += moves
+                            else:
+                                memy -= moves
+                            if room < n:
+                                pc += room
+                                steps += room
+                                exception = "data pointer out of range"
+                                break
+                        elif op == 19:   #### tags and flag instructions
+                            flag = (flag & p) ^ q
+                        else:            #### tags and data instructions
+                            data_bit = (rows[memy] >> memx) & 1
+                            if ((data_bit & p) ^ q) != data_bit:
+                                rows[memy] ^= 1 << memx
+                        pc += n - 1
+                        steps += n - 1
+                    elif op == 21:       #### a scan loop
+                        p, bit, exit_pc = arg
+                        #  How many cells from here hold the bit (cells) and
+                        #  how far it is to the edge (room).
+                        if p == 0:
+                            room = right_edge - memx
+                            cells = rows[memy] >> memx
+                            if bit:
+                                cells = ~cells
+                            cells = (cells & -cells).bit_length() - 1
+                        elif p == 1:
+                            room = memx
+                            mask = (2 << memx) - 1
+                            cells = rows[memy] & mask
+                            if bit:
+                                cells ^= mask
+                            cells = memx + 1 - cells.bit_length()
+                        elif p == 2:
+                            room = top_edge - memy
+                            y = memy
+                            while y <= top_edge and (rows[y] >> memx) & 1 == bit:
+                                y += 1
+                            cells = y - memy
+                        else:
+                            room = memy
+                            y = memy
+                            while y >= 0 and (rows[y] >> memx) & 1 == bit:
+                                y -= 1
+                            cells = memy - y
+                        #  Four steps a cell, then three to get out.
+                        if cells < 0 or cells > room:
+                            moves = room
+                        else:
+                            moves = cells
+                        if limit - steps < 4 * moves + 2:
+                            moves = (limit - steps + 1) // 4
+                            code = self.code
+                        if p == 0:
+                            memx += moves
+                        elif p == 1:
+                            memx -= moves
+                        elif p == 2:
+                            memy += moves
+                        else:
+                            memy -= moves
+                        steps += 4 * moves - 1
+                        if code is self.code:
+                            continue     # the step limit is near
+                        steps += 3
+                        if cells < 0 or cells > room:
+                            pc += 3
+                            exception = "data pointer out of range"
+                            break
+                        if exit_pc < 0:
+                            pc += 2
+                            exception = "tag not found"
+                            break
+                        pc = exit_pc
+                        continue
+                    else:                #### a fill loop
+                        p, value, q = arg
+                        if value == 2:
+                            value = flag
+                        if p == 0:
+                            room = right_edge - memx
+                        elif p == 1:
+                            room = memx
+                        elif p == 2:
+                            room = top_edge - memy
+                        else:
+                            room = memy
+                        #  Four steps a cell, three for the one at the edge.
+                        cells = room + 1
+                        if limit - steps < 4 * room + 2:
+                            cells = (limit - steps + 1) // 4
+                            code = self.code
+                        if cells > 0:
+                            if p <= 1:
+                                if p == 0:
+                                    mask = ((1 << cells) - 1) << memx
+                                    memx += cells - 1
+                                else:
+                                    mask = ((1 << cells) - 1) << (memx - cells + 1)
+                                    memx -= cells - 1
+                                if value:
+                                    rows[memy] |= mask
+                                else:
+                                    rows[memy] &= ~mask
+                            else:
+                                if p == 2:
+                                    ys = range(memy, memy + cells)
+                                    memy += cells - 1
+                                else:
+                                    ys = range(memy, memy - cells, -1)
+                                    memy -= cells - 1
+                                for y in ys:
+                                    if value:
+                                        rows[y] |= 1 << memx
+                                    else:
+                                        rows[y] &= ~(1 << memx)
+                        if code is self.code:
+                            #  The step limit is near: back at the tag, one
+                            #  cell on from the last one written.
+                            if cells > 0:
+                                if p == 0:
+                                    memx += 1
+                                elif p == 1:
+                                    memx -= 1
+                                elif p == 2:
+                                    memy += 1
+                                else:
+                                    memy -= 1
+                            steps += 4 * cells - 1
+                            continue
+                        steps += 4 * room + 2
+                        pc += 2
+                        exception = "data pointer out of range"
+                        break
+
+                pc += 1
+                if pc >= proglist_length:
+                    exception = "Program terminated normally"
+                    break
+
+            if exception == "step limit" and mode == "step":
+                exception = "step"
+
+        program_counter = pc
+        self.steps = steps
+
+        self.program_counter = program_counter
+        self.memx = memx
+        self.memy = memy
+        self.flag = flag
+        self.exception = exception
+        return exception
+
+    #  The same run loop, but after every step each watcher's
+    #  after_step(pc, taken, next_pc, memx, memy, flag, flipped) is called:
+    #      pc       - the instruction just executed
+    #      taken    - whether its condition held (always True for exec,
+    #                 tag, adv and ret)
+    #      next_pc  - where the program counter is now
+    #      memx, memy, flag - the state after the step
+    #      flipped  - True if the data bit under the pointer changed
+    #  A watcher can stop the run by returning an exception string
+    #  (otherwise it returns None). Each watcher's start(machine, pc) is
+    #  called first.
+    #
+    #  This is slower than execute(), so it is only used when something is
+    #  actually watching, or for fields that aren't "dense" (it only uses
+    #  the field's test and flip methods).
+    def execute_watched(self, mode, max_steps, watchers):
+        exception = self.start_check()
+
+        code = self.code
+        test = self.field.test
+        flip = self.field.flip
+        if self.field.bounded:
+            right_edge = self.field.width - 1
+            top_edge = self.field.height - 1
+            left_edge = 0
+            bottom_edge = 0
+        else:
+            right_edge = None
+            top_edge = None
+            left_edge = None
+            bottom_edge = None
+        memx = self.memx
+        memy = self.memy
+        flag = self.flag
+
+        if mode == "step":
+            limit = 1
+        elif max_steps is None:
+            limit = sys.maxsize
+        else:
+            limit = max_steps
+
+        steps = 0
+        proglist_length = len(code)
+        pc = self.program_counter
+
+        if exception == "ok":
+            for watcher in watchers:
+                watcher.start(self, pc)
+            exception = None
+
+            while steps < limit:
+                cond, op, arg = code[pc]
+                steps += 1
+                next_pc = pc + 1
+                flipped = False
+
+                taken = (cond == 0
+                         or (cond == 1 and not test(memx, memy))
+                         or (cond == 2 and test(memx, memy))
+                         or (cond == 3 and not flag)
+                         or (cond == 4 and flag))
+
+                if taken:
+                    if op == 16:         #### adv/ret
+                        if arg < 0:
+                            exception = "tag not found"
+                            next_pc = pc
+                        else:
+                            next_pc = arg
+                    elif op == 17:       #### tag
+                        pass
+                    elif op == 0:        #### r
+                        if memx == right_edge:
+                            exception = "data pointer out of range"
+                            next_pc = pc
+                        else:
+                            memx += 1
+                    elif op == 1:        #### l
+                        if memx == left_edge:
+                            exception = "data pointer out of range"
+                            next_pc = pc
+                        else:
+                            memx -= 1
+                    elif op == 2:        #### u
+                        if memy == top_edge:
+                            exception = "data pointer out of range"
+                            next_pc = pc
+                        else:
+                            memy += 1
+                    elif op == 3:        #### d
+                        if memy == bottom_edge:
+                            exception = "data pointer out of range"
+                            next_pc = pc
+                        else:
+                            memy -= 1
+                    elif op == 4:        #### h
+                        memx = 0
+                        memy = 0
+                    elif op == 5:        #### x
+                        exception = "halt"
+                    elif op == 6:        #### sk
+                        next_pc = pc + 2
+                    elif op == 12:       #### fd
+                        flag = test(memx, memy)
+                    elif op == 13:       #### fc
+                        flag = 1 - flag
+                    elif op == 14:       #### f0
+                        flag = 0
+                    elif op == 15:       #### f1
+                        flag = 1
+                    else:
+                        data_bit = test(memx, memy)
+                        if op == 7:      #### ex
+                            new_bit = flag
+                            flag = data_bit
+                        elif op == 8:    #### df
+                            new_bit = flag
+                        elif op == 9:    #### dc
+                            new_bit = 1 - data_bit
+                        elif op == 10:   #### d0
+                            new_bit = 0
+                        else:            #### d1
+                            new_bit = 1
+                        if new_bit != data_bit:
+                            flip(memx, memy)
+                            flipped = True
+
+                if next_pc >= proglist_length and (exception is None or exception == "halt"):
+                    exception = "Program terminated normally"
+
+                for watcher in watchers:
+                    stop = watcher.after_step(pc, taken, next_pc, memx, memy, flag, flipped)
+                    if stop is not None and exception is None:
+                        exception = stop
+
+                pc = next_pc
+                if exception is not None:
+                    break
+
+            if exception is None:
+                if mode == "step":
+                    exception = "step"
+                else:
+                    exception = "step limit"
+
+        self.program_counter = pc
+        self.steps = steps
+        self.memx = memx
+        self.memy = memy
+        self.flag = flag
+        self.exception = exception
+        return exception
+
+
+
+############################################################################
+###                                                                      ###
+###                               MAIN                                   ###
+###                                                                      ###
+############################################################################
+
+#  view is the [x, y] of the bottom left of the 16 x 16 part of the field
+#  on display. It follows the pointer around a field bigger than that.
+#
+#  Returns the console screen as a list of lines.
+def func_screen_lines(m, str_0, str_1, view, result=None):
+    lines = [
+        "",
+        'To load a program, enter "path/filename" in quotes.',
+        '<ENTER>=run s=step l=left r=right u=up d=down h=home',
+        '0=reset_bit 1=set_bit f=toggle_flag q=quit',
+        '*** See comments in listing for more options ***',
+    ]
+
+    view[0] = func_follow(view[0], m.memx, m.field.width)
+    view[1] = func_follow(view[1], m.memy, m.field.height)
+
+    displayed_op = m.program_counter - 11
+    i=15
+    while i >= 0:
+        displayed_op += 1
+        this_str = func_field_view(m.field, view[1] + i, str_0, str_1, view[0])
+        
+        if i == 10:
+            this_str = this_str + str(m.program_counter).rjust(6) + " >>>"
+        else:
+            this_str = this_str+ "          "
+        lines.append(this_str + " " + m.format_line(displayed_op))
+
+        displayed_op += 1      
+        if m.memy - view[1] == i:
+            this_str = ("   " * (m.memx - view[0])) + "*^*" + ("   " * (15 - m.memx + view[0]))
+        else:
+            this_str = (" " * 48)
+        lines.append(this_str + "           " + m.format_line(displayed_op))
+        i -= 1
+
+    lines.append("******************** FLAG=" + str(m.flag) +  " ********************           ######&")
+    if m.name != "":
+        this_str = '"' + m.name + '"'
+    else:
+        this_str = ""
+    if m.field.width != 16 or m.field.height != 16:
+        this_str = this_str + "   pointer at x=" + str(m.memx) + " y=" + str(m.memy)
+    lines.append(this_str)
+    if result is None:
+        lines.append(m.exception)
+    else:
+        lines.append(m.exception + "   (%d steps, %.3f s, %.0f steps/s)" % (result.steps, result.elapsed, result.ips))
+    return lines
+
+def func_display(m, str_0, str_1, view, result=None):
+    for this_str in func_screen_lines(m, str_0, str_1, view, result):
+        print(this_str)
+
+############################################################################
+#
+#  Screen draws the console screen on a terminal that understands ANSI
+#  cursor movement. It remembers what is on the screen and, next time,
+#  only rewrites the parts of lines that have changed, moving the cursor
+#  up from the input line to get to them.
+#
+#  While the console is using it, Screen stands in for sys.stdout and
+#  counts the lines anything else prints. If something was printed (a
+#  load error, say), the screen below it has scrolled away, so the next
+#  draw prints the whole screen again, the plain way.
+#
+
+class Screen:
+
+    def __init__(self, out=None):
+        if out is None:
+            out = sys.stdout
+        self.out = out
+        self.lines = None
+        self.printed = 0
+        self.typed = 0
+
+    #  What print() and friends write while the console runs.
+    def write(self, text):
+        self.printed += text.count("\n")
+        return self.out.write(text)
+
+    def flush(self):
+        self.out.flush()
+
+    def fileno(self):
+        return self.out.fileno()
+
+    def isatty(self):
+        return self.out.isatty()
+
+    #  Call after each line typed in: the terminal has echoed it.
+    def line_typed(self):
+        self.typed += 1
+
+    #  Draws lines and leaves the cursor at the start of the line below
+    #  them (the input line).
+    def draw(self, lines):
+        try:
+            rows = os.get_terminal_size(self.out.fileno()).lines
+        except (OSError, ValueError):
+            rows = 0
+        if (self.lines is None or self.printed != 0 or len(lines) != len(self.lines)
+                or rows < len(lines) + 1 + self.typed):
+            self.out.write("\n".join(lines) + "\n")
+        else:
+            #  From wherever typing left the cursor back up to the top.
+            parts = ["\x1b[%dA" % (len(lines) + self.typed)]
+            row = 0
+            for i in range(len(lines)):
+                old = self.lines[i]
+                new = lines[i]
+                if old == new:
+                    continue
+                first = 0
+                while first < len(old) and first < len(new) and old[first] == new[first]:
+                    first += 1
+                if len(old) == len(new):
+                    last = len(new)
+                    while new[last - 1] == old[last - 1]:
+                        last -= 1
+                    span = new[first:last]
+                else:
+                    span = new[first:] + "\x1b[K"
+                if i > row:
+                    parts.append("\x1b[%dB" % (i - row))
+                    row = i
+                parts.append("\x1b[%dG" % (first + 1) + span)
+            parts.append("\x1b[%dB\r\x1b[K" % (len(lines) - row))
+            self.out.write("".join(parts))
+        self.out.flush()
+        self.lines = list(lines)
+        self.printed = 0
+        self.typed = 0
+
+#  Redraws the screen while a program runs, at most rate times a second
+#  (see Machine.run's progress).
+class LiveDisplay:
+
+    def __init__(self, screen, str_0, str_1, view, rate):
+        self.screen = screen
+        self.str_0 = str_0
+        self.str_1 = str_1
+        self.view = view
+        self.interval = 1.0 / rate
+        self.last = time.perf_counter()
+
+    def __call__(self, m, steps):
+        now = time.perf_counter()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        exception = m.exception
+        m.exception = "running... %d steps" % steps
+        lines = func_screen_lines(m, self.str_0, self.str_1, self.view)
+        m.exception = exception
+        if self.screen is None:
+            print("\n".join(lines))
+        else:
+            self.screen.draw(lines)
+
+#  screen is a Screen to draw on, or None to just print the screen.
+#
+#  With commands (lines of console commands, such as an open script file)
+#  the commands are taken from there instead of typed, nothing is drawn
+#  in between, and when they run out (or at "q") the screen is shown
+#  once on out (stdout if None), or with json_state the machine's
+#  state(json_field) as one line of JSON. Returns how many commands failed (a
+#  program that didn't load, or a command that wasn't understood).
+def func_console(m, screen=None, commands=None, json_state=False, out=None, json_field="rows"):
+    if commands is None:
+        print()
+    view = [0, 0]
+    str_0="0"
+    str_1="1"
+    time_limit = None
+    detect_loops = False
+    optimize = False
+    watch_rate = None
+    profile = False
+    trace = Trace()
+    trace_runs = False
+    breakpoints = Breakpoints()
+    snapshots = {}
+    result = None
+    failed = 0
+
+    quit = 0
+
+    while quit == 0:
+        if commands is not None:
+            console_cmd = next(commands, None)
+            if console_cmd is None:
+                break
+            console_cmd = console_cmd.rstrip("\r\n")
+        elif screen is None:
+            func_display(m, str_0, str_1, view, result)
+        else:
+            screen.draw(func_screen_lines(m, str_0, str_1, view, result))
+
+        cmd = ""
+        if commands is None:
+            console_cmd = input()
+        if screen is not None:
+            screen.line_typed()
+
+        #  "q" keeps the last command's result, for the state shown at the
+        #  end of a script.
+        if console_cmd != "q":
+            m.exception = "ok"
+            result = None
+
+        if console_cmd != "":
+            cmd = console_cmd[0]
+      
+        if cmd == "l" or cmd == "r" or cmd == "u" or cmd == "d":
+            m.move(cmd, func_get_number(console_cmd))
+        elif console_cmd == "h":
+            m.home()
+        elif console_cmd == "f":
+            m.toggle_flag()
+        elif cmd == "0":
+            m.data_bits(console_cmd)
+        elif cmd == "1":
+            m.data_bits(console_cmd)
+        elif cmd == "z":
+            this_str = console_cmd + "01"
+            str_0 = this_str[1]
+            str_1 = this_str[2]
+        elif console_cmd == "s":
+            if len(breakpoints) > 0:
+                m.step([trace, breakpoints])
+            else:
+                m.step([trace])
+        elif cmd == "b":
+            m.step_back(trace, func_get_number(console_cmd))
+        elif cmd == "@":
+            if console_cmd == "@":
+                m.exception = "breaks: " + (", ".join(breakpoints.describe()) or "none")
+            elif console_cmd == "@clear":
+                breakpoints.clear()
+                m.exception = "all breaks cleared"
+            else:
+                try:
+                    m.exception = breakpoints.toggle(console_cmd[1 :])
+                except ValueError:
+                    print("????")
+                    failed += 1
+        elif cmd == ">":
+            name = console_cmd[1 :].strip()
+            if name == "":
+                m.exception = "snapshots: " + (", ".join(sorted(snapshots)) or "none")
+            elif name.lower().endswith(".ob1s"):
+                try:
+                    with open(name, "wb") as snapshot_file:
+                        snapshot_file.write(m.snapshot())
+                    m.exception = "saved " + name
+                except OSError as error:
+                    print(">>>", error)
+                    failed += 1
+            else:
+                snapshots[name] = m.snapshot()
+                m.exception = "saved " + name
+        elif cmd == "<":
+            name = console_cmd[1 :].strip()
+            try:
+                if name.lower().endswith(".ob1s"):
+                    with open(name, "rb") as snapshot_file:
+                        data = snapshot_file.read()
+                elif name in snapshots:
+                    data = snapshots[name]
+                else:
+                    raise ValueError("no snapshot called " + name)
+                m.restore(data)
+                trace = Trace()
+                m.exception = "restored " + name
+            except (OSError, ValueError) as error:
+                print(">>>", error)
+                failed += 1
+        elif console_cmd == "k":
+            trace_runs = not trace_runs
+            if trace_runs:
+                m.exception = "keeping a trace of runs"
+            else:
+                m.exception = "not keeping a trace of runs"
+        elif console_cmd == "":
+            progress = None
+            if watch_rate is not None and commands is None:
+                progress = LiveDisplay(screen, str_0, str_1, view, watch_rate)
+            watchers = []
+            if trace_runs:
+                watchers.append(trace)
+            if len(breakpoints) > 0:
+                watchers.append(breakpoints)
+            if profile:
+                watchers.insert(0, Profiler())
+            result = m.run(time_limit=time_limit, detect_loops=detect_loops, progress=progress,
+                           watchers=watchers)
+            if profile:
+                print(watchers[0].report(), end="")
+                if m.name != "":
+                    filename = os.path.splitext(m.name)[0] + ".folded"
+                else:
+                    filename = "ob1.folded"
+                try:
+                    watchers[0].write_collapsed(filename)
+                    print(">>> Collapsed stacks written to", filename)
+                except OSError as error:
+                    print(">>>", error)
+        elif console_cmd == "i":
+            detect_loops = not detect_loops
+            if detect_loops:
+                m.exception = "infinite loop detection on"
+            else:
+                m.exception = "infinite loop detection off"
+        elif console_cmd == "o":
+            optimize = not optimize
+            if optimize:
+                for change in m.optimize():
+                    print(">>> Optimized:", change)
+                m.exception = "optimizer on"
+            else:
+                m.unoptimize()
+                m.exception = "optimizer off"
+        elif console_cmd == "p":
+            profile = not profile
+            if profile:
+                m.exception = "profiler on"
+            else:
+                m.exception = "profiler off"
+        elif cmd == "w":
+            if console_cmd == "w":
+                watch_rate = None
+                m.exception = "watch off"
+            else:
+                try:
+                    watch_rate = float(console_cmd[1 :])
+                    if watch_rate <= 0:
+                        raise ValueError
+                    m.exception = "watch on"
+                except ValueError:
+                    watch_rate = None
+                    print("????")
+                    failed += 1
+        elif cmd == "t":
+            if console_cmd == "t":
+                time_limit = None
+            else:
+                try:
+                    time_limit = float(console_cmd[1 :])
+                except ValueError:
+                    print("????")
+                    failed += 1
+        elif console_cmd == "q":
+            quit = 1
+        elif cmd == '"':
+            if m.load(console_cmd[1 : -1], verbose=True, optimize=optimize) != 0:
+                failed += 1
+        else:
+            print("?????")
+            failed += 1
+
+    if commands is not None:
+        if json_state:
+            print(json.dumps(m.state(json_field)), file=out)
+        else:
+            for this_str in func_screen_lines(m, str_0, str_1, view, result):
+                print(this_str, file=out)
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MJH One-Bit Machine Type 01")
+    parser.add_argument("--sparse", action="store_true",
+                        help="use a data field without edges")
+    parser.add_argument("--width", type=int, default=16,
+                        help="width of the data field")
+    parser.add_argument("--height", type=int, default=16,
+                        help="height of the data field")
+    parser.add_argument("--field", metavar="FILE",
+                        help="keep the data field in FILE instead of memory")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="rewrite every program loaded with the rules in FILE")
+    parser.add_argument("--plain", action="store_true",
+                        help="print the whole screen every time (no cursor movement)")
+    parser.add_argument("--script", metavar="FILE",
+                        help='take console commands from FILE ("-" for the keyboard or a pipe), '
+                             'show the screen once at the end')
+    parser.add_argument("--json", action="store_true",
+                        help="with --script, show the machine's state as JSON at the end instead")
+    parser.add_argument("--field-output", choices=["rows", "cells", "none"], default="rows",
+                        help='with --json, the field as rows (the default), as a list of the "1" cells, '
+                             'or not at all')
+    parser.add_argument("--assemble", nargs=2, metavar=("PROGRAM", "TAPE"),
+                        help="turn a text program into a binary .ob1b tape and stop")
+    parser.add_argument("--disassemble", metavar="TAPE",
+                        help="list a binary .ob1b tape as a text program and stop")
+    args = parser.parse_args(argv)
+
+    if args.assemble is not None:
+        return func_assemble(args.assemble[0], args.assemble[1])
+    if args.disassemble is not None:
+        try:
+            proglist, jumps = func_read_tape(args.disassemble)
+        except (OSError, ValueError) as error:
+            print(">>>", error)
+            return 5
+        sys.stdout.write(func_disassemble(proglist))
+        return 0
+
+    rules = []
+    if args.rules is not None:
+        try:
+            rules = func_read_rules(args.rules)
+        except (OSError, ValueError) as error:
+            print(">>>", error)
+            return 5
+
+    script_file = None
+    if args.script == "-":
+        script_file = sys.stdin
+    elif args.script is not None:
+        try:
+            script_file = open(args.script, "r")
+        except OSError as error:
+            print(">>>", error)
+            return 5
+
+    if args.sparse:
+        m = Machine(SparseField())
+    elif args.field is not None:
+        m = Machine(MappedField(args.field, args.width, args.height))
+    else:
+        m = Machine(Field(args.width, args.height))
+    m.rules = rules
+
+    #  A script's messages (loads, "?????") go to stderr, leaving stdout
+    #  to the final screen or JSON.
+    if script_file is not None:
+        out = sys.stdout
+        try:
+            sys.stdout = sys.stderr
+            json_field = args.field_output
+            if json_field == "none":
+                json_field = None
+            failed = func_console(m, commands=script_file, json_state=args.json, out=out,
+                                  json_field=json_field)
+        finally:
+            sys.stdout = out
+            if script_file is not sys.stdin:
+                script_file.close()
+            m.field.close()
+        if failed:
+            return 1
+        return 0
+
+    screen = None
+    if not args.plain and sys.stdout.isatty() and os.environ.get("TERM", "dumb") != "dumb":
+        screen = Screen()
+
+    func_banner()
+    try:
+        if screen is not None:
+            sys.stdout = screen
+        func_console(m, screen)
+    finally:
+        if screen is not None:
+            sys.stdout = screen.out
+        m.field.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
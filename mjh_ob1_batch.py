@@ -0,0 +1,247 @@
+#  MJH One-Bit Machine Type 01 - batch runner
+#
+#############################################################################
+#
+#  Runs one or more "ob1" programs against a whole file of starting data
+#  fields, without the console, spread over all the CPU cores.
+#
+#      python mjh_ob1_batch.py scan.ob1 copy.ob1 --fields fields.jsonl
+#
+#  The fields file has one JSON object per line. Every key is optional:
+#
+#      {"id": "case 7",
+#       "field": ["0000000000000000", ..., "1001110100000000"],
+#       "flag": 1, "memx": 3, "memy": 0}
+#
+#  "field" is a list of rows of "0"s and "1"s, top row first (the way the
+#  console shows it). Missing rows or bits are "0". With no fields file
+#  each program is run once on an empty field. A line that isn't a JSON
+#  object like that gets a result line of its own saying what is wrong
+#  ("exception": "bad field: ..."), and the rest of the batch goes on.
+#
+#  Every program is run against every field. The results are written as
+#  JSON Lines (to --out, or the screen), one line per run, in the same
+#  order as the programs and fields were given:
+#
+#      {"program": "scan.ob1", "id": "case 7", "exception": "halt",
+#       "steps": 41, "program_counter": 6, "memx": 9, "memy": 0,
+#       "flag": 0, "field": [...]}
+#
+#  Options:
+#
+#      --out FILE         where to write the results
+#      --workers N        number of processes (default: one per core)
+#      --width N          width of the data field (default 16)
+#      --height N         height of the data field (default 16)
+#      --field-output F   how the field is written: "rows" (the default),
+#                         "cells" (a list of the [x, y] of every "1",
+#                         for big fields) or "none"
+#      --max-steps N      stop each run after N instructions
+#      --time-limit S     stop each run after S seconds
+#      --backend NAME     "interp" or "compiled"
+#      --detect-loops     stop runs that are stuck in a loop
+#      --memo             remember which cells each run read, and answer
+#                         later runs that agree on those cells without
+#                         running them (see Memo in mjh_ob1.py); for
+#                         sweeps over many settings of a few input cells
+#
+#  Each worker process loads a program the first time it needs it and
+#  keeps it, so no program is read more than once per process. Runs are
+#  handed out in chunks of fields for one program, which keeps the
+#  traffic between processes small.
+#
+#############################################################################
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+
+import mjh_ob1
+
+#  Loaded machines (with how the load went), and their Memos, by program
+#  path, for this process.
+_machines = {}
+_memos = {}
+
+#  Returns (machine, the error number from loading it; 0 if it loaded).
+def func_machine_for(path, width=16, height=16):
+    key = (path, width, height)
+    loaded = _machines.get(key)
+    if loaded is None:
+        m = mjh_ob1.Machine(mjh_ob1.Field(width, height))
+        loaded = (m, m.load(path))
+        _machines[key] = loaded
+    return loaded
+
+#  Runs one program against a list of (id, field, problem) cases and
+#  returns the result records. This is what each worker process does.
+def func_run_chunk(job):
+    path, cases, options = job
+    m, bad_error = func_machine_for(path, options.get("width", 16), options.get("height", 16))
+    results = []
+    for case_id, case, problem in cases:
+        record = {"program": path, "id": case_id}
+        if bad_error != 0:
+            record["exception"] = "problem loading program"
+            results.append(record)
+            continue
+        if problem is not None:
+            record["exception"] = "bad field: " + problem
+            results.append(record)
+            continue
+
+        m.set_state({"field": [], "memx": 0, "memy": 0, "flag": 0})
+        m.set_state(case)
+        m.program_counter = case.get("program_counter", 0)
+        if options.get("memo"):
+            result = _memos.setdefault(path, mjh_ob1.Memo()).run(m, options["max_steps"])
+        else:
+            result = m.run(max_steps=options["max_steps"],
+                           time_limit=options["time_limit"],
+                           backend=options["backend"],
+                           detect_loops=options["detect_loops"])
+
+        state = m.state(options.get("field_output", "rows"))
+        record["exception"] = result.reason
+        record["steps"] = result.steps
+        record["program_counter"] = state["program_counter"]
+        record["memx"] = state["memx"]
+        record["memy"] = state["memy"]
+        record["flag"] = state["flag"]
+        if "field" in state:
+            record["field"] = state["field"]
+        if "cells" in state:
+            record["cells"] = state["cells"]
+        results.append(record)
+    return results
+
+#  What is wrong with one starting field, or None if it can be run.
+def func_check_case(case):
+    if not isinstance(case, dict):
+        return "not a JSON object"
+    field = case.get("field", [])
+    if not isinstance(field, list):
+        return '"field" is not a list of rows'
+    for row in field:
+        if not isinstance(row, str) or row.strip("01") != "":
+            return '"field" rows must be strings of "0"s and "1"s'
+    for name in ("memx", "memy", "flag", "program_counter"):
+        if name in case and (not isinstance(case[name], int) or isinstance(case[name], bool)):
+            return '"%s" is not a whole number' % name
+    if case.get("program_counter", 0) < 0:
+        return '"program_counter" is less than 0'
+    return None
+
+#  Returns (id, field, problem) for each line, problem being what is
+#  wrong with it, or None.
+def func_read_fields(filename):
+    cases = []
+    if filename is None:
+        return [(0, {}, None)]
+    with open(filename, "r") as fields_file:
+        line_number = 0
+        for xline in fields_file:
+            line_number += 1
+            if xline.strip() == "":
+                continue
+            try:
+                case = json.loads(xline)
+            except ValueError as error:
+                cases.append((len(cases), {}, "line %d: %s" % (line_number, error)))
+                continue
+            problem = func_check_case(case)
+            if problem is None:
+                cases.append((case.get("id", len(cases)), case, None))
+            elif isinstance(case, dict):
+                cases.append((case.get("id", len(cases)), {}, "line %d: %s" % (line_number, problem)))
+            else:
+                cases.append((len(cases), {}, "line %d: %s" % (line_number, problem)))
+    return cases
+
+#  The jobs: every program against every field, chunk_size fields a job.
+def func_make_jobs(programs, cases, options, chunk_size):
+    for path in programs:
+        i = 0
+        while i < len(cases):
+            yield (path, cases[i : i + chunk_size], options)
+            i += chunk_size
+
+def func_run_batch(programs, cases, options, out_file, workers=None, chunk_size=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        #  A few chunks per worker per program, so the load stays even.
+        chunk_size = max(1, min(256, len(cases) // (workers * 4) or 1))
+
+    jobs = func_make_jobs(programs, cases, options, chunk_size)
+    count = 0
+    if workers == 1:
+        chunks = map(func_run_chunk, jobs)
+        for results in chunks:
+            for record in results:
+                out_file.write(json.dumps(record) + "\n")
+                count += 1
+        return count
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        #  Keep a bounded number of chunks in flight so results can be
+        #  written out as they come, in order, without queueing the whole
+        #  batch up front.
+        pending = []
+        for job in itertools.islice(jobs, workers * 4):
+            pending.append(executor.submit(func_run_chunk, job))
+        while pending:
+            results = pending.pop(0).result()
+            for job in itertools.islice(jobs, 1):
+                pending.append(executor.submit(func_run_chunk, job))
+            for record in results:
+                out_file.write(json.dumps(record) + "\n")
+                count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ob1 programs against many data fields.")
+    parser.add_argument("programs", nargs="+", help="ob1 program files")
+    parser.add_argument("--fields", help="JSON Lines file of starting fields")
+    parser.add_argument("--out", help="JSON Lines file for the results")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--width", type=int, default=16, help="width of the data field")
+    parser.add_argument("--height", type=int, default=16, help="height of the data field")
+    parser.add_argument("--field-output", choices=["rows", "cells", "none"], default="rows")
+    parser.add_argument("--max-steps", type=int, default=None)
+    parser.add_argument("--time-limit", type=float, default=None)
+    parser.add_argument("--backend", choices=["interp", "compiled"], default="interp")
+    parser.add_argument("--detect-loops", action="store_true")
+    parser.add_argument("--memo", action="store_true")
+    args = parser.parse_args(argv)
+    if args.memo and (args.time_limit is not None or args.detect_loops):
+        parser.error("--memo can't be used with --time-limit or --detect-loops")
+    if args.width < 1 or args.height < 1:
+        parser.error("--width and --height must be at least 1")
+
+    options = {
+        "max_steps": args.max_steps,
+        "time_limit": args.time_limit,
+        "backend": args.backend,
+        "detect_loops": args.detect_loops,
+        "memo": args.memo,
+        "width": args.width,
+        "height": args.height,
+        "field_output": args.field_output,
+    }
+    if args.field_output == "none":
+        options["field_output"] = None
+    cases = func_read_fields(args.fields)
+
+    if args.out is None:
+        func_run_batch(args.programs, cases, options, sys.stdout, args.workers)
+    else:
+        with open(args.out, "w") as out_file:
+            func_run_batch(args.programs, cases, options, out_file, args.workers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#  MJH One-Bit Machine Type 01 - benchmarks
+#
+#############################################################################
+#
+#  Times the machine on a fixed set of programs (in the "benchmarks"
+#  folder) and writes the results as JSON, so a change can be checked
+#  against the numbers from before it.
+#
+#      python mjh_ob1_bench.py run --out baseline.json
+#      ... make the change ...
+#      python mjh_ob1_bench.py run --out new.json
+#      python mjh_ob1_bench.py compare baseline.json new.json
+#
+#  The programs:
+#
+#      scan         the scan example from the top of mjh_ob1.py
+#      copy         the copy example from the top of mjh_ob1.py
+#      counter      a binary counter along the bottom row, to overflow
+#      fill_row     fills a row with the flag
+#      fill_column  fills a column with the flag
+#      bitsort      a bubble style sort of a 64 bit row
+#      long_tape    a 100,000 instruction tape that spends its time in
+#                   "adv,"/"ret," jumps (made by this program each time)
+#
+#  For each program "run" measures:
+#
+#      load_s           loading the program from its text (Machine.load,
+#                       with nothing in the cache)
+#      load_cached_s    loading it again, from the cache
+#      compile_s        compiling it for the "compiled" backend
+#      render_ms        building the console screen once
+#      peak_kib         the most memory Python had allocated during a
+#                       load and a run (from tracemalloc)
+#      steps, exception what one run does (the same every time; compare
+#                       reports any difference as a change in behaviour)
+#      backends         steps per second run by run, for each backend:
+#                       "interp", "compiled" and "optimized" (interp
+#                       after Machine.optimize())
+#
+#  Each program is run once to warm up (and, for "compiled", to compile
+#  it), then over and over, from the same start, for at least --min-time
+#  seconds per backend; the best of --repeat such measurements is kept.
+#
+#  "compare" lists every number side by side and flags any that got
+#  worse by more than --threshold percent (default 10). It exits with 1
+#  if anything was flagged, so it can be used in a script.
+#
+#############################################################################
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mjh_ob1
+
+_bench_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+#  name, program, field width and height, the bottom row of the starting
+#  field (the rest is "0"s), flag, and the step limit for one run (None =
+#  run to the end).
+_benchmarks = [
+    ("scan", "scan.ob1", 16, 16, "0000000000000001", 0, None),
+    ("copy", "copy.ob1", 16, 16, "1010000000000000", 0, None),
+    ("counter", "counter.ob1", 16, 16, "", 0, None),
+    ("fill_row", "fill_row.ob1", 16, 16, "", 1, None),
+    ("fill_column", "fill_column.ob1", 16, 16, "", 1, None),
+    ("bitsort", "bitsort.ob1", 64, 16, "01" * 32, 0, None),
+    ("long_tape", None, 16, 16, "", 0, 200000),
+]
+
+#  A long tape that jumps about: blocks of filler that each "adv," skips
+#  over, tag ids going round 1 thru 15, and a "ret,0" back to the start.
+def func_long_tape(filename, blocks=2000, filler=48):
+    lines = ["tag,0"]
+    i = 0
+    while i < blocks:
+        tag = i % 15 + 1
+        lines.append("adv,%d" % tag)
+        lines.extend(["exec,dc"] * filler)
+        lines.append("tag,%d" % tag)
+        i += 1
+    lines.append("ret,0")
+    with open(filename, "w") as tape_file:
+        tape_file.write("\n".join(lines) + "\n")
+
+def func_machine(width, height):
+    return mjh_ob1.Machine(mjh_ob1.Field(width, height))
+
+def func_reset(m, field, flag):
+    m.set_state({"field": field, "memx": 0, "memy": 0, "flag": flag, "program_counter": 0})
+
+#  Steps per second for one backend: runs the program from the start
+#  again and again for at least min_time seconds.
+def func_steps_per_second(m, field, flag, max_steps, backend, min_time):
+    steps = 0
+    elapsed = 0.0
+    while elapsed < min_time:
+        func_reset(m, field, flag)
+        result = m.run(max_steps=max_steps, backend=backend)
+        steps += result.steps
+        elapsed += result.elapsed
+    return steps / elapsed
+
+def func_run_one(name, path, width, height, bottom_row, flag, max_steps, min_time, repeat):
+    record = {}
+    field = [""] * (height - 1) + [bottom_row]
+
+    m = func_machine(width, height)
+    if os.path.exists(mjh_ob1.func_cache_file(path)):
+        os.remove(mjh_ob1.func_cache_file(path))
+    start = time.perf_counter()
+    m.load(path)
+    record["load_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    m.load(path)
+    record["load_cached_s"] = time.perf_counter() - start
+
+    mjh_ob1._compiled_programs.pop(mjh_ob1.func_program_hash(m.proglist), None)
+    start = time.perf_counter()
+    mjh_ob1.func_compile_prog(m.proglist, m.code)
+    record["compile_s"] = time.perf_counter() - start
+
+    func_reset(m, field, flag)
+    result = m.run(max_steps=max_steps)
+    record["steps"] = result.steps
+    record["exception"] = result.reason
+
+    view = [0, 0]
+    count = 200
+    start = time.perf_counter()
+    i = 0
+    while i < count:
+        mjh_ob1.func_screen_lines(m, "0", "1", view, result)
+        i += 1
+    record["render_ms"] = 1000.0 * (time.perf_counter() - start) / count
+
+    tracemalloc.start()
+    m = func_machine(width, height)
+    m.load(path)
+    func_reset(m, field, flag)
+    m.run(max_steps=max_steps)
+    record["peak_kib"] = tracemalloc.get_traced_memory()[1] / 1024.0
+    tracemalloc.stop()
+
+    backends = {}
+    for backend in ("interp", "compiled", "optimized"):
+        m = func_machine(width, height)
+        m.load(path)
+        run_backend = backend
+        if backend == "optimized":
+            m.optimize()
+            run_backend = "interp"
+        func_reset(m, field, flag)
+        m.run(max_steps=max_steps, backend=run_backend)
+        best = 0.0
+        i = 0
+        while i < repeat:
+            best = max(best, func_steps_per_second(m, field, flag, max_steps, run_backend, min_time))
+            i += 1
+        backends[backend] = {"steps_per_s": best}
+    record["backends"] = backends
+    return record
+
+def func_run(args):
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "benchmarks": {},
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ.setdefault("MJH_OB1_CACHE", os.path.join(temp_dir, "cache"))
+        mjh_ob1._cache_dir = os.environ["MJH_OB1_CACHE"]
+        for name, program, width, height, bottom_row, flag, max_steps in _benchmarks:
+            if args.only and name not in args.only:
+                continue
+            if program is None:
+                path = os.path.join(temp_dir, name + ".ob1")
+                func_long_tape(path)
+            else:
+                path = os.path.join(_bench_dir, program)
+            record = func_run_one(name, path, width, height, bottom_row, flag, max_steps,
+                                  args.min_time, args.repeat)
+            results["benchmarks"][name] = record
+            print("%-12s %10d steps  %12.0f steps/s interp  %12.0f compiled  %12.0f optimized" % (
+                  name, record["steps"], record["backends"]["interp"]["steps_per_s"],
+                  record["backends"]["compiled"]["steps_per_s"],
+                  record["backends"]["optimized"]["steps_per_s"]), file=sys.stderr)
+
+    text = json.dumps(results, indent=2, sort_keys=True) + "\n"
+    if args.out is None:
+        sys.stdout.write(text)
+    else:
+        with open(args.out, "w") as out_file:
+            out_file.write(text)
+    return 0
+
+#  Every number to compare, as (name, value, True if bigger is better).
+def func_measures(record):
+    yield ("load_s", record["load_s"], False)
+    yield ("load_cached_s", record["load_cached_s"], False)
+    yield ("compile_s", record["compile_s"], False)
+    yield ("render_ms", record["render_ms"], False)
+    yield ("peak_kib", record["peak_kib"], False)
+    for backend in sorted(record["backends"]):
+        yield (backend + " steps/s", record["backends"][backend]["steps_per_s"], True)
+
+def func_compare(args):
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.current) as current_file:
+        current = json.load(current_file)
+
+    flagged = 0
+    print("%-12s %-18s %14s %14s %9s" % ("benchmark", "measure", "baseline", "current", "change"))
+    for name in sorted(baseline["benchmarks"]):
+        old = baseline["benchmarks"][name]
+        new = current["benchmarks"].get(name)
+        if new is None:
+            print("%-12s missing from %s" % (name, args.current))
+            flagged += 1
+            continue
+        if (old["steps"], old["exception"]) != (new["steps"], new["exception"]):
+            print("%-12s BEHAVIOUR CHANGED: %d steps, %s -> %d steps, %s" % (
+                  name, old["steps"], old["exception"], new["steps"], new["exception"]))
+            flagged += 1
+        new_measures = dict((measure, value) for measure, value, better in func_measures(new))
+        for measure, value, bigger_is_better in func_measures(old):
+            if measure not in new_measures:
+                continue
+            new_value = new_measures[measure]
+            if value > 0:
+                change = 100.0 * (new_value - value) / value
+            else:
+                change = 0.0
+            if bigger_is_better:
+                worse = -change
+            else:
+                worse = change
+            mark = ""
+            if worse > args.threshold:
+                mark = "  <<< worse"
+                flagged += 1
+            print("%-12s %-18s %14.6g %14.6g %+8.1f%%%s" % (name, measure, value, new_value, change, mark))
+
+    if flagged:
+        print("%d regression(s) beyond %.1f%%" % (flagged, args.threshold))
+        return 1
+    print("no regressions beyond %.1f%%" % args.threshold)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ob1 machine.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="run the benchmarks and write JSON")
+    run_parser.add_argument("--out", help="JSON file for the results (default: the screen)")
+    run_parser.add_argument("--only", nargs="+", help="just these benchmarks")
+    run_parser.add_argument("--min-time", type=float, default=0.5,
+                            help="seconds to run each backend for (default 0.5)")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="measurements per backend, best kept (default 3)")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=10.0,
+                                help="percent worse that counts as a regression (default 10)")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        return func_run(args)
+    return func_compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
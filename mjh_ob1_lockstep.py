@@ -0,0 +1,210 @@
+#  MJH One-Bit Machine Type 01 - lockstep runner
+#
+#############################################################################
+#
+#  Runs ONE "ob1" program on thousands of machines at once, each with its
+#  own data field, pointer and flag. Needs NumPy.
+#
+#      import mjh_ob1, mjh_ob1_lockstep
+#      m = mjh_ob1.Machine()
+#      m.load("scan.ob1")
+#      result = mjh_ob1_lockstep.func_run_lockstep(m, fields, memx=0, memy=0,
+#                                                  flag=0, max_steps=10000)
+#
+#  fields is an (N, height, width) array of 0s and 1s (bool or uint8),
+#  indexed fields[machine, memy, memx]; row 0 is the BOTTOM row and
+#  column 0 the left, the same as the pointer. memx, memy, flag and pc
+#  can be single numbers (the same for every machine) or arrays of N.
+#
+#  The result is a dictionary of arrays, one entry per machine:
+#
+#      "fields", "memx", "memy", "flag", "program_counter", "steps"
+#      "exception"  - list of the exception strings the console would show
+#
+#  Every machine ends up exactly where Machine.run() would have left it,
+#  with the same step count.
+#
+#  How it works: on every step all running machines are grouped by their
+#  program counter. Each group executes its one instruction with array
+#  operations (conditions become boolean masks), so the cost of a step
+#  depends on how many different places in the program the machines are
+#  at, not on how many machines there are. A machine drops out on halt,
+#  at the end of the tape, on "data pointer out of range" or "tag not
+#  found", and the rest carry on.
+#
+#############################################################################
+
+import sys
+
+import numpy as np
+
+_exceptions = [
+    "step limit",                        # 0
+    "halt",                              # 1
+    "Program terminated normally",       # 2
+    "data pointer out of range",         # 3
+    "tag not found",                     # 4
+    "no program loaded",                 # 5
+    "what happened???",                  # 6
+]
+
+RUNNING = -1
+HALT = 1
+TERMINATED = 2
+OUT_OF_RANGE = 3
+TAG_NOT_FOUND = 4
+NO_PROGRAM = 5
+WHAT_HAPPENED = 6
+
+def func_lanes(value, lanes, dtype):
+    return np.array(np.broadcast_to(np.asarray(value, dtype=dtype), (lanes,)))
+
+#  Executes the instruction code[pc] on the machines in idx (all of them
+#  are at that pc).
+def func_lockstep_instruction(instruction, idx, fields, memx, memy, flag, pc, stop):
+    cond, op, arg = instruction
+    height = fields.shape[1]
+    width = fields.shape[2]
+
+    if cond:
+        if cond == 1 or cond == 2:
+            taken = fields[idx, memy[idx], memx[idx]] == (cond - 1)
+        else:
+            taken = flag[idx] == (cond - 3)
+        pc[idx[~taken]] += 1
+        idx = idx[taken]
+        if idx.size == 0:
+            return
+
+    if op == 16:                         #### adv/ret
+        if arg < 0:
+            stop[idx] = TAG_NOT_FOUND
+        else:
+            pc[idx] = arg
+        return
+
+    if op <= 3:                          #### r, l, u, d
+        if op == 0:
+            edge = memx[idx] == width - 1
+        elif op == 1:
+            edge = memx[idx] == 0
+        elif op == 2:
+            edge = memy[idx] == height - 1
+        else:
+            edge = memy[idx] == 0
+        stop[idx[edge]] = OUT_OF_RANGE
+        idx = idx[~edge]
+        if op == 0:
+            memx[idx] += 1
+        elif op == 1:
+            memx[idx] -= 1
+        elif op == 2:
+            memy[idx] += 1
+        else:
+            memy[idx] -= 1
+        pc[idx] += 1
+        return
+
+    if op == 6:                          #### sk
+        pc[idx] += 2
+        return
+
+    pc[idx] += 1
+    if op == 17:                         #### tag
+        pass
+    elif op == 4:                        #### h
+        memx[idx] = 0
+        memy[idx] = 0
+    elif op == 5:                        #### x
+        stop[idx] = HALT
+    elif op == 7:                        #### ex
+        data_bits = fields[idx, memy[idx], memx[idx]]
+        fields[idx, memy[idx], memx[idx]] = flag[idx]
+        flag[idx] = data_bits
+    elif op == 8:                        #### df
+        fields[idx, memy[idx], memx[idx]] = flag[idx]
+    elif op == 9:                        #### dc
+        fields[idx, memy[idx], memx[idx]] ^= 1
+    elif op == 10:                       #### d0
+        fields[idx, memy[idx], memx[idx]] = 0
+    elif op == 11:                       #### d1
+        fields[idx, memy[idx], memx[idx]] = 1
+    elif op == 12:                       #### fd
+        flag[idx] = fields[idx, memy[idx], memx[idx]]
+    elif op == 13:                       #### fc
+        flag[idx] ^= 1
+    elif op == 14:                       #### f0
+        flag[idx] = 0
+    else:                                #### f1
+        flag[idx] = 1
+
+def func_run_lockstep(m, fields, memx=0, memy=0, flag=0, pc=None, max_steps=None):
+    code = m.code
+    proglist_length = len(code)
+
+    if not m.field.bounded:
+        raise ValueError("lockstep runs need a data field with edges")
+
+    fields = np.array(fields, dtype=np.uint8)
+    if fields.ndim != 3:
+        raise ValueError("fields must be an (N, height, width) array")
+    lanes = fields.shape[0]
+    if fields.shape[1] != m.field.height or fields.shape[2] != m.field.width:
+        raise ValueError("fields must be %d x %d" % (m.field.height, m.field.width))
+
+    memx = func_lanes(memx, lanes, np.int64)
+    memy = func_lanes(memy, lanes, np.int64)
+    flag = func_lanes(flag, lanes, np.uint8)
+    if pc is None:
+        pc = func_lanes(0, lanes, np.int64)
+    else:
+        pc = func_lanes(pc, lanes, np.int64)
+    steps = np.zeros(lanes, dtype=np.int64)
+    stop = np.full(lanes, RUNNING, dtype=np.int8)
+
+    #  The same checks as Machine.start_check, machine by machine.
+    if proglist_length == 0:
+        stop[:] = NO_PROGRAM
+    else:
+        stop[pc < 0] = WHAT_HAPPENED
+        pc[pc >= proglist_length] = 0
+
+    if max_steps is None:
+        limit = sys.maxsize
+    else:
+        limit = max_steps
+
+    step = 0
+    while step < limit:
+        alive = np.flatnonzero(stop == RUNNING)
+        if alive.size == 0:
+            break
+        step += 1
+        steps[alive] += 1
+
+        #  Group the running machines by program counter.
+        here = pc[alive]
+        order = np.argsort(here, kind="stable")
+        alive = alive[order]
+        here = here[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(here)) + 1))
+        ends = np.concatenate((starts[1:], [alive.size]))
+
+        for start, end in zip(starts, ends):
+            func_lockstep_instruction(code[int(here[start])], alive[start:end],
+                                      fields, memx, memy, flag, pc, stop)
+
+        finished = ((stop == RUNNING) | (stop == HALT)) & (pc >= proglist_length)
+        stop[finished] = TERMINATED
+
+    stop[stop == RUNNING] = 0            # step limit
+
+    return {
+        "fields": fields,
+        "memx": memx,
+        "memy": memy,
+        "flag": flag,
+        "program_counter": pc,
+        "steps": steps,
+        "exception": [_exceptions[code_number] for code_number in stop],
+    }
@@ -0,0 +1,278 @@
+#  MJH One-Bit Machine Type 01 - machine server
+#
+#############################################################################
+#
+#  Keeps any number of machines in one process and lets other programs
+#  drive them over a local socket, one line of text per command.
+#
+#      python mjh_ob1_server.py --port 7101
+#      python mjh_ob1_server.py --unix /tmp/ob1.sock
+#
+#  Each command line is the name of a machine, a space, and then a
+#  command the way it is typed at the console:
+#
+#      a "scan.ob1"       load a program (also: a load scan.ob1)
+#      a l3               move the pointer (l, r, u, d, with a count)
+#      a h                pointer home
+#      a 0110             data bits at the pointer
+#      a f                flip the flag
+#      a s                one step
+#      a run              run to the end (also: just "a", like ENTER)
+#      a run 5000         run at most 5000 steps
+#      a stop             stop a run that is going on
+#      a state            send the whole state again
+#      a drop             throw the machine away
+#      list               the names of all the machines
+#
+#  A machine is made (with an empty field) the first time its name is
+#  used. Commands for one machine are done in the order they came (any
+#  still waiting when it is dropped get an error), but
+#  a long run on one machine doesn't hold up any other: runs go
+#  --slice instructions at a time, letting the other machines (and other
+#  clients) have a turn in between.
+#
+#  Every command is answered with one line of JSON. Instead of the whole
+#  screen it holds only what changed since the last answer this client
+#  got for that machine (everything, the first time):
+#
+#      {"machine": "a", "exception": "halt", "steps": 41,
+#       "program_counter": 6, "memx": 9, "rows": {"0": "1001110..."}}
+#
+#  "rows" maps row numbers (0 = bottom) to the row as "0"s and "1"s.
+#  "steps" is how many instructions the command ran. A command that
+#  can't be done gets {"machine": ..., "error": ...}.
+#
+#############################################################################
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+import mjh_ob1
+
+#  One machine, with what the server needs to share it.
+class Host:
+
+    def __init__(self, name, width, height):
+        self.name = name
+        self.m = mjh_ob1.Machine(mjh_ob1.Field(width, height))
+        self.lock = asyncio.Lock()
+        self.stopping = False
+        self.dropped = False
+
+class Server:
+
+    #  slice is how many instructions a run goes before letting anything
+    #  else have a turn.
+    def __init__(self, width=16, height=16, slice=10000):
+        self.width = width
+        self.height = height
+        self.slice = slice
+        self.hosts = {}
+
+    def host(self, name):
+        host = self.hosts.get(name)
+        if host is None:
+            host = Host(name, self.width, self.height)
+            self.hosts[name] = host
+        return host
+
+    async def run(self, host, max_steps):
+        m = host.m
+        host.stopping = False
+        steps = 0
+        while True:
+            chunk = self.slice
+            if max_steps is not None and max_steps - steps < chunk:
+                chunk = max_steps - steps
+            exception = m.run(max_steps=chunk).reason
+            steps += m.steps
+            if exception != "step limit":
+                break
+            if max_steps is not None and steps >= max_steps:
+                break
+            await asyncio.sleep(0)
+            if host.stopping or host.dropped:
+                exception = "stopped"
+                break
+        m.steps = steps
+        m.exception = exception
+
+    #  Reading and parsing a program (a big one, or one not in the cache)
+    #  is done on a thread, so the other machines go on meanwhile.
+    async def load(self, m, path):
+        await asyncio.get_running_loop().run_in_executor(None, m.load, path)
+
+    #  Does one console style command on host's machine. Returns an error
+    #  message, or None.
+    async def command(self, host, console_cmd):
+        m = host.m
+        m.exception = "ok"
+        m.steps = 0
+        cmd = console_cmd[: 1]
+        if console_cmd == "" or console_cmd == "run":
+            await self.run(host, None)
+        elif console_cmd.startswith("run "):
+            try:
+                max_steps = int(console_cmd[4 :])
+            except ValueError:
+                return "bad step count"
+            if max_steps < 1:
+                return "bad step count"
+            await self.run(host, max_steps)
+        elif console_cmd.startswith("load "):
+            await self.load(m, console_cmd[5 :].strip())
+        elif cmd in ("l", "r", "u", "d"):
+            if console_cmd[1 :] != "" and not console_cmd[1 :].isdigit():
+                return "bad count"
+            m.move(cmd, mjh_ob1.func_get_number(console_cmd))
+        elif console_cmd == "h":
+            m.home()
+        elif console_cmd == "f":
+            m.toggle_flag()
+        elif cmd in ("0", "1"):
+            if console_cmd.strip("01") != "":
+                return "bad data bits"
+            m.data_bits(console_cmd)
+        elif console_cmd == "s":
+            m.step()
+        elif cmd == '"' and console_cmd.endswith('"') and len(console_cmd) > 1:
+            await self.load(m, console_cmd[1 : -1])
+        elif console_cmd == "state":
+            pass
+        else:
+            return "unknown command"
+        return None
+
+    async def client(self, reader, writer):
+        sent = {}
+        tasks = set()
+        try:
+            while True:
+                xline = await reader.readline()
+                if xline == b"":
+                    break
+                xline = xline.decode("utf-8", "replace").strip()
+                if xline == "":
+                    continue
+                task = asyncio.ensure_future(self.line(xline, sent, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    #  Does one line from a client and writes the answer.
+    async def line(self, xline, sent, writer):
+        name, _, console_cmd = xline.partition(" ")
+        console_cmd = console_cmd.strip()
+        if name == "list" and console_cmd == "":
+            answer = {"machines": sorted(self.hosts)}
+        elif console_cmd == "stop":
+            host = self.hosts.get(name)
+            if host is not None:
+                host.stopping = True
+            answer = {"machine": name}
+        elif console_cmd == "drop":
+            #  A run going on stops at its next slice, and commands still
+            #  waiting for the machine find it dropped; the field is only
+            #  closed once nothing is using it.
+            host = self.hosts.pop(name, None)
+            if host is not None:
+                host.stopping = True
+                host.dropped = True
+                async with host.lock:
+                    host.m.field.close()
+            sent.pop(name, None)
+            answer = {"machine": name, "dropped": host is not None}
+        else:
+            host = self.host(name)
+            async with host.lock:
+                if host.dropped:
+                    error = "machine was dropped"
+                else:
+                    if console_cmd == "state":
+                        sent.pop(name, None)
+                    error = await self.command(host, console_cmd)
+                if error is None:
+                    answer = func_delta(name, host.m, sent.get(name))
+                    sent[name] = func_snapshot(host.m)
+                else:
+                    answer = {"machine": name, "error": error}
+        writer.write((json.dumps(answer) + "\n").encode("utf-8"))
+        #  Waits while a slow client lets answers pile up, so they can't
+        #  fill memory. A client that has gone just misses its answer.
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+#  What a client has been told about a machine, to work out the next
+#  delta from.
+def func_snapshot(m):
+    return (m.exception, m.program_counter, m.memx, m.memy, m.flag, m.field.copy_bits())
+
+#  Only the parts of m that are not as in snapshot (all of them if
+#  snapshot is None). "exception" and "steps" are always there.
+def func_delta(name, m, snapshot):
+    delta = {"machine": name, "exception": m.exception, "steps": m.steps}
+    if snapshot is None:
+        snapshot = (None, None, None, None, None, None)
+    if m.program_counter != snapshot[1]:
+        delta["program_counter"] = m.program_counter
+    if m.memx != snapshot[2]:
+        delta["memx"] = m.memx
+    if m.memy != snapshot[3]:
+        delta["memy"] = m.memy
+    if m.flag != snapshot[4]:
+        delta["flag"] = m.flag
+    bits = m.field.copy_bits()
+    old_bits = snapshot[5]
+    rows = {}
+    y = 0
+    while y < m.field.height:
+        if old_bits is None or bits[y] != old_bits[y]:
+            rows[str(y)] = m.field.row_bits(y)
+        y += 1
+    if rows:
+        delta["rows"] = rows
+    return delta
+
+async def func_serve(server, host, port, unix_path):
+    if unix_path is not None:
+        listener = await asyncio.start_unix_server(server.client, path=unix_path)
+        print(">>> Listening on", unix_path, file=sys.stderr)
+    else:
+        listener = await asyncio.start_server(server.client, host, port)
+        print(">>> Listening on %s port %d" % (host, port), file=sys.stderr)
+    async with listener:
+        await listener.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve ob1 machines over a local socket.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7101)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead")
+    parser.add_argument("--width", type=int, default=16, help="width of each data field")
+    parser.add_argument("--height", type=int, default=16, help="height of each data field")
+    parser.add_argument("--slice", type=int, default=10000,
+                        help="instructions a run goes before the others get a turn")
+    args = parser.parse_args(argv)
+
+    if args.slice < 1:
+        parser.error("--slice must be at least 1")
+    server = Server(args.width, args.height, args.slice)
+    try:
+        asyncio.run(func_serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.unix is not None and os.path.exists(args.unix):
+            os.remove(args.unix)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+#  MJH One-Bit Machine Type 01 - superoptimizer
+#
+#############################################################################
+#
+#  Looks for shorter runs of instructions that do exactly what a given
+#  run does, and writes what it finds as rewrite rules for the loader
+#  (see "Rewrite rules" in mjh_ob1.py).
+#
+#      python mjh_ob1_superopt.py --fragment "exec,f0; exec,fc"
+#      python mjh_ob1_superopt.py copy.ob1 --window 4 --rules ob1.rules
+#      python mjh_ob1.py --rules ob1.rules
+#
+#  With --fragment the one run given is looked at. With a program file
+#  every run of 2 thru --window straight-line instructions in it is (a
+#  run that a shorter one inside it already covers is skipped). Only
+#  straight-line instructions are used or looked for: "exec,", "ifd0,",
+#  "ifd1,", "iff0," and "iff1," with any operation but "h", "x" and "sk".
+#  A run with a move in it is skipped, as the loader never uses such a
+#  rule.
+#
+#  How it works:
+#
+#  1. Every sequence of up to --max-length instructions is run from a
+#     set of --tests random starting points (a random patch of field
+#     round the pointer, a random flag, and edges of the field at random
+#     small distances, or none), and what it does (where the pointer
+#     ends up, the flag, the cells it changes, or running off an edge)
+#     is its fingerprint. The search goes one length at a time and only
+#     grows sequences with a fingerprint not seen before, so of all the
+#     sequences that do the same thing only the first is ever grown.
+#     Each length is spread over a process pool.
+#
+#  2. A sequence with the same fingerprint as the run being looked at is
+#     then checked for every starting point that can matter: each
+#     distance (0 thru the length, or none) to each edge the two could
+#     move towards, and every bit of every cell and the flag the two
+#     read or write, found one at a time as they are needed. Only a
+#     sequence that does exactly the same thing from all of them (or
+#     runs off the same edge with everything else the same) becomes a
+#     rule.
+#
+#############################################################################
+
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import random
+import sys
+
+import mjh_ob1
+
+#  Every straight-line instruction code.
+_alphabet = [code for code in range(176, 256) if mjh_ob1.func_straight_line(code)]
+
+#  The test starting points, for this process.
+_tests = []
+
+def func_init_worker(tests):
+    _tests[:] = tests
+
+#  Runs seq (a tuple of codes) from a starting point: edges is (left,
+#  right, down, up), each the distance from the pointer to that edge or
+#  None, and inputs maps "flag" and (x, y) cells (the pointer starts at
+#  0, 0) to bits. Returns what it did as (ran off an edge, x, y, flag,
+#  the changed cells), or ("need", key) if it needs a bit not in inputs.
+def func_simulate(seq, edges, inputs):
+    left, right, down, up = edges
+    x = 0
+    y = 0
+    flag = inputs.get("flag")
+    if flag is None:
+        return ("need", "flag")
+    cells = {}
+    error = False
+    for code in seq:
+        cond = (code >> 4) - 11
+        op = code & 15
+        data = 0
+        if cond == 1 or cond == 2 or 7 <= op <= 12:
+            key = (x, y)
+            if key in cells:
+                data = cells[key]
+            elif key in inputs:
+                data = inputs[key]
+            else:
+                return ("need", key)
+
+        if not (cond == 0
+                or (cond == 1 and not data)
+                or (cond == 2 and data)
+                or (cond == 3 and not flag)
+                or (cond == 4 and flag)):
+            continue
+
+        if op == 0:
+            if x == right:
+                error = True
+                break
+            x += 1
+        elif op == 1:
+            if left is not None and x == -left:
+                error = True
+                break
+            x -= 1
+        elif op == 2:
+            if y == up:
+                error = True
+                break
+            y += 1
+        elif op == 3:
+            if down is not None and y == -down:
+                error = True
+                break
+            y -= 1
+        elif op == 7:
+            cells[(x, y)] = flag
+            flag = data
+        elif op == 8:
+            cells[(x, y)] = flag
+        elif op == 9:
+            cells[(x, y)] = 1 - data
+        elif op == 10:
+            cells[(x, y)] = 0
+        elif op == 11:
+            cells[(x, y)] = 1
+        elif op == 12:
+            flag = data
+        elif op == 13:
+            flag = 1 - flag
+        elif op == 14:
+            flag = 0
+        elif op == 15:
+            flag = 1
+
+    changed = tuple(sorted((key, bit) for key, bit in cells.items() if bit != inputs[key]))
+    return (error, x, y, flag, changed)
+
+#  count random starting points, each with every cell within radius of
+#  the pointer filled in.
+def func_make_tests(count, radius, seed):
+    rng = random.Random(seed)
+    tests = []
+    i = 0
+    while i < count:
+        edges = tuple(None if rng.random() < 0.5 else rng.randrange(radius) for side in range(4))
+        if i == 0:
+            edges = (None, None, None, None)
+        inputs = {"flag": rng.randrange(2)}
+        for x in range(-radius, radius + 1):
+            for y in range(-radius, radius + 1):
+                inputs[(x, y)] = rng.randrange(2)
+        tests.append((edges, inputs))
+        i += 1
+    return tests
+
+#  A digest of what seq does from every test starting point. (Not
+#  hash(): before Python 3.12 hash(None) differs from one process to
+#  the next, and fingerprints are compared across the worker pool.)
+def func_fingerprint(seq):
+    results = tuple(func_simulate(seq, edges, inputs) for edges, inputs in _tests)
+    return hashlib.blake2b(repr(results).encode(), digest_size=16).digest()
+
+#  One chunk of the search: grows each sequence in prefixes by every
+#  instruction. Returns (fingerprint, sequence) for the first sequence of
+#  each fingerprint in the chunk.
+def func_grow(prefixes):
+    found = {}
+    for prefix in prefixes:
+        for code in _alphabet:
+            seq = prefix + (code,)
+            fingerprint = func_fingerprint(seq)
+            if fingerprint not in found:
+                found[fingerprint] = seq
+    return list(found.items())
+
+#  Step 1. Returns a dictionary from fingerprint to the shortest
+#  sequences found with it (up to keep of them).
+def func_search(max_length, tests, workers, keep=4, verbose=True):
+    func_init_worker(tests)
+    table = {func_fingerprint(()): [()]}
+    level = [()]
+    length = 1
+    executor = None
+    if workers != 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=func_init_worker,
+                                                          initargs=(tests,))
+    try:
+        while length <= max_length and level:
+            chunk_size = max(1, min(64, len(level) // ((workers or os.cpu_count() or 1) * 4) or 1))
+            chunks = [level[i : i + chunk_size] for i in range(0, len(level), chunk_size)]
+            if executor is None:
+                results = map(func_grow, chunks)
+            else:
+                results = executor.map(func_grow, chunks)
+            next_level = []
+            for found in results:
+                for fingerprint, seq in found:
+                    sequences = table.get(fingerprint)
+                    if sequences is None:
+                        table[fingerprint] = [seq]
+                        next_level.append(seq)
+                    elif len(sequences) < keep and len(sequences[0]) == len(seq):
+                        sequences.append(seq)
+            if verbose:
+                print(">>> Length %d: %d sequences grown, %d new" % (length, len(level) * len(_alphabet),
+                      len(next_level)), file=sys.stderr)
+            level = next_level
+            length += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return table
+
+#  Step 2. True if a and b do exactly the same thing from every starting
+#  point that can matter.
+def func_equivalent(a, b):
+    size = max(len(a), len(b))
+    ops = set(code & 15 for code in a + b)
+    near = list(range(size)) + [None]
+    sides = [near if op in ops else [None] for op in (1, 0, 3, 2)]
+    for edges in itertools.product(*sides):
+        stack = [{"flag": 0}, {"flag": 1}]
+        while stack:
+            inputs = stack.pop()
+            result_a = func_simulate(a, edges, inputs)
+            result_b = func_simulate(b, edges, inputs)
+            need = None
+            if result_a[0] == "need":
+                need = result_a[1]
+            elif result_b[0] == "need":
+                need = result_b[1]
+            if need is not None:
+                for bit in (0, 1):
+                    more = dict(inputs)
+                    more[need] = bit
+                    stack.append(more)
+            elif result_a != result_b:
+                return False
+    return True
+
+#  The shortest sequence found that is exactly the same as target, or
+#  None.
+def func_best(table, target):
+    fingerprint = func_fingerprint(target)
+    for seq in table.get(fingerprint, []):
+        if len(seq) < len(target) and func_equivalent(seq, target):
+            return seq
+    return None
+
+#  The runs to look at in a program: every run of 2 thru window
+#  straight-line instructions, shortest first, each once.
+def func_windows(proglist, window):
+    windows = []
+    seen = set()
+    size = 2
+    while size <= window:
+        i = 0
+        while i + size <= len(proglist):
+            run = tuple(proglist[i : i + size])
+            if run not in seen and all(mjh_ob1.func_straight_line(code) for code in run):
+                seen.add(run)
+                windows.append(run)
+            i += 1
+        size += 1
+    return windows
+
+#  Adds rules to filename (made if need be), leaving out any whose
+#  pattern is already there. Returns how many were added.
+def func_write_rules(filename, rules):
+    old = set()
+    if os.path.exists(filename):
+        old = set(pattern for pattern, replacement in mjh_ob1.func_read_rules(filename))
+    new = [rule for rule in rules if rule[0] not in old]
+    if new:
+        with open(filename, "a") as rule_file:
+            if not old:
+                rule_file.write("#  ob1 rewrite rules (see mjh_ob1_superopt.py)\n")
+            for pattern, replacement in new:
+                rule_file.write(mjh_ob1.func_format_rule(pattern, replacement) + "\n")
+    return len(new)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find shorter ob1 instruction sequences.")
+    parser.add_argument("program", nargs="?", help="ob1 program to look for runs in")
+    parser.add_argument("--fragment", help='one run to look at, such as "exec,f0; exec,fc"')
+    parser.add_argument("--window", type=int, default=3,
+                        help="longest run of a program to look at (default 3)")
+    parser.add_argument("--max-length", type=int, default=None,
+                        help="longest sequence to try (default one less than the longest run, at most 3)")
+    parser.add_argument("--tests", type=int, default=64, help="random starting points (default 64)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rules", metavar="FILE", help="rule file to add what is found to")
+    args = parser.parse_args(argv)
+
+    if (args.program is None) == (args.fragment is None):
+        parser.error("give a program or --fragment (not both)")
+    if args.fragment is not None:
+        try:
+            targets = [mjh_ob1.func_parse_rule_side(args.fragment)]
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        proglist = []
+        if mjh_ob1.func_read_prog(args.program, proglist, verbose=False, cache=False) != 0:
+            print(">>>", '"' + args.program + '"', "can't be loaded", file=sys.stderr)
+            return 5
+        targets = func_windows(proglist, args.window)
+    targets = [target for target in targets if len(target) > 0 and not mjh_ob1.func_has_moves(target)]
+    if not targets:
+        print(">>> Nothing to look at", file=sys.stderr)
+        return 0
+
+    longest = max(len(target) for target in targets)
+    max_length = args.max_length
+    if max_length is None:
+        max_length = min(longest - 1, 3)
+    tests = func_make_tests(args.tests, max(longest, max_length), args.seed)
+    table = func_search(max_length, tests, args.workers)
+
+    rules = []
+    for target in targets:
+        covered = False
+        for pattern, replacement in rules:
+            i = 0
+            while i + len(pattern) <= len(target):
+                if target[i : i + len(pattern)] == pattern:
+                    covered = True
+                i += 1
+        if covered:
+            continue
+        best = func_best(table, target)
+        if best is not None:
+            rules.append((target, best))
+            print(mjh_ob1.func_format_rule(target, best))
+
+    print(">>> %d rule(s) found in %d run(s)" % (len(rules), len(targets)), file=sys.stderr)
+    if args.rules is not None and rules:
+        try:
+            added = func_write_rules(args.rules, rules)
+        except (OSError, ValueError) as error:
+            print(">>>", error, file=sys.stderr)
+            return 5
+        print(">>> %d rule(s) added to %s" % (added, args.rules), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
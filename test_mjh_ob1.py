@@ -0,0 +1,675 @@
+#  MJH One-Bit Machine Type 01 - tests
+#
+#############################################################################
+#
+#  Randomized checks that the fast ways of running a program give
+#  exactly what the plain run loop (or, for the run loop itself, a
+#  straight reading of the language description) gives.
+#
+#      python -m pytest -q
+#
+#############################################################################
+
+import collections
+import json
+import os
+import random
+
+import pytest
+
+import mjh_ob1
+
+#  A random tape: mostly executable instructions, with tags, adv and ret
+#  on a few tag ids so jumps are found (and sometimes not).
+def func_random_program(rng, length):
+    proglist = []
+    while len(proglist) < length:
+        chance = rng.random()
+        if chance < 0.15:
+            proglist.append(128 + rng.randrange(3))
+        elif chance < 0.3:
+            proglist.append(rng.choice([144, 160]) + rng.randrange(3))
+        else:
+            proglist.append(rng.randrange(176, 256))
+    return proglist
+
+#  A tape heavy in the runs the optimizer looks for.
+def func_run_program(rng, length):
+    proglist = []
+    while len(proglist) < length:
+        chance = rng.random()
+        if chance < 0.3:
+            proglist += [176 + rng.randrange(4)] * rng.randrange(1, 8)
+        elif chance < 0.5:
+            proglist += [rng.choice([189, 190, 191, 128 + rng.randrange(3)]) for i in range(rng.randrange(1, 5))]
+        elif chance < 0.65:
+            proglist += [rng.choice([185, 186, 187, 128 + rng.randrange(3)]) for i in range(rng.randrange(1, 5))]
+        elif rng.random() < 0.4:
+            proglist.append(rng.choice([128, 129, 130, 144, 145, 146, 160, 161, 162]))
+        else:
+            proglist.append(rng.randrange(176, 256))
+    return proglist
+
+#  A tape heavy in scan and fill loops.
+def func_idiom_program(rng, length):
+    proglist = []
+    while len(proglist) < length:
+        chance = rng.random()
+        tag = rng.randrange(4)
+        if chance < 0.25:
+            proglist += [128 + tag, rng.choice([198, 214]), rng.choice([144, 160]) + rng.randrange(5),
+                         176 + rng.randrange(4), rng.choice([144 + tag, 160 + tag])]
+        elif chance < 0.45:
+            proglist += [128 + tag, 176 + rng.choice([8, 10, 11]), 176 + rng.randrange(4),
+                         rng.choice([144 + tag, 160 + tag])]
+        else:
+            proglist += func_run_program(rng, rng.randrange(1, 6))
+    return proglist
+
+#  Random field, pointer, flag and program counter.
+def func_fill(m, rng):
+    m.field.rows[:] = [rng.getrandbits(m.field.width) for y in range(m.field.height)]
+    m.memx = rng.randrange(m.field.width)
+    m.memy = rng.randrange(m.field.height)
+    m.flag = rng.randrange(2)
+    m.program_counter = rng.randrange(len(m.proglist) + 1)
+
+def func_snap(m, result):
+    if not isinstance(result, str):
+        result = result.reason
+    return (result, m.program_counter, m.memx, m.memy, m.flag, list(m.field.rows), m.steps)
+
+def func_pair(proglist, seed, width=16, height=16):
+    machines = []
+    for i in range(2):
+        m = mjh_ob1.Machine(mjh_ob1.Field(width, height))
+        m.load(proglist)
+        func_fill(m, random.Random(seed))
+        machines.append(m)
+    return machines
+
+#  The language as described at the top of mjh_ob1.py, one instruction
+#  at a time, searching the tape for tags. Returns (exception, pc,
+#  memx, memy, flag, rows, steps) like func_snap.
+def func_reference_run(proglist, rows, width, height, memx, memy, flag, pc, max_steps, mode="run"):
+    rows = list(rows)
+    if len(proglist) == 0:
+        return ("no program loaded", pc, memx, memy, flag, rows, 0)
+    if pc >= len(proglist):
+        pc = 0
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        steps += 1
+        header = proglist[pc] >> 4
+        op = proglist[pc] & 15
+        bit = (rows[memy] >> memx) & 1
+        exception = None
+        if header == 9 or header == 10:
+            direction = 1 if header == 9 else -1
+            target = pc + direction
+            while 0 <= target < len(proglist) and proglist[target] != 128 + op:
+                target += direction
+            if 0 <= target < len(proglist):
+                pc = target - 1
+            else:
+                exception = "tag not found"
+        taken = (header == 11 or (header == 12 and not bit) or (header == 13 and bit)
+                 or (header == 14 and not flag) or (header == 15 and flag))
+        if taken:
+            if op == 0:
+                if memx == width - 1:
+                    exception = "data pointer out of range"
+                else:
+                    memx += 1
+            elif op == 1:
+                if memx == 0:
+                    exception = "data pointer out of range"
+                else:
+                    memx -= 1
+            elif op == 2:
+                if memy == height - 1:
+                    exception = "data pointer out of range"
+                else:
+                    memy += 1
+            elif op == 3:
+                if memy == 0:
+                    exception = "data pointer out of range"
+                else:
+                    memy -= 1
+            elif op == 4:
+                memx = 0
+                memy = 0
+            elif op == 5:
+                exception = "halt"
+            elif op == 6:
+                pc += 1
+            elif op == 7:
+                rows[memy] = rows[memy] & ~(1 << memx) | (flag << memx)
+                flag = bit
+            elif op == 8:
+                rows[memy] = rows[memy] & ~(1 << memx) | (flag << memx)
+            elif op == 9:
+                rows[memy] ^= 1 << memx
+            elif op == 10:
+                rows[memy] &= ~(1 << memx)
+            elif op == 11:
+                rows[memy] |= 1 << memx
+            elif op == 12:
+                flag = bit
+            elif op == 13:
+                flag = 1 - flag
+            elif op == 14:
+                flag = 0
+            elif op == 15:
+                flag = 1
+        if exception is None or exception == "halt":
+            pc += 1
+            if pc >= len(proglist):
+                exception = "Program terminated normally"
+        if exception is not None:
+            return (exception, pc, memx, memy, flag, rows, steps)
+        if mode == "step":
+            return ("step", pc, memx, memy, flag, rows, steps)
+    return ("step limit", pc, memx, memy, flag, rows, steps)
+
+def test_run_loop_matches_reference():
+    for seed in range(1500):
+        rng = random.Random(seed)
+        proglist = func_random_program(rng, rng.randrange(1, 40))
+        m = mjh_ob1.Machine()
+        m.load(proglist)
+        func_fill(m, rng)
+        mode = "step" if seed % 3 == 0 else "run"
+        want = func_reference_run(proglist, m.field.rows, 16, 16, m.memx, m.memy, m.flag,
+                                  m.program_counter, 2000, mode)
+        if mode == "step":
+            result = m.step()
+        else:
+            result = m.run(max_steps=2000)
+        assert func_snap(m, result) == want, (seed, proglist)
+
+#  table_min 0 makes every program dispatch through the table of block
+#  functions, 1000 makes every one use the binary search.
+@pytest.mark.parametrize("table_min", [None, 0, 1000])
+def test_compiled_matches_interpreter(table_min, monkeypatch):
+    if table_min is not None:
+        monkeypatch.setattr(mjh_ob1, "_compiled_table_min", table_min)
+        monkeypatch.setattr(mjh_ob1, "_compiled_programs", collections.OrderedDict())
+    limits = (20000, 1, 2, 3, 7, 50, 5000)
+    for seed in range(1500):
+        rng = random.Random(seed)
+        proglist = func_random_program(rng, rng.randrange(1, 40))
+        limit = limits[seed % len(limits)]
+        a, b = func_pair(proglist, seed)
+        want = func_snap(a, a.run(max_steps=limit))
+        assert func_snap(b, b.run(max_steps=limit, backend="compiled")) == want, (seed, proglist)
+
+def test_compiled_programs_are_bounded(monkeypatch):
+    monkeypatch.setattr(mjh_ob1, "_compiled_programs", collections.OrderedDict())
+    monkeypatch.setattr(mjh_ob1, "_compiled_keep", 3)
+    machines = []
+    for i in range(5):
+        m = mjh_ob1.Machine()
+        m.load([176] * (i + 1))
+        m.run(backend="compiled")
+        machines.append(m)
+    machines[2].run(backend="compiled")
+    assert len(mjh_ob1._compiled_programs) == 3
+    assert mjh_ob1.func_program_hash(machines[0].proglist) not in mjh_ob1._compiled_programs
+    machines[0].run(backend="compiled")
+    assert mjh_ob1.func_program_hash(machines[2].proglist) in mjh_ob1._compiled_programs
+    assert mjh_ob1.func_program_hash(machines[3].proglist) not in mjh_ob1._compiled_programs
+
+def test_lockstep_matches_machine():
+    np = pytest.importorskip("numpy")
+    import mjh_ob1_lockstep
+    lanes = 16
+    for seed in range(60):
+        rng = random.Random(seed)
+        proglist = func_random_program(rng, rng.randrange(1, 40))
+        m = mjh_ob1.Machine()
+        m.load(proglist)
+        fields = np.array([[[rng.randrange(2) for x in range(16)] for y in range(16)] for i in range(lanes)],
+                          dtype=np.uint8)
+        memx = np.array([rng.randrange(16) for i in range(lanes)])
+        memy = np.array([rng.randrange(16) for i in range(lanes)])
+        flag = np.array([rng.randrange(2) for i in range(lanes)])
+        pcs = np.array([rng.randrange(len(proglist) + 1) for i in range(lanes)])
+        limit = rng.choice([1, 5, 50, 3000])
+        result = mjh_ob1_lockstep.func_run_lockstep(m, fields, memx, memy, flag, pcs, max_steps=limit)
+        for i in range(lanes):
+            a = mjh_ob1.Machine()
+            a.load(proglist)
+            a.field.rows[:] = [int("".join(str(bit) for bit in fields[i, y][::-1]), 2) for y in range(16)]
+            a.memx, a.memy, a.flag, a.program_counter = int(memx[i]), int(memy[i]), int(flag[i]), int(pcs[i])
+            want = func_snap(a, a.run(max_steps=limit))
+            rows = [int("".join(str(bit) for bit in result["fields"][i, y][::-1]), 2) for y in range(16)]
+            got = (result["exception"][i], int(result["program_counter"][i]), int(result["memx"][i]),
+                   int(result["memy"][i]), int(result["flag"][i]), rows, int(result["steps"][i]))
+            assert got == want, (seed, i, proglist)
+
+#  Step by step every third time, otherwise one run with a step limit.
+def func_compare_optimized(proglist, seed, limit, width=16, height=16, rows=None):
+    a, b = func_pair(proglist, seed, width, height)
+    b.optimize()
+    if rows is not None:
+        a.field.rows[:] = rows
+        b.field.rows[:] = rows
+    if seed % 3 == 0:
+        i = 0
+        while i < limit:
+            want = func_snap(a, a.step())
+            assert func_snap(b, b.step()) == want, (seed, limit, proglist)
+            if want[0] != "step":
+                break
+            i += 1
+    else:
+        want = func_snap(a, a.run(max_steps=limit))
+        assert func_snap(b, b.run(max_steps=limit)) == want, (seed, limit, proglist)
+
+def test_optimized_matches_plain():
+    for seed in range(2000):
+        rng = random.Random(seed)
+        proglist = func_run_program(rng, rng.randrange(1, 40))
+        func_compare_optimized(proglist, seed, rng.choice([1, 2, 3, 5, 17, 200, 5000]))
+
+def test_idioms_match_plain():
+    for seed in range(2000):
+        rng = random.Random(seed)
+        proglist = func_idiom_program(rng, rng.randrange(1, 40))
+        limit = rng.choice([1, 2, 3, 4, 5, 6, 7, 9, 13, 17, 40, 200, 5000])
+        width = rng.choice([16, 16, 5, 70])
+        rows = None
+        if seed % 2:
+            #  Long runs of one bit, for the scans to go along.
+            rows = [0 if rng.random() < 0.5 else ((1 << width) - 1) ^ (1 << rng.randrange(width))
+                    for y in range(16)]
+        func_compare_optimized(proglist, seed, limit, width, 16, rows)
+
+def test_memo_matches_run():
+    for seed in range(300):
+        rng = random.Random(seed)
+        proglist = [rng.randrange(128, 256) for i in range(rng.randrange(3, 20))]
+        for field in (mjh_ob1.Field(4, 3), mjh_ob1.SparseField()):
+            memo = mjh_ob1.Memo()
+            a = mjh_ob1.Machine(field)
+            a.load(proglist)
+            b = a.fork()
+            for trial in range(20):
+                state = {"field": ["".join(rng.choice("01") for x in range(4)) for y in range(3)],
+                         "memx": 0, "memy": 0, "flag": rng.randrange(2), "program_counter": 0}
+                a.set_state(state)
+                b.set_state(state)
+                want = a.run(max_steps=60)
+                got = memo.run(b, 60)
+                assert (got.reason, got.steps, b.state()) == (want.reason, want.steps, a.state()), (seed, proglist)
+
+#  Rules as mjh_ob1_superopt.py finds them, including ones that take a
+#  run out altogether.
+_rules = [
+    ((183, 183), ()),          # exec,ex; exec,ex  =>
+    ((185, 185), ()),          # exec,dc; exec,dc  =>
+    ((190, 189), (191,)),      # exec,f0; exec,fc  =>  exec,f1
+    ((188, 184), (188,)),      # exec,fd; exec,df  =>  exec,fd
+    ((251, 234), (184,)),      # iff1,d1; iff0,d0  =>  exec,df
+]
+
+def test_rules_keep_behaviour():
+    codes = [code for code in range(176, 256) if mjh_ob1.func_straight_line(code)]
+    rewritten = 0
+    for seed in range(3000):
+        rng = random.Random(seed)
+        proglist = []
+        while len(proglist) < rng.randrange(1, 30):
+            chance = rng.random()
+            if chance < 0.4:
+                proglist += list(rng.choice(_rules)[0])
+            elif chance < 0.55:
+                proglist.append(rng.choice([181, 213, 245]))
+            elif chance < 0.8:
+                proglist.append(rng.choice(codes))
+            else:
+                proglist.append(rng.randrange(128, 256))
+        a = mjh_ob1.Machine(mjh_ob1.Field(8, 8))
+        b = mjh_ob1.Machine(mjh_ob1.Field(8, 8))
+        b.rules = _rules
+        a.load(proglist)
+        b.load(proglist)
+        assert len(b.proglist) > 0
+        rewritten += len(b.proglist) < len(a.proglist)
+        state = {"field": ["".join(rng.choice("01") for x in range(8)) for y in range(8)],
+                 "memx": rng.randrange(8), "memy": rng.randrange(8), "flag": rng.randrange(2),
+                 "program_counter": 0}
+        a.set_state(state)
+        b.set_state(state)
+        want = a.run(max_steps=20000)
+        got = b.run(max_steps=20000)
+        if want.reason == "step limit":
+            continue
+        want_state = a.state()
+        got_state = b.state()
+        del want_state["program_counter"], got_state["program_counter"]
+        assert got.reason == want.reason, (seed, proglist)
+        assert got_state == want_state, (seed, proglist)
+        assert got.steps <= want.steps
+    assert rewritten > 0
+
+def test_rules_with_moves_are_not_used():
+    #  exec,r; exec,f1; exec,l; exec,r  =>  exec,r; exec,f1 runs off the
+    #  same edge, but a stop at its last "r" could not be carried on.
+    rule = ((176, 191, 177, 176), (176, 191))
+    proglist = [190, 176, 191, 177, 176, 183]
+    m = mjh_ob1.Machine(mjh_ob1.Field(8, 8))
+    m.rules = [rule] + _rules
+    m.load(proglist)
+    assert m.proglist == proglist
+
+def func_trace_fields(tmp_path, seed):
+    return [mjh_ob1.Field(8, 8), mjh_ob1.MappedField(str(tmp_path / ("f%d.bits" % seed)), 8, 8),
+            mjh_ob1.SparseField()]
+
+def func_trace_state(m):
+    state = m.state()
+    del state["program_counter"], state["exception"]
+    return state
+
+def test_step_back_matches_history(tmp_path):
+    for seed in range(40):
+        rng = random.Random(seed)
+        proglist = func_random_program(rng, rng.randrange(5, 40))
+        for field in func_trace_fields(tmp_path, seed):
+            m = mjh_ob1.Machine(field)
+            m.load(proglist)
+            m.set_state({"field": ["".join(rng.choice("01") for x in range(8)) for y in range(8)],
+                         "memx": 4, "memy": 4, "flag": 0, "program_counter": 0})
+            trace = mjh_ob1.Trace(size=256, interval=16)
+            history = {0: func_trace_state(m)}
+            tries = 0
+            while trace.steps < 300 and tries < 400:
+                if rng.random() < 0.7:
+                    m.step([trace])
+                else:
+                    m.run(max_steps=rng.randrange(1, 40), watchers=[trace])
+                history[trace.steps] = func_trace_state(m)
+                tries += 1
+            for back in range(10):
+                m.step_back(trace, rng.randrange(1, 30))
+                if trace.steps in history:
+                    assert func_trace_state(m) == history[trace.steps], (seed, proglist, trace.steps, type(field))
+            field.close()
+
+def test_single_steps_keep_few_checkpoints(tmp_path):
+    for field in func_trace_fields(tmp_path, 0):
+        m = mjh_ob1.Machine(field)
+        m.load([128, 185, 160])
+        trace = mjh_ob1.Trace(size=1024, interval=4096)
+        history = []
+        for i in range(500):
+            history.append(func_trace_state(m))
+            m.step([trace])
+        assert len(trace.checkpoints) == 1
+        assert field.dense or trace.checkpoints[0][5] is None
+        m.step_back(trace, 8)
+        assert trace.steps == 492
+        assert func_trace_state(m) == history[492]
+        field.close()
+
+def test_damaged_cache_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(mjh_ob1, "_cache_dir", str(tmp_path / "cache"))
+    prog_name = str(tmp_path / "prog.ob1")
+    with open(prog_name, "w") as prog_file:
+        prog_file.write("tag,0\nexec,dc\n\nexec,r\nret,0\n")
+    want = []
+    assert mjh_ob1.func_read_prog(prog_name, want, verbose=False) == 0
+    cache_name = mjh_ob1.func_cache_file(prog_name)
+    with open(cache_name, "rb") as cache_file:
+        good = cache_file.read()
+    header, newline, body = good.partition(b"\n")
+    for damaged in (good[:-1], good[:-5], good + b"\0", header[:-1] + b"x\n" + body,
+                    header[:-1] + b"9\n" + body, header + b"\n" + b"\0" + body[1:]):
+        with open(cache_name, "wb") as cache_file:
+            cache_file.write(damaged)
+        proglist = []
+        linenos = []
+        assert mjh_ob1.func_read_prog(prog_name, proglist, verbose=False, linenos=linenos) == 0
+        assert (proglist, list(linenos)) == (want, [1, 2, 4, 5])
+    assert os.listdir(str(tmp_path / "cache")) == [os.path.basename(cache_name)]
+
+def test_damaged_tape_is_refused(tmp_path):
+    rng = random.Random(1)
+    proglist = func_random_program(rng, 50)
+    tape_name = str(tmp_path / "prog.ob1b")
+    mjh_ob1.func_write_tape(tape_name, proglist)
+    tape, jumps = mjh_ob1.func_read_tape(tape_name)
+    assert list(tape) == proglist
+    assert list(jumps) == mjh_ob1.func_tag_table(proglist)
+    del tape, jumps
+    with open(tape_name, "rb") as tape_file:
+        good = tape_file.read()
+    tag_index = mjh_ob1._tape_header.unpack_from(good)[4]
+    #  Every wrong place an "adv,"/"ret," entry could point: off either
+    #  end, at itself, at anything but a tag with its id, or the wrong
+    #  way.
+    jumps = mjh_ob1.func_tag_table(proglist)
+    checked = 0
+    for pc in range(len(proglist)):
+        if not 144 <= proglist[pc] < 176:
+            continue
+        tag = 128 + (proglist[pc] & 15)
+        for entry in [-2, 50, 1 << 20] + list(range(len(proglist))):
+            if entry == jumps[pc]:
+                continue
+            if 0 <= entry < 50 and proglist[entry] == tag and (entry > pc) == (proglist[pc] < 160):
+                continue
+            damaged = bytearray(good)
+            damaged[tag_index + 4 * pc : tag_index + 4 * pc + 4] = entry.to_bytes(4, "little", signed=True)
+            with open(tape_name, "wb") as tape_file:
+                tape_file.write(damaged)
+            with pytest.raises(ValueError, match="cut short or damaged"):
+                mjh_ob1.func_read_tape(tape_name)
+            checked += 1
+    assert checked > 100
+
+def test_script_json_is_one_line(tmp_path, capsys):
+    prog_name = str(tmp_path / "prog.ob1")
+    with open(prog_name, "w") as prog_file:
+        prog_file.write("exec,d1\nexec,r\n")
+    script_name = str(tmp_path / "script.txt")
+    with open(script_name, "w") as script_file:
+        script_file.write('"%s"\n\n' % prog_name)
+    assert mjh_ob1.main(["--script", script_name, "--json"]) == 0
+    captured = capsys.readouterr()
+    assert len(captured.out.splitlines()) == 1
+    assert json.loads(captured.out)["memx"] == 1
+    assert "Successful Program Load" in captured.err
+
+    with open(script_name, "w") as script_file:
+        script_file.write('"%s"\n\nq\n' % prog_name)
+    assert mjh_ob1.main(["--script", script_name, "--json"]) == 0
+    captured = capsys.readouterr()
+    assert json.loads(captured.out)["exception"] == "Program terminated normally"
+
+    for bad in ('"%s"\n' % str(tmp_path / "missing.ob1"), "nonsense\n"):
+        with open(script_name, "w") as script_file:
+            script_file.write(bad)
+        assert mjh_ob1.main(["--script", script_name, "--json"]) != 0
+        captured = capsys.readouterr()
+        assert len(captured.out.splitlines()) == 1
+        json.loads(captured.out)
+
+def test_batch_reports_partial_load(tmp_path):
+    import mjh_ob1_batch
+    prog_name = str(tmp_path / "prog.ob1")
+    with open(prog_name, "w") as prog_file:
+        prog_file.write("exec,r\nexec,d1\nexec,zz\n")
+    options = {"max_steps": 100, "time_limit": None, "backend": "interp", "detect_loops": False}
+    results = mjh_ob1_batch.func_run_chunk((prog_name, [(0, {}, None), (1, {}, None)], options))
+    assert [record["exception"] for record in results] == ["problem loading program"] * 2
+
+def test_batch_reports_bad_fields(tmp_path):
+    import mjh_ob1_batch
+    prog_name = str(tmp_path / "prog.ob1")
+    with open(prog_name, "w") as prog_file:
+        prog_file.write("exec,r\nexec,d1\n")
+    fields_name = str(tmp_path / "fields.jsonl")
+    with open(fields_name, "w") as fields_file:
+        fields_file.write('{"id": "good", "field": ["0110"]}\n[1, 2]\n{"field": ["01x"]}\n'
+                          '{"memx": "3"}\nnot json\n{"id": "wide", "memx": 30}\n')
+    out_name = str(tmp_path / "out.jsonl")
+    assert mjh_ob1_batch.main([prog_name, "--fields", fields_name, "--out", out_name,
+                               "--workers", "1", "--width", "40", "--height", "3"]) == 0
+    with open(out_name) as out_file:
+        records = [json.loads(xline) for xline in out_file]
+    assert len(records) == 6
+    assert records[0]["exception"] == "Program terminated normally"
+    assert records[0]["field"][0] == "0110" + "0" * 36
+    assert len(records[0]["field"]) == 3
+    assert all(record["exception"].startswith("bad field: line %d:" % (i + 2))
+               for i, record in enumerate(records[1:5]))
+    assert records[5]["memx"] == 31
+
+def test_state_cells_and_loops_on_a_big_field(tmp_path):
+    m = mjh_ob1.Machine(mjh_ob1.MappedField(str(tmp_path / "big.bits"), 1 << 14, 1 << 14))
+    m.load([128, 185, 160])
+    m.field.set(3, 9000)
+    m.memx = 5
+    assert m.state(field="cells")["cells"] == [[3, 9000]]
+    assert "field" not in m.state(field=None)
+    result = m.run(max_steps=10000, detect_loops=True)
+    assert result.reason.startswith("infinite loop detected")
+    m.field.close()
+    a = mjh_ob1.Machine(mjh_ob1.Field(8, 4))
+    a.field.set(2, 3)
+    a.field.set(7, 0)
+    assert a.state(field="cells")["cells"] == [[2, 3], [7, 0]]
+    assert a.state()["field"][0] == "00100000"
+
+def test_checkpoint_bytes_count_wide_rows():
+    m = mjh_ob1.Machine(mjh_ob1.Field(4096, 64))
+    m.load([128, 185, 176, 160])
+    trace = mjh_ob1.Trace(size=4096, interval=16, max_bytes=100000)
+    m.run(max_steps=2000, watchers=[trace])
+    assert trace.checkpoint_bytes <= 100000
+    assert len(trace.checkpoints) == 3
+
+#  Stands in for an asyncio StreamWriter, keeping what was written.
+class FakeWriter:
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(json.loads(data.decode("utf-8")))
+
+    async def drain(self):
+        pass
+
+def test_server_drop_waits_for_the_machine():
+    import asyncio
+    import mjh_ob1_server
+
+    async def session():
+        server = mjh_ob1_server.Server(slice=100)
+        writer = FakeWriter()
+        sent = {}
+        await server.line("a 1", sent, writer)
+        server.host("a").m.load([128, 185, 160])
+        running = asyncio.ensure_future(server.line("a run", sent, writer))
+        queued = asyncio.ensure_future(server.line("a s", sent, writer))
+        await asyncio.sleep(0)
+        await server.line("a drop", sent, writer)
+        await asyncio.gather(running, queued)
+        return writer.lines
+
+    lines = asyncio.run(session())
+    assert lines[1]["exception"] == "stopped"
+    assert lines[2] == {"machine": "a", "error": "machine was dropped"}
+    assert lines[3] == {"machine": "a", "dropped": True}
+
+def test_server_loads_off_the_event_loop(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    import mjh_ob1_server
+    prog_name = str(tmp_path / "prog.ob1")
+    with open(prog_name, "w") as prog_file:
+        prog_file.write("exec,d1\n")
+    threads = []
+    load = mjh_ob1.Machine.load
+
+    def spy(m, program, *args, **kwargs):
+        threads.append(threading.current_thread())
+        return load(m, program, *args, **kwargs)
+
+    monkeypatch.setattr(mjh_ob1.Machine, "load", spy)
+
+    async def session():
+        server = mjh_ob1_server.Server()
+        writer = FakeWriter()
+        await server.line('a "%s"' % prog_name, {}, writer)
+        await server.line("a load " + prog_name, {}, writer)
+        await server.line("a", {}, writer)
+        return writer.lines
+
+    lines = asyncio.run(session())
+    assert len(threads) == 2 and threading.main_thread() not in threads
+    assert lines[2]["exception"] == "Program terminated normally"
+
+def test_server_waits_for_slow_clients():
+    import asyncio
+    import mjh_ob1_server
+
+    class SlowWriter(FakeWriter):
+
+        async def drain(self):
+            self.drained = len(self.lines)
+
+    async def session():
+        server = mjh_ob1_server.Server()
+        writer = SlowWriter()
+        await server.line("a 1", {}, writer)
+        return writer
+
+    assert asyncio.run(session()).drained == 1
+
+def test_sparse_fork_shares_chunks_until_written():
+    rng = random.Random(3)
+    field = mjh_ob1.SparseField()
+    for i in range(300):
+        field.set(rng.randrange(-100, 100), rng.randrange(-100, 100))
+    fork = field.fork()
+    assert all(fork.chunks[key] is chunk for key, chunk in field.chunks.items())
+    want = field.copy_bits()
+    for i in range(2000):
+        x, y = rng.randrange(-120, 20), rng.randrange(-10, 20)
+        fork.flip(x, y)
+        if i % 3 == 0:
+            fork2 = fork.fork()
+            fork2.flip(y, x)
+    assert field.copy_bits() == want
+    shared = sum(fork.chunks.get(key) is chunk for key, chunk in field.chunks.items())
+    assert 0 < shared < len(field.chunks)
+    for key, chunk in fork.chunks.items():
+        assert any(chunk)
+
+def test_memo_keeps_field_sizes_apart():
+    memo = mjh_ob1.Memo()
+    for field in (mjh_ob1.Field(8, 4), mjh_ob1.Field(3, 4), mjh_ob1.SparseField(), mjh_ob1.Field(8, 4)):
+        m = mjh_ob1.Machine(field)
+        m.load([176, 176, 176, 176, 181])
+        plain = m.fork()
+        want = plain.run(max_steps=100)
+        got = memo.run(m, 100)
+        assert (got.reason, got.steps, m.memx) == (want.reason, want.steps, plain.memx)
+    assert memo.hits == 1
+
+def test_superopt_fingerprints_agree_across_processes():
+    import subprocess
+    import sys
+    import mjh_ob1_superopt
+    mjh_ob1_superopt.func_init_worker(mjh_ob1_superopt.func_make_tests(8, 3, 1))
+    here = mjh_ob1_superopt.func_fingerprint((177, 176)).hex()
+    script = ("import mjh_ob1_superopt as s; s.func_init_worker(s.func_make_tests(8, 3, 1)); "
+              "print(s.func_fingerprint((177, 176)).hex())")
+    there = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                           cwd=os.path.dirname(os.path.abspath(mjh_ob1_superopt.__file__)), check=True)
+    assert there.stdout.strip() == here